@@ -0,0 +1,296 @@
+"""
+Synthetic archives and a local HTTP server for the drmhelper benchmarks.
+The server supports HEAD and byte ranges like the real hosts, and can be
+slowed down to a given bandwidth and per request latency.
+"""
+import os
+import platform
+import re
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import drmbinary
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+WRITE_CHUNK = 16 * 1024
+
+
+def write_random(path, size):
+    """
+    Write size bytes of random data, which doesn't compress, so archives
+    are about as big as their contents like the real ones
+    """
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 1024 * 1024)
+            f.write(os.urandom(n))
+            remaining -= n
+
+
+def library_header(size):
+    """
+    Return headers of a library for the machine we're running on which
+    says it's size bytes long, so drmbinary accepts the random data after
+    it as a complete module
+    """
+    bits = struct.calcsize('P') * 8
+    machine = drmbinary.target(
+        {'AMD64': 'x86_64', 'i386': 'x86', 'i686': 'x86', 'arm64': 'aarch64',
+         'armv7l': 'arm'}.get(platform.machine(), platform.machine()), bits)
+    system = platform.system()
+    if system == 'Windows':
+        number = dict((v, k) for k, v in drmbinary.PE_MACHINES.items())
+        opt_size = 224 if bits == 32 else 240
+        header = (b'MZ' + b'\0' * 58 + struct.pack('<I', 64) + b'PE\0\0' +
+                  struct.pack('<HHIIIHH', number[machine], 1, 0, 0, 0,
+                              opt_size, 0x2022))
+        opt = bytearray(opt_size)
+        struct.pack_into('<H', opt, 0, 0x10b if bits == 32 else 0x20b)
+        struct.pack_into('<I', opt, 92 if bits == 32 else 108, 16)
+        return (header + bytes(opt) +
+                struct.pack('<8sIIII', b'.text', size, 4096, size - 1024,
+                            1024))
+    if system == 'Darwin':
+        number = dict((v, k) for k, v in drmbinary.MACHO_MACHINES.items())
+        if bits == 32:
+            cmd = struct.pack('<II16sIIIIiiII', 0x1, 56, b'__TEXT', 0, size,
+                              0, size, 5, 5, 0, 0)
+            return struct.pack('<IiiIIII', 0xfeedface, number[machine], 0, 6,
+                               1, len(cmd), 0) + cmd
+        cmd = struct.pack('<II16sQQQQiiII', 0x19, 72, b'__TEXT', 0, size, 0,
+                          size, 5, 5, 0, 0)
+        return struct.pack('<IiiIIIII', 0xfeedfacf, number[machine], 0, 6, 1,
+                           len(cmd), 0, 0) + cmd
+    number = dict((v, k) for k, v in drmbinary.ELF_MACHINES.items())
+    if bits == 32:
+        return (b'\x7fELF\x01\x01\x01' + b'\0' * 9 +
+                struct.pack('<HHIIIIIHHHHHH', 3, number[machine], 1, 0, 52, 0,
+                            0, 52, 32, 1, 40, 0, 0) +
+                struct.pack('<IIIIIIII', 1, 0, 0, 0, size, size, 5, 4096))
+    return (b'\x7fELF\x02\x01\x01' + b'\0' * 9 +
+            struct.pack('<HHIQQQIHHHHHH', 3, number[machine], 1, 0, 64, 0, 0,
+                        64, 56, 1, 64, 0, 0) +
+            struct.pack('<IIQQQQQQ', 1, 5, 0, 0, 0, size, size, 4096))
+
+
+def write_library(path, size):
+    """
+    Write a library of size bytes, random data after headers that pass the
+    checks check_inputstream() makes
+    """
+    write_random(path, size)
+    with open(path, 'r+b') as f:
+        f.write(library_header(size))
+
+
+def build_zip(path, members):
+    """
+    Write a zip file. members is a dict of archive name to source file.
+    """
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, src in sorted(members.items()):
+            zf.write(src, name)
+
+
+def build_tar_xz(path, members):
+    """
+    Write a .tar.xz file, returns False if there's no lzma module
+    """
+    if lzma is None:
+        return False
+    with open(path, 'wb') as raw:
+        xz = lzma.LZMAFile(raw, 'w')
+        try:
+            with tarfile.open(fileobj=xz, mode='w') as tf:
+                for name, src in sorted(members.items()):
+                    tf.add(src, name)
+        finally:
+            xz.close()
+    return True
+
+
+def build_fixtures(root, cdm_size, ia_files=20, ia_file_size=64 * 1024,
+                   ssd_size=3 * 1024 * 1024, download_size=None):
+    """
+    Create the files the benchmarks serve under root and return a dict of
+    their paths relative to root
+    """
+    src = os.path.join(root, 'src')
+    os.makedirs(src)
+    cdm = os.path.join(src, 'libwidevinecdm.so')
+    write_library(cdm, cdm_size)
+    files = {}
+
+    files['cdm_zip'] = 'widevine/cdm-linux-x64.zip'
+    os.makedirs(os.path.join(root, 'widevine'))
+    build_zip(os.path.join(root, files['cdm_zip']),
+              {'manifest.json': cdm, 'libwidevinecdm.so': cdm})
+    files['cdm_tar_xz'] = 'widevine/chromium-widevine.pkg.tar.xz'
+    if not build_tar_xz(os.path.join(root, files['cdm_tar_xz']),
+                        {'usr/lib/chromium/libwidevinecdm.so': cdm}):
+        del files['cdm_tar_xz']
+
+    ia = {'inputstream.adaptive/addon.xml': None}
+    for i in range(ia_files):
+        name = 'inputstream.adaptive/resources/file{0}.bin'.format(i)
+        ia[name] = os.path.join(src, 'ia{0}.bin'.format(i))
+        write_random(ia[name], ia_file_size)
+    ia['inputstream.adaptive/addon.xml'] = os.path.join(src, 'addon.xml')
+    with open(ia['inputstream.adaptive/addon.xml'], 'w') as f:
+        f.write('<addon id="inputstream.adaptive"/>\n')
+    files['ia_zip'] = 'ia.zip'
+    build_zip(os.path.join(root, files['ia_zip']), ia)
+
+    files['ssd'] = 'libssd_wv.so'
+    write_library(os.path.join(root, files['ssd']), ssd_size)
+    files['download'] = 'download.bin'
+    write_random(os.path.join(root, files['download']),
+                 download_size or cdm_size)
+    return files
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients closing connections early is expected
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, body):
+        server = self.server
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        path = os.path.join(server.root, self.path.split('?')[0].lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        m = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+        if m and server.ranges:
+            first, last = m.groups()
+            if not first:
+                start = max(0, size - int(last))
+            else:
+                start = int(first)
+                if last:
+                    end = min(int(last), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, size))
+        else:
+            self.send_response(200)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if body:
+            self.send_file(path, start, end - start + 1)
+
+    def send_file(self, path, start, length):
+        bandwidth = self.server.bandwidth
+        started = time.time()
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while sent < length:
+                chunk = f.read(min(WRITE_CHUNK, length - sent))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (IOError, OSError):  # client went away
+                    return
+                sent += len(chunk)
+                self.server.sent += len(chunk)
+                if bandwidth:
+                    ahead = sent / float(bandwidth) - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+class FixtureServer(object):
+    """
+    Serve the files in root on a local port in a background thread.
+    bandwidth -- bytes per second per connection, 0 for unlimited
+    latency -- seconds before each response starts
+    ranges -- whether byte range requests are honoured
+    """
+    def __init__(self, root, bandwidth=0, latency=0.0, ranges=True):
+        self.httpd = ThreadingServer(('127.0.0.1', 0), FixtureHandler)
+        self.httpd.root = root
+        self.httpd.bandwidth = bandwidth
+        self.httpd.latency = latency
+        self.httpd.ranges = ranges
+        self.httpd.requests = 0
+        self.httpd.sent = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.httpd.server_address[1])
+
+    def url(self, path):
+        return self.base_url + path
+
+    def reset_counters(self):
+        self.httpd.requests = 0
+        self.httpd.sent = 0
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def sent(self):
+        return self.httpd.sent
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
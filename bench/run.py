@@ -0,0 +1,400 @@
+"""
+Benchmarks for drmhelper, run outside Kodi against the stub xbmc modules
+in bench/stubs and a local HTTP server serving synthetic CDM archives.
+Results are written as JSON so they can be compared between releases.
+
+    python bench/run.py --bandwidth 2000000 --latency 0.05 -o results.json
+
+Each benchmark reports the time of every run plus min, median, mean and
+max in seconds, and extra details like bytes transferred where relevant.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+LIB_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'lib')
+sys.path[0:0] = [STUBS_DIR, LIB_DIR]
+
+import fixtures  # noqa: E402
+import xbmc  # noqa: E402
+import xbmcaddon  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# module level state drmhelper and friends remember between calls
+STATE = {'drmhelper': ['_platform', '_os_version_info', '_verdict_cache',
+                       '_artifact_cache', '_install_record', '_mirror_stats',
+                       '_manifest', '_bundle', '_background_session',
+                       '_capabilities', '_capability', '_metrics',
+                       '_manifest_refresh', '_addon_version',
+                       '_debug_enabled']}
+BENCHMARKS = ['import', 'check_inputstream_cold', 'check_inputstream_warm',
+              'check_inputstream_restart', 'progress_download',
+              'progress_download_segmented', 'download_background',
+              'unzip_cdm',
+              'fetch_widevinecdm_zip', 'fetch_widevinecdm_tar_xz',
+              'get_ia_direct', 'get_ia_direct_cached']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each benchmark')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second per connection, 0 for '
+                             'unlimited')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each HTTP response')
+    parser.add_argument('--rpc-latency', type=float, default=0.0,
+                        help='seconds each JSON-RPC request takes')
+    parser.add_argument('--cdm-size', type=int, default=8 * 1024 * 1024,
+                        help='size of the synthetic widevinecdm library')
+    parser.add_argument('--download-size', type=int,
+                        default=16 * 1024 * 1024,
+                        help='size of the file for download benchmarks')
+    parser.add_argument('--background-rate', type=int, default=1024 * 1024,
+                        help='bytes per second for background downloads')
+    parser.add_argument('--kodi-build', default='18.0 Git:20181010-5c4f5a5',
+                        help='System.BuildVersion info label')
+    parser.add_argument('--os-version', default='LibreELEC (official): 9.0.0',
+                        help='System.OSVersionInfo info label')
+    parser.add_argument('--ia-version', default='2.0.10',
+                        help='installed inputstream.adaptive version')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS,
+                        help='benchmarks to run, default all')
+    parser.add_argument('-o', '--output', help='write JSON here instead of '
+                        'to stdout')
+    return parser.parse_args(argv)
+
+
+def setup_kodi(root, args):
+    """
+    Point the stub modules at a fresh Kodi home under root
+    """
+    xbmc.SPECIAL_ROOT = root
+    xbmc.RPC_LATENCY = args.rpc_latency
+    xbmc.INFO_LABELS.clear()
+    xbmc.INFO_LABELS.update({
+        'System.BuildVersion': args.kodi_build,
+        'System.OSVersionInfo': args.os_version,
+        'System.AddonVersion(inputstream.adaptive)': args.ia_version,
+    })
+    xbmc.ADDONS.clear()
+    xbmc.ADDONS.update({
+        'script.module.drmhelper': {'addonid': 'script.module.drmhelper',
+                                    'enabled': True, 'version': '0.0.0'},
+        'inputstream.adaptive': {
+            'addonid': 'inputstream.adaptive', 'enabled': True,
+            'version': args.ia_version,
+            'path': os.path.join(root, 'home', 'addons',
+                                 'inputstream.adaptive')},
+    })
+    xbmcaddon.SETTINGS['inputstream.adaptive'] = {
+        'DECRYPTERPATH': 'special://home/cdm'}
+    for d in ('home/addons', 'home/cdm', 'profile', 'temp'):
+        os.makedirs(os.path.join(root, d))
+
+
+def reset_state():
+    """
+    Forget everything remembered in memory, as if Kodi started a new
+    interpreter for the next call
+    """
+    import drmrpc
+    for module, names in STATE.items():
+        module = sys.modules[module]
+        for name in names:
+            if hasattr(module, name):
+                setattr(module, name, None)
+    drmrpc.clear()
+
+
+def clear_dir(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def serve_at(server_root, relpath, url):
+    """
+    Make the fixture at relpath available at url as well
+    """
+    path = os.path.join(server_root, url.split('/', 3)[3])
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if not os.path.exists(path):
+        shutil.copyfile(os.path.join(server_root, relpath), path)
+
+
+def summarise(runs, extra=None):
+    ordered = sorted(runs)
+    mid = len(ordered) // 2
+    median = (ordered[mid] if len(ordered) % 2 else
+              (ordered[mid - 1] + ordered[mid]) / 2.0)
+    result = {'runs': runs, 'min': ordered[0], 'max': ordered[-1],
+              'mean': sum(runs) / len(runs), 'median': median}
+    result.update(extra or {})
+    return result
+
+
+def measure(repeat, func, setup=None):
+    """
+    Time func() repeat times, calling setup() untimed before each run.
+    Returns (list of seconds, result of the last run).
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = timer()
+        result = func()
+        runs.append(timer() - started)
+    return runs, result
+
+
+def bench_import(args):
+    code = ('import sys, time; sys.path[0:0] = {0!r}; '
+            't = time.time(); import drmhelper; '
+            'print(time.time() - t)'.format([STUBS_DIR, LIB_DIR]))
+    runs = [float(subprocess.check_output([sys.executable, '-c', code]))
+            for _ in range(args.repeat)]
+    return summarise(runs)
+
+
+class Bench(object):
+    """
+    Benchmarks that need the fixture server and a Kodi home
+    """
+    def __init__(self, args, root, server, files):
+        import drmconfig
+        import drmhelper
+        self.args = args
+        self.root = root
+        self.server = server
+        self.files = files
+        self.drmconfig = drmconfig
+        self.drmhelper = drmhelper
+        self.cdm_path = os.path.join(root, 'kodi', 'home', 'cdm')
+        self.plat = drmhelper.get_platform().plat
+        self.server_root = os.path.join(root, 'srv')
+
+        drmconfig.REPO_BASE = server.url('repo/')
+        drmconfig.REPO_MIRRORS = []
+        drmconfig.WIDEVINECDM_MIRRORS = {}
+        drmconfig.WIDEVINECDM_URL[self.plat] = server.url(files['cdm_zip'])
+        drmconfig.WIDEVINECDM_MEMBER[self.plat] = 'libwidevinecdm.so'
+        reset_state()  # drop anything worked out from the tables above
+        serve_at(self.server_root, files['ia_zip'], drmhelper.get_ia_url())
+        if drmhelper.get_capability().needs_modules:
+            serve_at(self.server_root, files['ssd'],
+                     drmhelper.get_ssd_wv_url())
+
+    def kodi_path(self, *parts):
+        return os.path.join(self.root, 'kodi', *parts)
+
+    def transfer(self):
+        return {'requests': self.server.requests,
+                'bytes_served': self.server.sent}
+
+    def provision_cdm(self):
+        p = self.drmhelper.get_platform()
+        for fn in (p.widevinecdm_filename, p.ssd_filename):
+            path = os.path.join(self.cdm_path, fn)
+            if not os.path.isfile(path):
+                fixtures.write_library(path, 1024 * 1024)
+
+    def cold_check(self):
+        self.provision_cdm()
+        reset_state()
+        verdict = xbmc.translatePath(self.drmconfig.VERDICT_CACHE_FILE)
+        if os.path.isfile(verdict):
+            os.remove(verdict)
+        xbmc.RPC_COUNT[0] = 0
+
+    def check(self):
+        return self.drmhelper.check_inputstream(drm=True)
+
+    def check_inputstream_cold(self):
+        runs, result = measure(self.args.repeat, self.check, self.cold_check)
+        return summarise(runs, {'result': result,
+                                'rpc_calls': xbmc.RPC_COUNT[0]})
+
+    def check_inputstream_warm(self):
+        self.cold_check()
+        self.check()
+        xbmc.RPC_COUNT[0] = 0
+        runs, result = measure(self.args.repeat, self.check)
+        return summarise(runs, {'result': result,
+                                'rpc_calls': xbmc.RPC_COUNT[0]})
+
+    def check_inputstream_restart(self):
+        self.cold_check()
+        self.check()
+        xbmc.RPC_COUNT[0] = 0
+        runs, result = measure(self.args.repeat, self.check, reset_state)
+        return summarise(runs, {'result': result,
+                                'rpc_calls': xbmc.RPC_COUNT[0]})
+
+    def _download(self, connections):
+        url = self.server.url(self.files['download'])
+        dest = self.kodi_path('temp', 'download.bin')
+
+        def setup():
+            clear_dir(self.kodi_path('temp'))
+            os.makedirs(self.kodi_path('temp'))
+            self.server.reset_counters()
+
+        runs, result = measure(
+            self.args.repeat,
+            lambda: self.drmhelper.progress_download(
+                url, dest, connections=connections), setup)
+        size = os.path.getsize(os.path.join(self.server_root,
+                                            self.files['download']))
+        extra = {'bytes': size, 'connections': connections,
+                 'throughput': size / min(runs)}
+        extra.update(self.transfer())
+        return summarise(runs, extra)
+
+    def progress_download(self):
+        return self._download(1)
+
+    def progress_download_segmented(self):
+        return self._download(self.drmconfig.DOWNLOAD_CONNECTIONS)
+
+    def download_background(self):
+        url = self.server.url(self.files['download'])
+        dest = self.kodi_path('temp', 'download.bin')
+        self.drmconfig.BACKGROUND_RATE = self.args.background_rate
+
+        def setup():
+            clear_dir(self.kodi_path('temp'))
+            os.makedirs(self.kodi_path('temp'))
+            reset_state()
+            self.server.reset_counters()
+
+        runs, _ = measure(
+            self.args.repeat,
+            lambda: self.drmhelper.mirror_download(
+                url, dest,
+                session=self.drmhelper.get_download_session(background=True)),
+            setup)
+        size = os.path.getsize(os.path.join(self.server_root,
+                                            self.files['download']))
+        extra = {'bytes': size, 'rate': self.args.background_rate,
+                 'throughput': size / min(runs)}
+        extra.update(self.transfer())
+        return summarise(runs, extra)
+
+    def unzip_cdm(self):
+        zpath = os.path.join(self.cdm_path, 'cdm.zip')
+        src = os.path.join(self.server_root, self.files['cdm_zip'])
+        runs, _ = measure(
+            self.args.repeat,
+            lambda: self.drmhelper.unzip_cdm(zpath, self.cdm_path),
+            lambda: shutil.copyfile(src, zpath))
+        return summarise(runs, {'bytes': self.args.cdm_size})
+
+    def _fetch_cdm(self, relpath, member):
+        url = self.server.url(relpath)
+        dest = self.kodi_path('temp', 'libwidevinecdm.so')
+        runs, _ = measure(
+            self.args.repeat,
+            lambda: self.drmhelper.fetch_widevinecdm(url, member, dest),
+            self.server.reset_counters)
+        extra = {'bytes': self.args.cdm_size,
+                 'archive_bytes': os.path.getsize(
+                     os.path.join(self.server_root, relpath))}
+        extra.update(self.transfer())
+        return summarise(runs, extra)
+
+    def fetch_widevinecdm_zip(self):
+        return self._fetch_cdm(self.files['cdm_zip'], 'libwidevinecdm.so')
+
+    def fetch_widevinecdm_tar_xz(self):
+        if 'cdm_tar_xz' not in self.files:
+            return {'skipped': 'no lzma module to build the archive'}
+        return self._fetch_cdm(self.files['cdm_tar_xz'],
+                               'usr/lib/chromium/libwidevinecdm.so')
+
+    def _ia_direct(self, cached):
+        def setup():
+            if not cached:
+                clear_dir(xbmc.translatePath(
+                    self.drmconfig.ARTIFACT_CACHE_DIR))
+            clear_dir(self.kodi_path('home', 'addons',
+                                     'inputstream.adaptive'))
+            reset_state()
+            self.server.reset_counters()
+
+        if cached:
+            self.drmhelper.get_ia_direct(update=True, drm=False)
+        runs, result = measure(
+            self.args.repeat,
+            lambda: self.drmhelper.get_ia_direct(update=True, drm=False),
+            setup)
+        extra = {'result': result}
+        extra.update(self.transfer())
+        return summarise(runs, extra)
+
+    def get_ia_direct(self):
+        return self._ia_direct(False)
+
+    def get_ia_direct_cached(self):
+        return self._ia_direct(True)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    selected = args.only or BENCHMARKS
+    root = tempfile.mkdtemp(prefix='drmhelper-bench-')
+    results = {}
+    try:
+        if 'import' in selected:
+            results['import'] = bench_import(args)
+        setup_kodi(os.path.join(root, 'kodi'), args)
+        files = fixtures.build_fixtures(
+            os.path.join(root, 'srv'), args.cdm_size,
+            download_size=args.download_size)
+        server = fixtures.FixtureServer(os.path.join(root, 'srv'),
+                                        args.bandwidth, args.latency).start()
+        try:
+            import drmhelper
+            if not drmhelper.get_platform().supported:
+                sys.exit('{0} is not a supported platform'.format(
+                    drmhelper.get_platform().plat))
+            bench = Bench(args, root, server, files)
+            for name in selected:
+                if name != 'import':
+                    results[name] = getattr(bench, name)()
+        finally:
+            if 'drmdownload' in sys.modules:  # close keep-alive connections
+                sys.modules['drmdownload'].get_session().close()
+            server.stop()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Minimal stand in for Kodi's xbmc module, for running drmhelper outside
+Kodi. Info labels, conditions and installed add-ons are plain module
+level dicts the benchmark sets up before each run.
+"""
+import json
+import os
+import re
+import time
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGNOTICE = 2
+LOGWARNING = 3
+LOGERROR = 4
+LOGSEVERE = 5
+LOGFATAL = 6
+LOGNONE = 7
+
+# root directory special:// paths are translated to
+SPECIAL_ROOT = '/tmp/kodi'
+INFO_LABELS = {}
+CONDITIONS = {}
+# installed add-ons, addonid -> dict of JSON-RPC addon details
+ADDONS = {}
+# messages below this level are discarded
+LOG_LEVEL = LOGWARNING
+LOG_LINES = []
+# number of JSON-RPC requests made, batches count once
+RPC_COUNT = [0]
+# seconds each JSON-RPC request takes, to simulate a busy Kodi
+RPC_LATENCY = 0.0
+
+
+def log(msg, level=LOGDEBUG):
+    if level >= LOG_LEVEL:
+        LOG_LINES.append(msg)
+
+
+def getInfoLabel(label):
+    return INFO_LABELS.get(label, '')
+
+
+def getCondVisibility(condition):
+    match = re.match(r'System\.HasAddon\((.+)\)$', condition, re.I)
+    if match:  # like Kodi, only true for enabled add-ons
+        addon = ADDONS.get(match.group(1))
+        return bool(addon and addon.get('enabled'))
+    return CONDITIONS.get(condition, False)
+
+
+def sleep(ms):
+    time.sleep(ms / 1000.0)
+
+
+def translatePath(path):
+    if path.startswith('special://'):
+        return os.path.join(SPECIAL_ROOT, path[len('special://'):])
+    return path
+
+
+def executebuiltin(function, wait=False):
+    pass
+
+
+def _rpc(request):
+    method = request.get('method')
+    params = request.get('params', {})
+    result = None
+    error = None
+    if method == 'Addons.GetAddonDetails':
+        addon = ADDONS.get(params.get('addonid'))
+        if addon is None:
+            error = {'code': -32602, 'message': 'Invalid params.'}
+        else:
+            props = params.get('properties', [])
+            result = {'addon': dict(
+                (k, v) for k, v in addon.items()
+                if k in props or k in ('addonid', 'type'))}
+    elif method == 'Addons.SetAddonEnabled':
+        addon = ADDONS.get(params.get('addonid'))
+        if addon is None:
+            error = {'code': -32602, 'message': 'Invalid params.'}
+        else:
+            addon['enabled'] = params.get('enabled', True)
+            result = 'OK'
+    else:
+        error = {'code': -32601, 'message': 'Method not found.'}
+    response = {'jsonrpc': '2.0', 'id': request.get('id')}
+    if error:
+        response['error'] = error
+    else:
+        response['result'] = result
+    return response
+
+
+def executeJSONRPC(jsonrpccommand):
+    RPC_COUNT[0] += 1
+    if RPC_LATENCY:
+        time.sleep(RPC_LATENCY)
+    request = json.loads(jsonrpccommand)
+    if isinstance(request, list):
+        return json.dumps([_rpc(r) for r in request])
+    return json.dumps(_rpc(request))
+
+
+class Monitor(object):
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=0):
+        return False
+
+
+class Player(object):
+    PLAYING = [False]
+
+    def isPlaying(self):
+        return self.PLAYING[0]
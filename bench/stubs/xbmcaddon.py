@@ -0,0 +1,35 @@
+"""
+Minimal stand in for Kodi's xbmcaddon module
+"""
+import os
+
+import xbmc
+
+# addonid -> dict of settings
+SETTINGS = {}
+
+
+class Addon(object):
+    def __init__(self, id=None):
+        if id is None:
+            id = 'script.module.drmhelper'
+        if id not in xbmc.ADDONS:
+            raise RuntimeError('Unknown addon id \'{0}\'.'.format(id))
+        self.id = id
+
+    def getAddonInfo(self, key):
+        details = xbmc.ADDONS[self.id]
+        if key == 'id':
+            return self.id
+        if key == 'profile':
+            return 'special://profile/addon_data/{0}/'.format(self.id)
+        if key == 'path':
+            return details.get('path', os.path.join(
+                xbmc.SPECIAL_ROOT, 'home', 'addons', self.id))
+        return details.get(key, '')
+
+    def getSetting(self, key):
+        return SETTINGS.get(self.id, {}).get(key, '')
+
+    def setSetting(self, key, value):
+        SETTINGS.setdefault(self.id, {})[key] = value
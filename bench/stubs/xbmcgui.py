@@ -0,0 +1,39 @@
+"""
+Minimal stand in for Kodi's xbmcgui module. Dialogs never block, and yes/no
+questions get the answer in YESNO_ANSWER.
+"""
+YESNO_ANSWER = [False]
+# (title, lines) of every dialog shown
+SHOWN = []
+
+
+class Dialog(object):
+    def ok(self, heading, *lines):
+        SHOWN.append((heading, lines))
+        return True
+
+    def yesno(self, heading, *lines, **kwargs):
+        SHOWN.append((heading, lines))
+        return YESNO_ANSWER[0]
+
+    def notification(self, heading, message, *args, **kwargs):
+        SHOWN.append((heading, (message,)))
+
+
+class DialogProgress(object):
+    def create(self, heading, *lines):
+        self.updates = 0
+
+    def update(self, percent, *lines):
+        self.updates += 1
+
+    def iscanceled(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class DialogProgressBG(DialogProgress):
+    def isFinished(self):
+        return False
@@ -0,0 +1,487 @@
+import os
+import posixpath
+import shutil
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+
+import drmdownload
+
+COPY_CHUNK = 256 * 1024
+# end of central directory record plus the longest possible comment
+EOCD_MAX_SIZE = 22 + 65535
+EOCD_FIRST_READ = 4096
+EOCD_SIG = b'PK\x05\x06'
+CD_ENTRY = struct.Struct('<4s6H3L5H2L')
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class ExtractError(Exception):
+    """
+    Raised when the wanted member can't be extracted from an archive
+    """
+    pass
+
+
+def has_lzma():
+    """
+    Check if .xz archives can be decompressed in process
+    """
+    return lzma is not None
+
+
+def find_member(names, target):
+    """
+    Return the archive member name matching target either exactly or by
+    its file name, or None
+    """
+    if target in names:
+        return target
+    for name in names:
+        if posixpath.basename(name) == posixpath.basename(target):
+            return name
+    return None
+
+
+def copy_member(src, dest, size=None, progress=None,
+                interval=drmdownload.PROGRESS_INTERVAL):
+    """
+    Copy an open archive member to dest in fixed size chunks, so memory use
+    doesn't depend on the member size. The file is written next to dest and
+    moved into place once complete. progress(done, size) is called at most
+    once per interval and may return True to cancel.
+    Returns the number of bytes written.
+    """
+    part_path = dest + '.part'
+    done = 0
+    last_update = time.time()
+    try:
+        with open(part_path, 'wb') as f:
+            while True:
+                chunk = src.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                f.write(chunk)
+                done += len(chunk)
+                now = time.time()
+                if progress and now - last_update >= interval:
+                    last_update = now
+                    if progress(done, size):
+                        raise drmdownload.DownloadCancelled(
+                            'Extraction cancelled')
+    except Exception:
+        os.remove(part_path)
+        raise
+    drmdownload.replace_file(part_path, dest)
+    return done
+
+
+def file_crc32(path):
+    """
+    Return the CRC32 of a file as stored in zip directories
+    """
+    check = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(COPY_CHUNK)
+            if not chunk:
+                break
+            check = zlib.crc32(chunk, check)
+    return check & 0xFFFFFFFF
+
+
+def link_or_copy(src, dest):
+    """
+    Hard link src to dest, or copy it where links aren't possible
+    """
+    try:
+        os.link(src, dest)
+    except (AttributeError, OSError):  # no os.link on windows python 2
+        shutil.copyfile(src, dest)
+
+
+def extract_zip_tree(zpath, prefix, dest):
+    """
+    Replace the directory dest with the members of a zip file under prefix.
+    The new tree is built in a staging directory next to dest and renamed
+    into place, so dest is never left partly written. Files in dest with
+    the same size and CRC32 as in the zip directory are linked or copied
+    into the staging directory instead of being extracted again.
+    Returns (number of files extracted, number reused).
+    """
+    staging = dest + '.staging'
+    old = dest + '.old'
+    if os.path.isdir(old):
+        if not os.path.isdir(dest):  # interrupted while swapping
+            os.rename(old, dest)
+        else:
+            shutil.rmtree(old)
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    extracted = reused = 0
+    try:
+        with zipfile.ZipFile(zpath) as zf:
+            for info in zf.infolist():
+                if not info.filename.startswith(prefix + '/'):
+                    continue
+                rel = info.filename[len(prefix) + 1:]
+                parts = [p for p in rel.split('/') if p]
+                if '..' in parts or rel.startswith('/'):
+                    raise ExtractError('Unsafe path {0} in {1}'.format(
+                        info.filename, zpath))
+                if not parts:
+                    continue
+                target = os.path.join(staging, *parts)
+                if rel.endswith('/'):
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    continue
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                current = os.path.join(dest, *parts)
+                if (os.path.isfile(current) and
+                        os.path.getsize(current) == info.file_size and
+                        file_crc32(current) == info.CRC):
+                    link_or_copy(current, target)
+                    reused += 1
+                    continue
+                src = zf.open(info)
+                try:
+                    with open(target, 'wb') as f:
+                        shutil.copyfileobj(src, f, COPY_CHUNK)
+                finally:
+                    src.close()
+                extracted += 1
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    if os.path.isdir(dest):
+        os.rename(dest, old)
+    try:
+        os.rename(staging, dest)
+    except OSError:
+        os.rename(old, dest)
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    shutil.rmtree(old, ignore_errors=True)
+    return extracted, reused
+
+
+def extract_zip_member(zpath, member, dest, progress=None):
+    """
+    Extract a single member of a zip file to dest
+    """
+    with zipfile.ZipFile(zpath) as zf:
+        name = find_member(zf.namelist(), member)
+        if not name:
+            raise ExtractError('{0} not found in {1}'.format(member, zpath))
+        src = zf.open(name)
+        try:
+            return copy_member(src, dest, zf.getinfo(name).file_size,
+                               progress)
+        finally:
+            src.close()
+
+
+class XZReader(object):
+    """
+    Minimal file like object decompressing xz data read from another file
+    like object, for use with tarfile's stream mode
+    """
+    def __init__(self, fileobj, read_size=64 * 1024, on_read=None):
+        self.fileobj = fileobj
+        self.read_size = read_size
+        self.on_read = on_read
+        self.decompressor = lzma.LZMADecompressor()
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or
+                                len(self.buffer) - self.pos < size):
+            data = self.fileobj.read(self.read_size)
+            if not data:
+                self.eof = True
+                break
+            if self.on_read:
+                self.on_read(len(data))
+            self.buffer = (self.buffer[self.pos:] +
+                           self.decompressor.decompress(data))
+            self.pos = 0
+        end = len(self.buffer) if size < 0 else self.pos + size
+        data = self.buffer[self.pos:end]
+        self.pos += len(data)
+        return data
+
+
+def extract_tar_member(fileobj, member, dest, progress=None):
+    """
+    Extract a single member of a tar stream to dest without seeking, so the
+    stream can be a decompressor reading straight from the network
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|') as tf:
+        for info in tf:
+            if info.isfile() and find_member([info.name], member):
+                src = tf.extractfile(info)
+                return copy_member(src, dest, info.size, progress)
+    raise ExtractError('{0} not found in archive'.format(member))
+
+
+def stream_tar_xz_member(url, member, dest, progress=None, session=None):
+    """
+    Download a .tar.xz archive and extract a single member on the fly, so
+    the archive itself is never written to disk. progress(read, total) is
+    given the compressed bytes read from the network. If downloads are
+    paused part way, the archive is read again from the start afterwards.
+    """
+    getter = session or drmdownload.get_session()
+    if not has_lzma():
+        raise ExtractError('lzma module not available')
+    while True:
+        try:
+            return _stream_tar_xz_member(getter, url, member, dest, progress)
+        except drmdownload.DownloadPaused:
+            # the decompressor can't pick up part way through the stream
+            getter.wait()
+
+
+def _stream_tar_xz_member(getter, url, member, dest, progress):
+    import requests
+    try:
+        res = getter.get(url, stream=True, verify=False,
+                         timeout=drmdownload.TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise drmdownload.DownloadError(str(e))
+    try:
+        if res.status_code >= 400:
+            raise drmdownload.DownloadError(
+                'HTTP {0} error'.format(res.status_code), res.status_code)
+        length = res.headers.get('content-length')
+        total = int(length) if length else None
+        state = {'read': 0, 'last_update': time.time()}
+
+        def on_read(n):
+            state['read'] += n
+            now = time.time()
+            if progress and (now - state['last_update'] >=
+                             drmdownload.PROGRESS_INTERVAL):
+                state['last_update'] = now
+                if progress(state['read'], total):
+                    raise drmdownload.DownloadCancelled(
+                        'Download cancelled')
+
+        reader = XZReader(res.raw, on_read=on_read)
+        try:
+            return extract_tar_member(reader, member, dest)
+        except (lzma.LZMAError, tarfile.TarError) as e:
+            raise ExtractError(str(e))
+        except drmdownload.network_errors() as e:
+            raise drmdownload.DownloadError(str(e))
+    finally:
+        res.close()
+
+
+class RemoteZip(object):
+    """
+    Read single members of a zip file on a web server with HTTP Range
+    requests, fetching only the central directory and the member's own
+    compressed bytes instead of the whole archive
+    """
+    def __init__(self, url, session=None):
+        self.url = url
+        self.getter = session or drmdownload.get_session()
+        self._entries = None
+        self.transferred = 0
+
+    def _get_range(self, start, end=None):
+        """
+        Return a streamed response for a byte range. A negative start with
+        no end requests the last -start bytes.
+        """
+        if start < 0:
+            spec = 'bytes={0}'.format(start)
+        else:
+            spec = 'bytes={0}-{1}'.format(start, '' if end is None else end)
+        try:
+            res = self.getter.get(self.url, stream=True, verify=False,
+                                  headers={'Range': spec},
+                                  timeout=drmdownload.TIMEOUT)
+        except drmdownload.network_errors() as e:
+            raise drmdownload.DownloadError(str(e))
+        if res.status_code != 206:
+            res.close()
+            if res.status_code == 200:
+                raise drmdownload.RangeNotSupported(
+                    'Server ignored range request for {0}'.format(self.url))
+            raise drmdownload.DownloadError(
+                'HTTP {0} error'.format(res.status_code), res.status_code)
+        return res
+
+    def _read_range(self, start, end=None):
+        res = self._get_range(start, end)
+        try:
+            data = res.content
+        finally:
+            res.close()
+        self.transferred += len(data)
+        return data, drmdownload.content_range_total(res)
+
+    def entries(self):
+        """
+        Return dict of member name to (method, crc, compressed size,
+        uncompressed size, local header offset, name and extra field
+        length)
+        """
+        if self._entries is not None:
+            return self._entries
+        # most archives have no comment, so try a small read first
+        tail, size = self._read_range(-EOCD_FIRST_READ)
+        pos = tail.rfind(EOCD_SIG)
+        if pos < 0 and size is not None and size > len(tail):
+            tail, size = self._read_range(-EOCD_MAX_SIZE)
+            pos = tail.rfind(EOCD_SIG)
+        if pos < 0 or size is None:
+            raise ExtractError('No end of central directory record found')
+        cd_size, cd_offset = struct.unpack('<2L', tail[pos + 12:pos + 20])
+        if cd_offset == 0xFFFFFFFF:
+            raise ExtractError('Zip64 archives not supported')
+        tail_start = size - len(tail)
+        if cd_offset >= tail_start:
+            directory = tail[cd_offset - tail_start:
+                             cd_offset - tail_start + cd_size]
+        else:
+            directory = self._read_range(cd_offset,
+                                         cd_offset + cd_size - 1)[0]
+
+        entries = {}
+        pos = 0
+        while pos + CD_ENTRY.size <= len(directory):
+            fields = CD_ENTRY.unpack_from(directory, pos)
+            if fields[0] != b'PK\x01\x02':
+                break
+            name_len, extra_len, comment_len = fields[10:13]
+            start = pos + CD_ENTRY.size
+            name = directory[start:start + name_len].decode('utf-8', 'replace')
+            entries[name] = (fields[4], fields[7], fields[8], fields[9],
+                             fields[16], name_len + extra_len)
+            pos = start + name_len + extra_len + comment_len
+        self._entries = entries
+        return entries
+
+    def extract(self, member, dest, progress=None,
+                interval=drmdownload.PROGRESS_INTERVAL):
+        """
+        Fetch and inflate a single member to dest, checking its CRC.
+        progress(done, total) is given compressed bytes and may return True
+        to cancel. Returns the uncompressed size.
+        """
+        entries = self.entries()
+        name = find_member(list(entries), member)
+        if not name:
+            raise ExtractError('{0} not found in {1}'.format(member, self.url))
+        method, crc, comp_size, size, offset, extra_len = entries[name]
+        if method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        elif method == zipfile.ZIP_STORED:
+            decompressor = None
+        else:
+            raise ExtractError('Unsupported compression method {0}'.format(
+                method))
+
+        # one request covers the local header and the member data, assuming
+        # the local extra field is as long as the central directory's. pos
+        # and end are the file offsets of the next and last byte of the
+        # response, which is always read to the end so its connection can
+        # be used again.
+        pos = offset
+        end = offset + LOCAL_HEADER.size + extra_len + comp_size - 1
+        res = self._get_range(pos, end)
+        part_path = dest + '.part'
+        try:
+            header = res.raw.read(LOCAL_HEADER.size)
+            fields = LOCAL_HEADER.unpack(header)
+            if fields[0] != b'PK\x03\x04':
+                raise ExtractError('Bad local file header for {0}'.format(
+                    name))
+            pos += LOCAL_HEADER.size
+            start = pos + fields[9] + fields[10]
+            while pos < min(start, end + 1):  # skip the name and extra field
+                skipped = len(res.raw.read(min(start, end + 1) - pos))
+                if not skipped:
+                    raise ExtractError('Truncated local file header')
+                pos += skipped
+            done = 0
+            check = 0
+            last_update = time.time()
+            with open(part_path, 'wb') as f:
+                while done < comp_size:
+                    if pos > end:  # the local extra field is longer
+                        res.close()
+                        pos, end = start + done, start + comp_size - 1
+                        res = self._get_range(pos, end)
+                    try:
+                        chunk = res.raw.read(min(COPY_CHUNK, comp_size - done,
+                                                 end + 1 - pos))
+                    except drmdownload.DownloadPaused:
+                        # close the connection and ask for the rest of the
+                        # member once the pause is over
+                        res.close()
+                        self.getter.wait()
+                        end = pos - 1
+                        continue
+                    if not chunk:
+                        raise drmdownload.DownloadError(
+                            'Connection closed after {0} of {1} bytes'.format(
+                                done, comp_size))
+                    pos += len(chunk)
+                    done += len(chunk)
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                    check = zlib.crc32(chunk, check)
+                    f.write(chunk)
+                    now = time.time()
+                    if progress and now - last_update >= interval:
+                        last_update = now
+                        if progress(done, comp_size):
+                            raise drmdownload.DownloadCancelled(
+                                'Download cancelled')
+                if decompressor:
+                    tail = decompressor.flush()
+                    check = zlib.crc32(tail, check)
+                    f.write(tail)
+            if pos <= end:  # the local extra field is shorter
+                try:
+                    res.raw.read(end + 1 - pos)
+                except drmdownload.DownloadPaused:
+                    pass  # closed below instead
+            self.transferred += done
+        except Exception as e:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if isinstance(e, struct.error):
+                raise ExtractError('Truncated local file header')
+            if isinstance(e, drmdownload.network_errors()):
+                raise drmdownload.DownloadError(str(e))
+            raise
+        finally:
+            res.close()
+
+        if check & 0xFFFFFFFF != crc:
+            os.remove(part_path)
+            raise ExtractError('CRC mismatch for {0}'.format(name))
+        drmdownload.replace_file(part_path, dest)
+        return size
@@ -0,0 +1,259 @@
+import os
+import struct
+
+# bytes read up front, enough for the headers and usually the program or
+# load command tables too
+HEADER_READ = 4096
+# largest header table we'll read, anything bigger means a damaged file
+MAX_TABLE = 1024 * 1024
+
+ELF_MACHINES = {3: 'x86', 62: 'x86_64', 40: 'arm', 183: 'aarch64'}
+PE_MACHINES = {0x14c: 'x86', 0x8664: 'x86_64', 0x1c4: 'arm',
+               0xaa64: 'aarch64'}
+MACHO_MACHINES = {7: 'x86', 0x01000007: 'x86_64', 12: 'arm',
+                  0x0100000c: 'aarch64'}
+# machine a 32 and 64 bit process runs as, by CPU arch
+TARGETS = {'x86': ('x86', 'x86_64'),
+           'x86_64': ('x86', 'x86_64'),
+           'arm': ('arm', 'aarch64'),
+           'aarch64': ('arm', 'aarch64')}
+
+# path: ((size, mtime), BinaryInfo or BinaryError)
+_cache = {}
+
+
+class BinaryError(Exception):
+    """
+    Raised when a file isn't a complete library in a format we know
+    """
+    pass
+
+
+class IncompatibleBinary(BinaryError):
+    """
+    Raised when a library is intact but built for another machine
+    """
+    pass
+
+
+class BinaryInfo(object):
+    """
+    What a library's headers say about it. archs is a list of
+    (machine, bits), more than one for Mach-O universal binaries. size is
+    the length of the file according to the headers.
+    """
+    def __init__(self, fmt, archs, size):
+        self.format = fmt
+        self.archs = archs
+        self.size = size
+
+    def supports(self, machine, bits):
+        return (machine, bits) in self.archs
+
+    def __str__(self):
+        return '{0} {1}'.format(self.format, ', '.join(
+            '{0} {1} bit'.format(m, b) for m, b in self.archs))
+
+
+def target(arch, bits):
+    """
+    Return the machine libraries must be built for to load into a process
+    of bits (32 or 64) on a CPU of arch, as in drmconfig.ARCH_DICT
+    """
+    machines = TARGETS.get(arch)
+    if not machines:
+        return arch
+    return machines[bits == 64]
+
+
+class _Reader(object):
+    """
+    Reads header fields from a file, from the first HEADER_READ bytes where
+    possible
+    """
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.head = f.read(HEADER_READ)
+
+    def read(self, offset, length):
+        if length > MAX_TABLE:
+            raise BinaryError('header table of {0} bytes is too '
+                              'big'.format(length))
+        if offset + length > self.size:
+            raise BinaryError('truncated, headers end at {0} but the file '
+                              'is {1} bytes'.format(offset + length,
+                                                    self.size))
+        if offset + length <= len(self.head):
+            return self.head[offset:offset + length]
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def unpack(self, fmt, offset):
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))
+
+
+def _elf(r):
+    ident = bytearray(r.read(0, 16))
+    bits = {1: 32, 2: 64}.get(ident[4])
+    e = {1: '<', 2: '>'}.get(ident[5])
+    if not bits or not e:
+        raise BinaryError('unknown ELF class or byte order')
+    if bits == 32:
+        fields = r.unpack(e + 'HHIIIIIHHHHHH', 16)
+        ph_fmt, ph_fields = e + 'IIIIIIII', (1, 4)
+    else:
+        fields = r.unpack(e + 'HHIQQQIHHHHHH', 16)
+        ph_fmt, ph_fields = e + 'IIQQQQQQ', (2, 5)
+    machine = fields[1]
+    phoff, shoff = fields[4], fields[5]
+    ehsize, phentsize, phnum, shentsize, shnum = fields[7:12]
+    end = ehsize
+    if shoff:
+        end = max(end, shoff + max(shnum, 1) * shentsize)
+    if phoff and phnum:
+        if phentsize < struct.calcsize(ph_fmt):
+            raise BinaryError('bad program header size')
+        table = r.read(phoff, phnum * phentsize)
+        end = max(end, phoff + len(table))
+        for i in range(phnum):
+            ph = struct.unpack_from(ph_fmt, table, i * phentsize)
+            end = max(end, ph[ph_fields[0]] + ph[ph_fields[1]])
+    return BinaryInfo('ELF', [(ELF_MACHINES.get(machine, str(machine)),
+                               bits)], end)
+
+
+def _pe(r):
+    lfanew, = r.unpack('<I', 0x3c)
+    if r.read(lfanew, 4) != b'PE\0\0':
+        raise BinaryError('no PE signature')
+    machine, nsections, _, _, _, opt_size, _ = r.unpack('<HHIIIHH',
+                                                         lfanew + 4)
+    opt = lfanew + 24
+    magic, = r.unpack('<H', opt)
+    bits = {0x10b: 32, 0x20b: 64}.get(magic)
+    if not bits:
+        raise BinaryError('unknown PE optional header')
+    table = r.read(opt + opt_size, nsections * 40)
+    end = opt + opt_size + len(table)
+    for i in range(nsections):
+        raw_size, raw_ptr = struct.unpack_from('<II', table, i * 40 + 16)
+        if raw_size:
+            end = max(end, raw_ptr + raw_size)
+    # the certificate table of signed dlls follows the sections and its
+    # directory entry holds a file offset rather than an address
+    dirs = opt + (96 if bits == 32 else 112)
+    ndirs, = r.unpack('<I', dirs - 4)
+    if ndirs > 4:
+        cert_offset, cert_size = r.unpack('<II', dirs + 4 * 8)
+        if cert_size:
+            end = max(end, cert_offset + cert_size)
+    return BinaryInfo('PE', [(PE_MACHINES.get(machine, str(machine)),
+                              bits)], end)
+
+
+def _macho(r, e, bits):
+    cputype, _, _, ncmds, sizeofcmds, _ = r.unpack(e + 'iiIIII', 4)
+    header_size = 28 if bits == 32 else 32
+    cmds = r.read(header_size, sizeofcmds)
+    end = header_size + sizeofcmds
+    offset = 0
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from(e + 'II', cmds, offset)
+        if cmdsize < 8:
+            raise BinaryError('bad load command size')
+        if cmd == 0x1:  # LC_SEGMENT
+            fileoff, filesize = struct.unpack_from(e + 'II', cmds,
+                                                   offset + 32)
+            end = max(end, fileoff + filesize)
+        elif cmd == 0x19:  # LC_SEGMENT_64
+            fileoff, filesize = struct.unpack_from(e + 'QQ', cmds,
+                                                   offset + 40)
+            end = max(end, fileoff + filesize)
+        offset += cmdsize
+    return BinaryInfo('Mach-O', [(MACHO_MACHINES.get(cputype, str(cputype)),
+                                  bits)], end)
+
+
+def _fat(r):
+    nfat, = r.unpack('>I', 4)
+    table = r.read(8, nfat * 20)
+    archs = []
+    end = 8 + len(table)
+    for i in range(nfat):
+        cputype, _, offset, size, _ = struct.unpack_from('>iiIII', table,
+                                                         i * 20)
+        archs.append((MACHO_MACHINES.get(cputype, str(cputype)),
+                      64 if cputype & 0x01000000 else 32))
+        end = max(end, offset + size)
+    return BinaryInfo('Mach-O universal', archs, end)
+
+
+def _parse(path, size):
+    with open(path, 'rb') as f:
+        r = _Reader(f, size)
+        magic = r.read(0, 4)
+        if magic == b'\x7fELF':
+            info = _elf(r)
+        elif magic[:2] == b'MZ':
+            info = _pe(r)
+        elif magic in (b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe'):
+            info = _macho(r, '>' if magic[0:1] == b'\xfe' else '<', 32)
+        elif magic in (b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe'):
+            info = _macho(r, '>' if magic[0:1] == b'\xfe' else '<', 64)
+        elif magic == b'\xca\xfe\xba\xbe':
+            info = _fat(r)
+        else:
+            raise BinaryError('not an ELF, PE or Mach-O library')
+    if info.size > size:
+        raise BinaryError('truncated, {0} of {1} bytes'.format(size,
+                                                               info.size))
+    return info
+
+
+def inspect(path):
+    """
+    Read the ELF, PE or Mach-O headers of the library at path, without
+    reading the rest of it. Raises BinaryError if it's missing, damaged or
+    shorter than its headers say. Results are kept until the file's size
+    or mtime change.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        _cache.pop(path, None)
+        raise BinaryError('not found')
+    stamp = (st.st_size, st.st_mtime)
+    cached = _cache.get(path)
+    if cached and cached[0] == stamp:
+        result = cached[1]
+    else:
+        try:
+            result = _parse(path, st.st_size)
+        except BinaryError as e:
+            result = e
+        except (IOError, OSError) as e:
+            raise BinaryError('unable to read: {0}'.format(e))
+        except struct.error:
+            result = BinaryError('damaged headers')
+        _cache[path] = (stamp, result)
+    if isinstance(result, BinaryError):
+        raise result
+    return result
+
+
+def check(path, machine, bits):
+    """
+    Check the library at path is complete and built for machine and bits,
+    see target(). Returns its BinaryInfo, or raises BinaryError or
+    IncompatibleBinary.
+    """
+    info = inspect(path)
+    if not info.supports(machine, bits):
+        raise IncompatibleBinary('built for {0}, not {1} {2} bit'.format(
+            info, machine, bits))
+    return info
+
+
+def clear():
+    _cache.clear()
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import time
+import zipfile
+
+import drmarchive
+import drmcache
+import drmdownload
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+
+
+class BundleError(Exception):
+    """
+    Raised when a bundle can't be read or holds a file that doesn't match
+    its manifest
+    """
+    pass
+
+
+def build(path, plat, kodi, artifacts):
+    """
+    Write a bundle for plat and kodi to path. artifacts is a list of
+    (key, file path), key being what the file is cached under. Files are
+    stored uncompressed under their sha256 digest, as they're either
+    archives already or don't compress well, and listed in a manifest
+    with their size and digest. Returns the manifest.
+    """
+    manifest = {'format': FORMAT, 'plat': plat, 'kodi': kodi,
+                'created': int(time.time()), 'artifacts': {}}
+    part_path = path + '.part'
+    with zipfile.ZipFile(part_path, 'w', zipfile.ZIP_STORED,
+                         allowZip64=True) as zf:
+        written = set()
+        for key, src in artifacts:
+            sha256 = drmcache.hash_file(src)
+            if sha256 not in written:
+                zf.write(src, sha256)
+                written.add(sha256)
+            manifest['artifacts'][key] = {'sha256': sha256,
+                                          'size': os.path.getsize(src)}
+        zf.writestr(MANIFEST, json.dumps(manifest, indent=1, sort_keys=True))
+    drmdownload.replace_file(part_path, path)
+    return manifest
+
+
+class VerifyingReader(object):
+    """
+    File wrapper hashing the data as it's read, which raises BundleError at
+    the end of the file if the size or digest aren't the expected ones
+    """
+    def __init__(self, fileobj, size, sha256):
+        self.fileobj = fileobj
+        self.size = size
+        self.sha256 = sha256
+        self.hasher = hashlib.sha256()
+        self.done = 0
+
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        if chunk:
+            self.hasher.update(chunk)
+            self.done += len(chunk)
+            if self.done > self.size:
+                raise BundleError('File is bigger than its manifest says')
+        elif self.done != self.size:
+            raise BundleError('File is truncated, {0} of {1} bytes'.format(
+                self.done, self.size))
+        elif self.hasher.hexdigest() != self.sha256:
+            raise BundleError('File does not match its sha256 digest')
+        return chunk
+
+
+class Bundle(object):
+    """
+    Offline bundle made by build(), on a local disk or a mounted network
+    share. Only the manifest is read up front, and the archive is opened
+    again for each file so a share going away in between doesn't matter.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with zipfile.ZipFile(path) as zf:
+                manifest = json.loads(zf.read(MANIFEST).decode('utf-8'))
+        except (IOError, OSError, KeyError, ValueError,
+                zipfile.BadZipfile) as e:
+            raise BundleError('{0} is not a usable bundle: {1}'.format(path,
+                                                                       e))
+        if manifest.get('format') != FORMAT:
+            raise BundleError('{0} has unknown format {1}'.format(
+                path, manifest.get('format')))
+        self.plat = manifest.get('plat')
+        self.kodi = manifest.get('kodi')
+        self.created = manifest.get('created')
+        self.artifacts = manifest.get('artifacts', {})
+
+    def lookup(self, key):
+        """
+        Return {'sha256': digest, 'size': bytes} of the file for key, or
+        None if the bundle doesn't have it
+        """
+        return self.artifacts.get(key)
+
+    def extract(self, key, dest, progress=None):
+        """
+        Copy the file for key to dest, checking it against the manifest as
+        it's copied. Nothing is left at dest if it doesn't match.
+        Returns its sha256 digest.
+        """
+        entry = self.artifacts.get(key)
+        if not entry:
+            raise BundleError('{0} is not in {1}'.format(key, self.path))
+        try:
+            with zipfile.ZipFile(self.path) as zf:
+                src = zf.open(entry['sha256'])
+                try:
+                    drmarchive.copy_member(
+                        VerifyingReader(src, entry['size'], entry['sha256']),
+                        dest, entry['size'], progress)
+                finally:
+                    src.close()
+        except (IOError, OSError, KeyError, zipfile.BadZipfile) as e:
+            raise BundleError('Unable to read {0} from {1}: {2}'.format(
+                key, self.path, e))
+        return entry['sha256']
@@ -0,0 +1,415 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+
+HASH_BLOCK = 1024 * 1024
+LOCK_POLL = 0.1
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+
+def make_key(parts):
+    """
+    Return a short stable digest for a list of JSON serialisable key parts
+    """
+    blob = json.dumps(parts, sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+def stat_key(path):
+    """
+    Return [size, mtime] for a file, or None if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [st.st_size, int(st.st_mtime)]
+
+
+def hash_file(path, hasher=None, length=None):
+    """
+    Return the sha256 hex digest of a file, or of its first length bytes.
+    The file is memory mapped where possible so hashing doesn't need any
+    extra copies. If hasher is given it's updated and the digest returned.
+    """
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        if length is None:
+            length = os.fstat(f.fileno()).st_size
+        try:
+            m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):  # empty file or no mmap
+            m = None
+        if m is not None:
+            try:
+                for pos in range(0, length, HASH_BLOCK):
+                    hasher.update(m[pos:min(pos + HASH_BLOCK, length)])
+            finally:
+                m.close()
+        else:
+            remaining = length
+            while remaining > 0:
+                block = f.read(min(HASH_BLOCK, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+    return hasher.hexdigest()
+
+
+def file_matches(path, expected):
+    """
+    Check if a file has the size and sha256 digest in expected, a dict with
+    'size' and 'sha256' keys. The size is compared first so most mismatches
+    don't need the file to be read.
+    """
+    try:
+        if os.path.getsize(path) != expected['size']:
+            return False
+    except (OSError, KeyError):
+        return False
+    return hash_file(path) == expected.get('sha256')
+
+
+def write_json(path, data):
+    """
+    Write data to a json file, replacing any previous file in one step so
+    readers never see a partially written file
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                        threading.current_thread().ident)
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:  # windows won't rename over an existing file
+        os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def file_id(path):
+    """
+    Return (inode, size, mtime) of a file, which changes whenever it's
+    replaced by write_json(), or None if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+class LockTimeout(Exception):
+    """
+    Raised when a FileLock can't be acquired in time
+    """
+    pass
+
+
+class ArtifactTooLarge(Exception):
+    """
+    Raised when a file is too big to fit in the ArtifactCache at all
+    """
+    pass
+
+
+class FileLock(object):
+    """
+    Exclusive lock on a file, held against other processes as well as other
+    threads. The operating system drops the lock if its holder dies, so
+    there are no stale locks to clean up.
+    """
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._f = None
+
+    def acquire(self):
+        """
+        Wait until the lock is free and take it. Raises LockTimeout if it's
+        still held by someone else after timeout seconds.
+        """
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        f = open(self.path, 'a+')
+        f.seek(0)
+        started = time.time()
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except (IOError, OSError):
+                if (self.timeout is not None and
+                        time.time() - started >= self.timeout):
+                    f.close()
+                    raise LockTimeout('Timed out waiting for {0}'.format(
+                        self.path))
+                time.sleep(LOCK_POLL)
+        self._f = f
+
+    def release(self):
+        if self._f is None:
+            return
+        try:
+            if fcntl:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            else:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class JSONStore(object):
+    """
+    Dict kept in a json file. The file is read again whenever another
+    process has replaced it, and changes made through update() start from
+    the latest copy on disk so concurrent writers don't lose each other's
+    entries.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._id = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        current = file_id(self.path)
+        if self._data is None or current != self._id:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._data = {}
+            self._id = current
+        return self._data
+
+    def _save(self):
+        try:
+            write_json(self.path, self._data)
+            self._id = file_id(self.path)
+        except (IOError, OSError):
+            pass  # losing a cache entry only costs a download or check
+
+    def update(self, change):
+        """
+        Call change(data) with the current contents and save the result,
+        holding a lock so other threads and processes wait their turn
+        """
+        with self._lock:
+            try:
+                lock = FileLock(self.path + '.lock')
+                lock.acquire()
+            except (IOError, OSError):
+                lock = None
+            try:
+                result = change(self._load())
+                self._save()
+                return result
+            finally:
+                if lock:
+                    lock.release()
+
+
+class VerdictCache(JSONStore):
+    """
+    Disk backed store of the last positive check_inputstream() verdicts.
+    Entries are only valid while their key matches the current key built
+    from the inputs the verdict depends on.
+    """
+
+    def lookup(self, name):
+        """
+        Return stored entry for name, or None
+        """
+        return self._load().get(name)
+
+    def store(self, name, key, **extra):
+        """
+        Store key plus any extra info for name and persist to disk
+        """
+        entry = dict(extra, key=key)
+        self.update(lambda data: data.__setitem__(name, entry))
+        return entry
+
+    def invalidate(self, name=None):
+        """
+        Remove entry for name, or all entries if name is None
+        """
+        if name is None:
+            self.update(lambda data: data.clear())
+        else:
+            self.update(lambda data: data.pop(name, None))
+
+
+class ArtifactCache(JSONStore):
+    """
+    Content addressed store for downloaded files. Files are saved under
+    their sha256 digest and an index maps each source key (normally the
+    URL) to its digest, size and last use time. The least recently used
+    files are removed once the total size goes over max_size.
+    """
+    def __init__(self, directory, max_size):
+        super(ArtifactCache, self).__init__(
+            os.path.join(directory, 'index.json'))
+        self.directory = directory
+        self.max_size = max_size
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def lookup(self, key, sha256=None):
+        """
+        Return the path of the cached file for key, or None if it isn't
+        cached or doesn't have the expected digest
+        """
+        entry = self._load().get(key)
+        if not entry or (sha256 and entry['sha256'] != sha256):
+            return None
+        path = self.blob_path(entry['sha256'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            self.update(lambda index: index.pop(key, None))
+            return None
+
+        def touch(index):
+            if key in index:
+                index[key]['used'] = time.time()
+        self.update(touch)
+        return path
+
+    def restore(self, key, dest, sha256=None):
+        """
+        Copy the cached file for key to dest. Returns True on a cache hit.
+        """
+        path = self.lookup(key, sha256)
+        if not path:
+            return False
+        part_path = dest + '.part'
+        try:
+            shutil.copyfile(path, part_path)
+            if os.path.exists(dest):
+                os.remove(dest)
+            os.rename(part_path, dest)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def digest(self, key):
+        """
+        Return the sha256 digest recorded for key, or None
+        """
+        entry = self._load().get(key)
+        return entry['sha256'] if entry else None
+
+    def store(self, key, path, sha256=None):
+        """
+        Add a copy of the file at path to the cache under key, hashing it
+        while it's copied unless the digest is already known. Other files
+        are evicted to make room for it, never the file itself.
+        Returns the sha256 digest of the file, raises ArtifactTooLarge if
+        it's bigger than max_size.
+        """
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            raise ArtifactTooLarge('{0} is {1} bytes, more than the cache '
+                                   'size of {2}'.format(key, size,
+                                                        self.max_size))
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        if not (sha256 and os.path.isfile(self.blob_path(sha256))):
+            hasher = hashlib.sha256()
+            tmp_path = os.path.join(self.directory, 'incoming.{0}.{1}'.format(
+                os.getpid(), threading.current_thread().ident))
+            with open(path, 'rb') as src:
+                with open(tmp_path, 'wb') as dst:
+                    while True:
+                        block = src.read(HASH_BLOCK)
+                        if not block:
+                            break
+                        hasher.update(block)
+                        dst.write(block)
+            sha256 = hasher.hexdigest()
+            if os.path.isfile(self.blob_path(sha256)):
+                os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, self.blob_path(sha256))
+
+        def add(index):
+            index[key] = {'sha256': sha256, 'size': size,
+                          'used': time.time()}
+            self._evict(index, keep=sha256)
+        self.update(add)
+        return sha256
+
+    def total_size(self):
+        blobs = dict((e['sha256'], e['size']) for e in self._load().values())
+        return sum(blobs.values())
+
+    def evict(self):
+        """
+        Remove least recently used files until under max_size
+        """
+        self.update(self._evict)
+
+    def _evict(self, index, keep=None):
+        blobs = {}
+        for entry in index.values():
+            used, size = blobs.get(entry['sha256'], (0, entry['size']))
+            blobs[entry['sha256']] = (max(used, entry['used']), size)
+        total = sum(size for used, size in blobs.values())
+        for digest, (used, size) in sorted(blobs.items(),
+                                           key=lambda b: b[1][0]):
+            if total <= self.max_size:
+                break
+            if digest == keep:  # the file being stored
+                continue
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError:
+                pass
+            for key in [k for k, e in index.items() if e['sha256'] == digest]:
+                del index[key]
+            total -= size
+
+
+class InstallRecord(JSONStore):
+    """
+    Record of the size and digest of each file installed, keyed by the
+    source it was installed from
+    """
+    def get(self, key):
+        return self._load().get(key)
+
+    def set(self, key, size, sha256):
+        self.update(lambda data: data.__setitem__(
+            key, {'size': size, 'sha256': sha256}))
@@ -0,0 +1,212 @@
+import re
+import sys
+
+# Kodi major version assumed for custom builds (SPMC etc.) that don't follow
+# the usual version numbering
+DEFAULT_KODI = '17'
+# how the widevinecdm library is got out of each kind of WIDEVINECDM_URL
+EXTRACTIONS = (('.zip', 'zip'), ('.tar.xz', 'tar.xz'))
+
+
+def extraction(url):
+    """
+    Return how the widevinecdm library is extracted from the archive at
+    url, 'zip' or 'tar.xz', or None if it's neither
+    """
+    for suffix, name in EXTRACTIONS:
+        if url.endswith(suffix):
+            return name
+    return None
+
+
+class Capability(object):
+    """
+    Everything needed to fetch and check the DRM components for one system,
+    arch and Kodi major version, worked out once from the tables in
+    drmconfig and the manifest
+    supported -- whether the platform is in SUPPORTED_PLATFORMS, which the
+        CapabilityIndex knows
+    """
+    def __init__(self, manifest, config, system, arch, kodi, supported=True):
+        self.system = system
+        self.arch = arch
+        self.kodi = kodi
+        self.plat = '{0}-{1}'.format(system, arch)
+        self.kodi_name = config.KODI_NAME[kodi]
+        self.supported = supported
+        # Android has widevine built in, so has no module filenames
+        self.ssd_filename = None
+        self.widevinecdm_filename = None
+        if supported and system != 'Android':
+            self.ssd_filename = config.SSD_WV_DICT[system]
+            self.widevinecdm_filename = config.WIDEVINECDM_DICT[system]
+
+        latest = manifest.CURRENT_IA_VERSION[self.kodi_name]
+        self.ia_version = latest['ver']
+        self.ia_commit = latest['commit']
+        self.min_ia_version = manifest.MIN_IA_VERSION[self.kodi_name]
+        self.latest_ia = manifest.parse_version(self.ia_version)
+        self.min_ia = manifest.parse_version(self.min_ia_version)
+
+        base = '{0}{1}/{2}-'.format(manifest.REPO_BASE, self.kodi_name,
+                                    self.plat.lower())
+        self.ia_url = '{0}inputstream.adaptive-{1}-{2}.zip'.format(
+            base, self.ia_version, self.ia_commit)
+        self.ssd_url = None
+        if self.ssd_filename:
+            name, ext = self.ssd_filename.split('.')[0:2]
+            self.ssd_url = '{0}{1}-{2}.{3}'.format(base, name,
+                                                   self.ia_commit, ext)
+
+        self.cdm_url = manifest.WIDEVINECDM_URL.get(self.plat)
+        self.cdm_member = manifest.WIDEVINECDM_MEMBER.get(
+            self.plat, self.widevinecdm_filename)
+        self.cdm_key = None
+        self.cdm_mirrors = []
+        self.unarchive_command = config.UNARCHIVE_COMMAND.get(self.plat)
+        if self.cdm_url:
+            self.cdm_key = '{0}#{1}'.format(self.cdm_url, self.cdm_member)
+            self.cdm_mirrors = list(manifest.WIDEVINECDM_MIRRORS.get(
+                self.plat, []))
+
+    @property
+    def needs_modules(self):
+        """
+        True if the widevine modules have to be installed separately
+        """
+        return self.ssd_filename is not None
+
+    @property
+    def can_fetch_cdm(self):
+        return self.cdm_url is not None
+
+
+class CapabilityIndex(object):
+    """
+    Capability of every supported platform and known Kodi version, keyed by
+    (system, arch, kodi major version)
+    """
+    def __init__(self, manifest, config):
+        self.manifest = manifest
+        self.config = config
+        self.entries = {}
+        for plat in config.SUPPORTED_PLATFORMS:
+            system, arch = plat.split('-', 1)
+            for kodi in config.KODI_NAME:
+                self.entries[(system, arch, kodi)] = Capability(
+                    manifest, config, system, arch, kodi)
+
+    def lookup(self, system, arch, kodi):
+        """
+        Return the Capability for a platform and Kodi major version. Kodi
+        versions we don't know are treated as DEFAULT_KODI, and unsupported
+        platforms get an entry with supported False.
+        """
+        if kodi not in self.config.KODI_NAME:
+            kodi = DEFAULT_KODI
+        entry = self.entries.get((system, arch, kodi))
+        if entry is None:  # every supported platform is in there already
+            entry = self.entries[(system, arch, kodi)] = Capability(
+                self.manifest, self.config, system, arch, kodi, False)
+        return entry
+
+    def lookup_name(self, system, arch, name):
+        """
+        Same as lookup() with a Kodi codename, eg. 'Leia'
+        """
+        for kodi, kodi_name in self.config.KODI_NAME.items():
+            if kodi_name == name:
+                return self.lookup(system, arch, kodi)
+        raise KeyError(name)
+
+
+def validate(manifest, config):
+    """
+    Check the platform, version and URL tables agree with each other.
+    Returns a list of the problems found, empty if there are none.
+    """
+    problems = []
+    arches = set(config.ARCH_DICT.values())
+    for bits, arch in config.WINDOWS_BITNESS.items():
+        if arch not in arches:
+            problems.append('WINDOWS_BITNESS {0} is unknown arch '
+                            '{1}'.format(bits, arch))
+    platforms = set(config.SUPPORTED_PLATFORMS)
+    for plat in config.SUPPORTED_PLATFORMS:
+        system, _, arch = plat.partition('-')
+        if arch not in arches:
+            problems.append('{0} has unknown arch {1}'.format(plat, arch))
+        if system == 'Android':
+            continue
+        for table in ('SSD_WV_DICT', 'WIDEVINECDM_DICT'):
+            if system not in getattr(config, table):
+                problems.append('{0} has no {1} entry for {2}'.format(
+                    plat, table, system))
+
+    for name in config.KODI_NAME.values():
+        latest = manifest.CURRENT_IA_VERSION.get(name)
+        minimum = manifest.MIN_IA_VERSION.get(name)
+        if not latest:
+            problems.append('No CURRENT_IA_VERSION for {0}'.format(name))
+        if not minimum:
+            problems.append('No MIN_IA_VERSION for {0}'.format(name))
+        if (latest and minimum and manifest.parse_version(latest['ver']) <
+                manifest.parse_version(minimum)):
+            problems.append('CURRENT_IA_VERSION {0} for {1} is older than '
+                            'MIN_IA_VERSION {2}'.format(latest['ver'], name,
+                                                        minimum))
+    if not re.match(r'^\d{8}$', manifest.MIN_LEIA_BUILD[0]):
+        problems.append('MIN_LEIA_BUILD date {0} is not YYYYMMDD'.format(
+            manifest.MIN_LEIA_BUILD[0]))
+
+    for base in [manifest.REPO_BASE] + list(manifest.REPO_MIRRORS):
+        if not base.endswith('/'):
+            problems.append('Repo URL {0} should end with /'.format(base))
+    for plat, url in manifest.WIDEVINECDM_URL.items():
+        if plat not in platforms:
+            problems.append('WIDEVINECDM_URL for unsupported {0}'.format(
+                plat))
+        method = extraction(url)
+        if method is None:
+            problems.append('WIDEVINECDM_URL for {0} is not a .zip or '
+                            '.tar.xz'.format(plat))
+        if method == 'tar.xz':
+            command = config.UNARCHIVE_COMMAND.get(plat)
+            member = manifest.WIDEVINECDM_MEMBER.get(plat)
+            if not command:
+                problems.append('No UNARCHIVE_COMMAND for {0}'.format(plat))
+            elif member and member not in command:
+                problems.append('UNARCHIVE_COMMAND for {0} does not extract '
+                                '{1}'.format(plat, member))
+    for table in ('WIDEVINECDM_MEMBER', 'WIDEVINECDM_MIRRORS'):
+        for plat in getattr(manifest, table):
+            if plat not in manifest.WIDEVINECDM_URL:
+                problems.append('{0} for {1} has no WIDEVINECDM_URL'.format(
+                    table, plat))
+    for plat in config.UNARCHIVE_COMMAND:
+        if extraction(manifest.WIDEVINECDM_URL.get(plat, '')) != 'tar.xz':
+            problems.append('UNARCHIVE_COMMAND for {0} which has no .tar.xz '
+                            'WIDEVINECDM_URL'.format(plat))
+    for key, expected in manifest.ARTIFACT_DIGESTS.items():
+        if not isinstance(expected, dict) or not ({'size', 'sha256'} <=
+                                                  set(expected)):
+            problems.append('ARTIFACT_DIGESTS for {0} needs size and '
+                            'sha256'.format(key))
+    return problems
+
+
+def main():
+    """
+    Check the built in tables, eg. before a release:
+    python lib/drmcapability.py
+    """
+    import drmconfig
+    import drmmanifest
+    problems = validate(drmmanifest.Manifest(drmconfig), drmconfig)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
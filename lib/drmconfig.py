@@ -7,10 +7,20 @@ WIDEVINECDM_URL = {'Linux-x86_64': 'https://dl.google.com/widevine-cdm/903-linux
                    'Windows-x86': 'https://dl.google.com/widevine-cdm/903-win-ia32.zip',
                    'Darwin-x86_64': 'https://dl.google.com/widevine-cdm/903-mac-x64.zip'}
 
-UNARCHIVE_COMMAND = {'Linux-x86_64': '(cd {1} && unzip {0} {2} -d {1} && chmod 755 {1}/{2} && rm -f {0})',
-                     'Linux-arm': '(cd {1} && tar xJfO {0} usr/lib/chromium/libwidevinecdm.so >{1}/{2} && chmod 755 {1}/{2} && rm -f {0})',
-                     'Linux-aarch64': '(cd {1} && tar xJfO {0} usr/lib/chromium/libwidevinecdm.so >{1}/{2} && chmod 755 {1}/{2} && rm -f {0})',
-                     'Darwin-x86_64': '(cd {1} && unzip {0} {2} -d {1} && chmod 755 {1}/{2} && rm -f {0})'}
+# only used when the lzma module isn't available to extract in process
+UNARCHIVE_COMMAND = {'Linux-arm': '(cd {1} && tar xJfO {0} usr/lib/chromium/libwidevinecdm.so >{1}/{2} && chmod 755 {1}/{2} && rm -f {0})',
+                     'Linux-aarch64': '(cd {1} && tar xJfO {0} usr/lib/chromium/libwidevinecdm.so >{1}/{2} && chmod 755 {1}/{2} && rm -f {0})'}
+
+# other URLs serving the same archives as WIDEVINECDM_URL
+WIDEVINECDM_MIRRORS = {}
+
+# path of the widevinecdm library inside the WIDEVINECDM_URL archives
+WIDEVINECDM_MEMBER = {'Linux-x86_64': 'libwidevinecdm.so',
+                      'Linux-arm': 'usr/lib/chromium/libwidevinecdm.so',
+                      'Linux-aarch64': 'usr/lib/chromium/libwidevinecdm.so',
+                      'Windows-x86_64': 'widevinecdm.dll',
+                      'Windows-x86': 'widevinecdm.dll',
+                      'Darwin-x86_64': 'libwidevinecdm.dylib'}
 
 SSD_WV_DICT = {'Windows': 'ssd_wv.dll',
                'Linux': 'libssd_wv.so',
@@ -49,6 +59,10 @@ WINDOWS_BITNESS = {'32bit': 'x86',
 
 REPO_BASE = 'https://github.com/aussieaddons/repo-binary/raw/master/'
 
+# other hosts serving the same files as REPO_BASE
+REPO_MIRRORS = ['https://raw.githubusercontent.com/aussieaddons/repo-binary/master/',
+                'https://cdn.jsdelivr.net/gh/aussieaddons/repo-binary@master/']
+
 KODI_NAME = {'17': 'Krypton', '18': 'Leia'}
 
 MIN_IA_VERSION = {'Krypton': '2.0.7', 'Leia': '2.0.10'}
@@ -57,3 +71,94 @@ CURRENT_IA_VERSION = {'Krypton': {'ver': '2.0.19', 'commit': '9af2121'},
                       'Leia': {'ver': '2.0.10', 'commit': '0c7e975'}}
 
 MIN_LEIA_BUILD = ('20170818', 'e6b0c83')
+
+VERDICT_CACHE_FILE = 'special://profile/addon_data/script.module.drmhelper/verdict.json'
+
+IA_SETTINGS_FILE = 'special://profile/addon_data/inputstream.adaptive/settings.xml'
+
+# parallel connections used for large downloads when the server accepts ranges
+DOWNLOAD_CONNECTIONS = 4
+
+# downloaded files are kept here so reinstalls don't need to fetch them again
+ARTIFACT_CACHE_DIR = 'special://temp/drmhelper/cache/'
+
+ARTIFACT_CACHE_MAX_SIZE = 200 * 1024 * 1024
+
+# expected {'size': bytes, 'sha256': hex digest} of installed files, keyed by
+# source URL, or URL#member for files extracted from an archive. Without an
+# entry the digest recorded when the file was last installed is used.
+ARTIFACT_DIGESTS = {}
+
+INSTALL_RECORD_FILE = 'special://profile/addon_data/script.module.drmhelper/installed.json'
+
+# files fetched by the background service are downloaded here before being
+# moved into the artifact cache
+STAGING_DIR = 'special://temp/drmhelper/staging/'
+
+# seconds after login before the background service first checks components,
+# and between later checks
+SERVICE_STARTUP_DELAY = 60
+
+SERVICE_INTERVAL = 24 * 60 * 60
+
+# where inputstream.adaptive looks for the widevine modules by default
+DEFAULT_DECRYPTER_PATH = 'special://home/cdm'
+
+# most components downloaded at the same time by install_components()
+INSTALL_WORKERS = 3
+
+# lock files making sure only one process at a time installs each component,
+# and the longest we wait for another process before going ahead anyway
+LOCK_DIR = 'special://temp/drmhelper/locks/'
+
+LOCK_TIMEOUT = 15 * 60
+
+# log one line with the duration of each phase of check_inputstream() and the
+# install functions, for profiling. Off by default as it adds a line to
+# kodi.log for every play.
+LOG_TIMINGS = False
+
+# log debug lines even when Kodi's debug logging is off
+DEBUG_LOG = False
+
+# seconds before a repeated routine message is logged again
+LOG_REPEAT_INTERVAL = 60
+
+# latency and throughput seen from each mirror, used to pick the fastest
+MIRROR_STATS_FILE = 'special://profile/addon_data/script.module.drmhelper/mirrors.json'
+
+# optional URL of a JSON manifest overriding CURRENT_IA_VERSION,
+# MIN_IA_VERSION, MIN_LEIA_BUILD and the URL tables above, so new builds can
+# be picked up without a new release of this module
+MANIFEST_URL = None
+
+MANIFEST_CACHE_FILE = 'special://profile/addon_data/script.module.drmhelper/manifest.json'
+
+# seconds before the server is asked whether the manifest has changed, and
+# how long we wait for it to answer
+MANIFEST_TTL = 24 * 60 * 60
+
+MANIFEST_TIMEOUT = (5, 5)
+
+# json report of the last unattended run of drmprovision.py
+PROVISION_REPORT_FILE = 'special://profile/addon_data/script.module.drmhelper/provision.json'
+
+# offline bundle made by drmhelper.build_bundle() to install components from
+# instead of downloading them, or a folder of bundles named like BUNDLE_NAME.
+# May be on a mounted network share.
+BUNDLE_PATH = None
+
+BUNDLE_NAME = 'drmhelper-{plat}-{kodi}.zip'
+
+# bytes per second for downloads made in the background, 0 for no limit, and
+# whether they stop altogether while something is playing
+BACKGROUND_RATE = 256 * 1024
+
+BACKGROUND_PAUSE = True
+
+# append only log of download, check and install timings, summarised by
+# drmhelper.metrics_summary() or python lib/drmmetrics.py, None to turn it
+# off. It's moved to METRICS_FILE + '.1' once bigger than METRICS_MAX_SIZE.
+METRICS_FILE = 'special://profile/addon_data/script.module.drmhelper/metrics.jsonl'
+
+METRICS_MAX_SIZE = 1024 * 1024
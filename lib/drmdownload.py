@@ -0,0 +1,683 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import drmcache
+import drmtiming
+
+CHUNK_MIN = 64 * 1024
+CHUNK_MAX = 1024 * 1024
+# grow the read size while reads return faster than this (seconds)
+FAST_READ = 0.05
+PROGRESS_INTERVAL = 0.5
+# segmented downloads are only used for files at least twice this size
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+SEGMENT_RETRIES = 3
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 30)
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+POOL_SIZE = 10
+# largest read made at once by rate limited downloads, so the data arrives
+# in an even trickle rather than bursts
+LIMITED_CHUNK = 16 * 1024
+# seconds between checks whether paused downloads may carry on
+PAUSE_POLL = 1.0
+
+_session = None
+
+
+class DownloadError(Exception):
+    """
+    Raised when a download can't be completed
+    """
+    def __init__(self, message, status_code=None):
+        super(DownloadError, self).__init__(message)
+        self.status_code = status_code
+
+
+class DownloadCancelled(DownloadError):
+    """
+    Raised when the progress callback asks to stop the download
+    """
+    pass
+
+
+class RangeNotSupported(DownloadError):
+    """
+    Raised when a server answers a range request with the whole file
+    """
+    pass
+
+
+class DownloadPaused(DownloadError):
+    """
+    Raised by reads through a RateLimiter when downloads are paused, so the
+    response can be closed rather than left idle until the pause is over.
+    The session's wait() blocks until then.
+    """
+    pass
+
+
+class DownloadResult(object):
+    """
+    Summary of a completed download
+    """
+    def __init__(self, url, path, size, elapsed, resumed_from=0,
+                 sha256=None, retries=0):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.elapsed = elapsed
+        self.resumed_from = resumed_from
+        self.sha256 = sha256
+        self.retries = retries
+
+    @property
+    def transferred(self):
+        return self.size - self.resumed_from
+
+    @property
+    def throughput(self):
+        """
+        Bytes per second over the network for this transfer
+        """
+        return self.transferred / max(self.elapsed, 0.001)
+
+    def __str__(self):
+        return '{0} bytes in {1:.1f}s ({2:.1f} KB/s)'.format(
+            self.transferred, self.elapsed, self.throughput / 1024)
+
+
+def create_session():
+    """
+    Return a new requests session with keep-alive connection pooling and
+    retries with exponential backoff for connection errors and server errors
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+    session = requests.Session()
+    retry = Retry(total=RETRIES, backoff_factor=RETRY_BACKOFF,
+                  status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the session shared by all downloads, creating it on first use
+    """
+    global _session
+    if _session is None:
+        _session = create_session()
+    return _session
+
+
+def set_session(session):
+    """
+    Use a custom session for all downloads, eg. one pointing at a local test
+    server. Passing None goes back to the default session.
+    """
+    global _session
+    _session = session
+
+
+class RateLimiter(object):
+    """
+    Token bucket holding downloads to rate bytes per second, shared by all
+    the connections using it.
+    rate -- bytes per second, 0 for no limit. May be changed at any time.
+    burst -- bytes that can be read at full speed after a quiet spell,
+        a second's worth by default
+    pause -- callable returning True while downloads should stop
+        altogether, eg. while a video is playing
+    """
+    def __init__(self, rate, burst=None, pause=None):
+        self.rate = rate
+        self.burst = burst
+        self.pause = pause
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def paused(self):
+        return bool(self.pause and self.pause())
+
+    def wait(self):
+        """
+        Block while pause() says downloads should stop
+        """
+        while self.paused():
+            time.sleep(PAUSE_POLL)
+            self.updated = time.time()  # no catching up afterwards
+
+    def consume(self, n):
+        """
+        Take n bytes worth of tokens, sleeping until they've been earned
+        """
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.time()
+            burst = self.burst or self.rate
+            self.tokens = min(burst, self.tokens +
+                              (now - self.updated) * self.rate) - n
+            self.updated = now
+            # readers on other threads queue up behind the debt
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class LimitedReader(object):
+    """
+    Wraps the raw stream of a response so reads go through a RateLimiter.
+    Raises DownloadPaused instead of reading while the limiter is paused.
+    """
+    def __init__(self, raw, limiter):
+        self._raw = raw
+        self._limiter = limiter
+
+    def read(self, amt=None, *args, **kwargs):
+        if self._limiter.paused():
+            raise DownloadPaused('Downloads are paused')
+        if amt is None:
+            data = self._raw.read(amt, *args, **kwargs)
+            self._limiter.consume(len(data))
+            return data
+        pieces = []
+        remaining = amt
+        while remaining > 0:
+            if pieces and self._limiter.paused():
+                break  # hand over what we have, the next read raises
+            n = min(remaining, LIMITED_CHUNK)
+            self._limiter.consume(n)
+            piece = self._raw.read(n, *args, **kwargs)
+            if not piece:
+                break
+            pieces.append(piece)
+            remaining -= len(piece)
+        return b''.join(pieces)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class LimitedSession(object):
+    """
+    Stands in for a requests session, reading the bodies of streamed
+    responses no faster than limiter allows. Used for low priority
+    downloads that shouldn't get in the way of playback. Requests made
+    while paused wait for the pause to end.
+    """
+    def __init__(self, limiter, session=None):
+        self.limiter = limiter
+        self.session = session
+
+    def wait(self):
+        self.limiter.wait()
+
+    def head(self, url, **kwargs):
+        return (self.session or get_session()).head(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        self.wait()
+        res = (self.session or get_session()).get(url, **kwargs)
+        if kwargs.get('stream'):
+            res.raw = LimitedReader(res.raw, self.limiter)
+        return res
+
+
+def replace_file(src, dst):
+    """
+    Move src over dst
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:  # windows won't rename over an existing file
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def content_range_total(res):
+    """
+    Return the full size from a Content-Range header, or None
+    """
+    value = res.headers.get('content-range', '')
+    try:
+        return int(value.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def response_validators(res):
+    """
+    Return the ETag and Last-Modified headers of a response, which identify
+    the version of the file it holds. Weak ETags are left out as they can't
+    be used with If-Range.
+    """
+    etag = res.headers.get('etag')
+    if etag and etag.startswith('W/'):
+        etag = None
+    return {'etag': etag, 'last_modified': res.headers.get('last-modified')}
+
+
+def read_part_info(path):
+    """
+    Return what was saved about a partial download, or None
+    """
+    try:
+        with open(path) as f:
+            info = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return info if isinstance(info, dict) else None
+
+
+def write_part_info(path, key, url, res):
+    """
+    Save where a partial download came from and which version of the file
+    it is, so it's only ever continued with the same file
+    """
+    info = dict(response_validators(res), key=key, url=url)
+    with open(path, 'w') as f:
+        json.dump(info, f)
+
+
+def resume_validator(info, key, url):
+    """
+    Return (name, value) of the validator to send in If-Range to continue a
+    partial download of key from url, or None if it can't safely be
+    continued. ETags are only compared on the URL they came from, as each
+    mirror has its own, while Last-Modified dates may match across them.
+    """
+    if not info or info.get('key') != key:
+        return None
+    if info.get('url') == url and info.get('etag'):
+        return 'etag', info['etag']
+    if info.get('last_modified'):
+        return 'last_modified', info['last_modified']
+    return None
+
+
+def remove_part(part_path):
+    """
+    Remove a partial download and what was saved about it
+    """
+    for name in (part_path, part_path + '.json'):
+        if os.path.isfile(name):
+            os.remove(name)
+
+
+def network_errors():
+    import requests
+    return (requests.exceptions.RequestException,
+            requests.packages.urllib3.exceptions.HTTPError, IOError)
+
+
+def copy_stream(res, f, downloaded=0, total=None, progress=None,
+                interval=PROGRESS_INTERVAL, hasher=None):
+    """
+    Copy the body of a streamed response to an open file. The read size
+    starts at CHUNK_MIN and doubles up to CHUNK_MAX while the connection
+    keeps up. progress(downloaded, total) is called at most once per
+    interval and may return True to cancel. If hasher is given it's updated
+    with the data as it's written.
+    Returns the new downloaded count.
+    """
+    chunk_size = CHUNK_MIN
+    last_update = time.time()
+    while True:
+        started = time.time()
+        chunk = res.raw.read(chunk_size, decode_content=True)
+        if not chunk:
+            break
+        f.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+        downloaded += len(chunk)
+        now = time.time()
+        if (chunk_size < CHUNK_MAX and len(chunk) == chunk_size and
+                now - started < FAST_READ):
+            chunk_size *= 2
+        if progress and now - last_update >= interval:
+            last_update = now
+            if progress(downloaded, total):
+                raise DownloadCancelled('Download cancelled')
+    if progress and progress(downloaded, total):
+        raise DownloadCancelled('Download cancelled')
+    return downloaded
+
+
+class Segment(object):
+    """
+    Inclusive byte range of a segmented download and how much of it has
+    been written so far
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.done = 0
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+
+def probe_ranges(url, session=None):
+    """
+    Return (url, size) for a file if the server accepts byte ranges for it,
+    following any redirects, otherwise None
+    """
+    import requests
+    getter = session or get_session()
+    try:
+        res = getter.head(url, verify=False, allow_redirects=True,
+                          timeout=TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
+    length = res.headers.get('content-length')
+    if (res.status_code != 200 or not length or
+            res.headers.get('accept-ranges', '').lower() != 'bytes'):
+        return None
+    return res.url, int(length)
+
+
+def split_segments(size, connections):
+    """
+    Split size bytes into segments, twice as many as there are connections
+    so faster connections can pick up the slack of slower ones
+    """
+    seg_size = max(SEGMENT_MIN_SIZE, -(-size // (connections * 2)))
+    return [Segment(start, min(start + seg_size, size) - 1)
+            for start in range(0, size, seg_size)]
+
+
+def fetch_segment(getter, url, path, seg, cancel):
+    """
+    Fetch the remaining bytes of a segment and write them in place
+    """
+    headers = {'Range': 'bytes={0}-{1}'.format(seg.start + seg.done, seg.end)}
+    res = getter.get(url, stream=True, verify=False, headers=headers,
+                     timeout=TIMEOUT)
+    try:
+        if res.status_code != 206:
+            raise DownloadError('HTTP {0} for range request'.format(
+                res.status_code), res.status_code)
+        with open(path, 'r+b') as f:
+            f.seek(seg.start + seg.done)
+            while seg.done < seg.length and not cancel.is_set():
+                chunk = res.raw.read(CHUNK_MIN, decode_content=True)
+                if not chunk:
+                    break
+                chunk = chunk[:seg.length - seg.done]
+                f.write(chunk)
+                seg.done += len(chunk)
+    finally:
+        res.close()
+    if seg.done < seg.length and not cancel.is_set():
+        raise DownloadError('Segment {0}-{1} ended early'.format(
+            seg.start, seg.end))
+
+
+def download_segmented(url, path, size, connections, progress=None,
+                       session=None, interval=PROGRESS_INTERVAL):
+    """
+    Download url of a known size to path over several connections, each
+    fetching byte range segments into a preallocated file. A segment that
+    fails is retried from where it stopped.
+    Returns a DownloadResult, raises DownloadError on failure.
+    """
+    getter = session or get_session()
+    seg_path = path + '.seg'
+    segments = split_segments(size, connections)
+    pending = list(segments)
+    errors = []
+    retries = [0]
+    lock = threading.Lock()
+    cancel = threading.Event()
+
+    def worker():
+        while not cancel.is_set():
+            with lock:
+                if not pending:
+                    return
+                seg = pending.pop(0)
+            attempt = 0
+            while not cancel.is_set():
+                try:
+                    fetch_segment(getter, url, seg_path, seg, cancel)
+                    break
+                except DownloadPaused:
+                    pass  # carries on from seg.done once the pause is over
+                except (DownloadError,) + network_errors() as e:
+                    if attempt == SEGMENT_RETRIES or cancel.is_set():
+                        errors.append(e)
+                        cancel.set()
+                        return
+                    attempt += 1
+                    with lock:
+                        retries[0] += 1
+                except Exception as e:  # a bug, retrying won't help
+                    errors.append(e)
+                    cancel.set()
+                    return
+
+    started = time.time()
+    with open(seg_path, 'wb') as f:
+        f.truncate(size)
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(connections, len(segments)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    cancelled = False
+    while True:
+        alive = [t for t in threads if t.is_alive()]
+        if not alive:
+            break
+        alive[0].join(interval)
+        if progress and not cancelled:
+            if progress(sum(seg.done for seg in segments), size):
+                cancelled = True
+                cancel.set()
+    for t in threads:
+        t.join()
+
+    if cancelled or errors:
+        os.remove(seg_path)
+        if cancelled:
+            raise DownloadCancelled('Download cancelled')
+        if isinstance(errors[0], DownloadError):
+            raise errors[0]
+        raise DownloadError(str(errors[0]))
+    if not all(seg.done == seg.length for seg in segments):
+        os.remove(seg_path)
+        raise DownloadError('Segmented download of {0} is incomplete'.format(
+            url))
+    if progress and progress(size, size):
+        os.remove(seg_path)
+        raise DownloadCancelled('Download cancelled')
+    # segments arrive out of order, so hash the finished file instead
+    sha256 = drmcache.hash_file(seg_path)
+    replace_file(seg_path, path)
+    return DownloadResult(url, path, size, time.time() - started,
+                          sha256=sha256, retries=retries[0])
+
+
+def download(url, path, progress=None, resume=True, session=None,
+             interval=PROGRESS_INTERVAL, connections=1, key=None):
+    """
+    Download url to path. Data is written to path + '.part' first and moved
+    into place once complete. If resume is set, an existing partial file is
+    continued with an HTTP Range request, as long as it was of the same key
+    and the server says the file hasn't changed since. With more than one
+    connection, large files from servers that accept ranges are fetched in
+    segments.
+    key -- identifies the file, so a partial download can be continued from
+        a mirror, defaults to url
+    Returns a DownloadResult, raises DownloadError on failure.
+    """
+    import requests
+    getter = session or get_session()
+    key = key or url
+    part_path = path + '.part'
+    info_path = part_path + '.json'
+    offset = 0
+    validator = None
+    if resume and os.path.isfile(part_path):
+        validator = resume_validator(read_part_info(info_path), key, url)
+        if validator:
+            offset = os.path.getsize(part_path)
+        else:  # from another file or version, or we can't tell
+            remove_part(part_path)
+
+    if connections > 1 and not offset:
+        probe = probe_ranges(url, session)
+        if probe and probe[1] >= SEGMENT_MIN_SIZE * 2:
+            try:
+                return download_segmented(probe[0], path, probe[1],
+                                          connections, progress, session,
+                                          interval)
+            except DownloadCancelled:
+                raise
+            except DownloadError:
+                pass  # fall back to a single stream
+
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes={0}-'.format(offset)
+        # the whole file is sent instead if it has changed
+        headers['If-Range'] = validator[1]
+    started = time.time()
+    try:
+        res = getter.get(url, stream=True, verify=False, headers=headers,
+                         timeout=TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise DownloadError(str(e))
+
+    try:
+        if res.status_code == 416 and offset:
+            if content_range_total(res) == offset:  # already complete
+                sha256 = drmcache.hash_file(part_path)
+                replace_file(part_path, path)
+                remove_part(part_path)
+                return DownloadResult(url, path, offset,
+                                      time.time() - started, offset, sha256)
+            res.close()
+            remove_part(part_path)
+            return download(url, path, progress, False, session, interval,
+                            connections, key)
+
+        if res.status_code >= 400:
+            raise DownloadError('HTTP {0} error'.format(res.status_code),
+                                res.status_code)
+        if (res.status_code == 206 and offset and
+                response_validators(res)[validator[0]] != validator[1]):
+            # changed, and the server didn't act on If-Range
+            res.close()
+            remove_part(part_path)
+            return download(url, path, progress, False, session, interval,
+                            connections, key)
+        if res.status_code != 206:  # changed or the server ignored the range
+            offset = 0
+        if not offset:
+            write_part_info(info_path, key, url, res)
+
+        length = res.headers.get('content-length')
+        total = offset + int(length) if length else None
+        hasher = hashlib.sha256()
+        if offset:
+            drmcache.hash_file(part_path, hasher, offset)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            try:
+                downloaded = copy_stream(res, f, offset, total, progress,
+                                         interval, hasher)
+            except DownloadPaused:
+                downloaded = None
+            except network_errors() as e:
+                raise DownloadError(str(e))
+    finally:
+        res.close()
+
+    if downloaded is None:
+        # with the connection closed, resume what's in part_path once the
+        # pause is over
+        getter.wait()
+        return download(url, path, progress, True, session, interval,
+                        connections, key)
+
+    if total is not None and downloaded < total:
+        raise DownloadError('Connection closed after {0} of {1} bytes'.format(
+            downloaded, total))
+    replace_file(part_path, path)
+    remove_part(part_path)
+    return DownloadResult(url, path, downloaded, time.time() - started,
+                          offset, hasher.hexdigest())
+
+
+def run_parallel(tasks, workers, progress=None, interval=PROGRESS_INTERVAL):
+    """
+    Run tasks on at most workers threads. Each task is called with a
+    progress(done, total) callback of its own, and the progress of all
+    tasks is summed into progress(done, total), which may return True to
+    cancel them all. The total is None until every task has reported one.
+    Spans timed by the tasks are added to the caller's trace.
+    Returns a list of each task's result, or the exception it raised.
+    """
+    trace = drmtiming.current()
+    states = [[0, None] for _ in tasks]
+    results = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+    lock = threading.Lock()
+    cancel = threading.Event()
+
+    def task_progress(i):
+        def update(done, total):
+            states[i] = [done, total]
+            return cancel.is_set()
+        return update
+
+    def worker():
+        drmtiming.attach(trace)
+        while not cancel.is_set():
+            with lock:
+                if not pending:
+                    return
+                i = pending.pop(0)
+            try:
+                results[i] = tasks[i](task_progress(i))
+                if states[i][1] is not None:
+                    states[i][0] = states[i][1]
+            except Exception as e:
+                results[i] = e
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(tasks)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    while True:
+        alive = [t for t in threads if t.is_alive()]
+        if not alive:
+            break
+        alive[0].join(interval)
+        if progress and not cancel.is_set():
+            done = sum(s[0] for s in states)
+            totals = [s[1] for s in states]
+            total = None if None in totals else sum(totals)
+            if progress(done, total):
+                cancel.set()
+    for t in threads:
+        t.join()
+    if cancel.is_set():
+        raise DownloadCancelled('Download cancelled')
+    return results
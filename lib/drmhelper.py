@@ -1,3 +1,4 @@
+import contextlib
 import os
 import re
 import posixpath
@@ -5,61 +6,256 @@ import xbmc
 import xbmcgui
 import xbmcaddon
 import drmconfig
+import drmtiming
 import platform
-import requests
-import json
-import zipfile
-import shutil
-from pipes import quote
-from distutils.version import LooseVersion
-
-system_ = platform.system()
-
-# dummy request first for this infolabel, sometimes returns 'Busy'
-xbmc.getInfoLabel('System.OSVersionInfo')
-xbmc.sleep(100)
-
-if xbmc.getCondVisibility('system.platform.android'):
-    system_ = 'Android'
-
-if 'Xbox One' in get_os_version_info():
-    system_ = 'XboxOne'
-
-try:
-    machine = platform.machine()
-    if machine[:3] == 'arm':
-        machine = machine[:5]
-    arch = drmconfig.ARCH_DICT.get(machine, 'NS')
-except:
-    arch = 'NS'
-
-if system_ == 'Windows':
-    try:
-        arch = drmconfig.WINDOWS_BITNESS[platform.architecture()[0]]
-    except:
-        arch = 'NS'
+import struct
+
+_platform = None
+_addon_version = None
+_debug_enabled = None
+_last_logged = {}
+_os_version_info = None
+_verdict_cache = None
+_artifact_cache = None
+_install_record = None
+_mirror_stats = None
+_manifest = None
+_bundle = None
+_background_session = None
+_capabilities = None
+_capability = None
+_metrics = None
+_manifest_refresh = None
+
+
+def get_addon_version():
+    """
+    Return our own version, looked up once per run
+    """
+    global _addon_version
+    if _addon_version is None:
+        _addon_version = xbmcaddon.Addon(
+            'script.module.drmhelper').getAddonInfo('version')
+    return _addon_version
 
-plat = '{0}-{1}'.format(system_, arch)
 
-if plat in drmconfig.SUPPORTED_PLATFORMS:
-    supported = True
-    if system_ != 'Android':
-        ssd_filename = drmconfig.SSD_WV_DICT[system_]
-        widevinecdm_filename = drmconfig.WIDEVINECDM_DICT[system_]
-else:
-    supported = False
+def is_debug_enabled():
+    """
+    Check if debug lines should be logged, either because Kodi's debug
+    logging is on or DEBUG_LOG is set
+    """
+    global _debug_enabled
+    if _debug_enabled is None:
+        _debug_enabled = drmconfig.DEBUG_LOG or xbmc.getCondVisibility(
+            'System.GetBool(debug.showloginfo)')
+    return _debug_enabled
 
 
-def log(message):
+def log(message, *args, **kwargs):
     """
-    Log message to kodi.log
+    Log message to kodi.log. Any args are put into message with
+    str.format(), which only happens if the line is actually logged.
+    level -- Kodi log level, LOGNOTICE by default. LOGDEBUG lines are
+        dropped without formatting unless debug logging is enabled.
     """
-    ver = xbmcaddon.Addon('script.module.drmhelper').getAddonInfo('version')
-    xbmc.log('[DRMHELPER {0}] - {1}'.format(ver, message), xbmc.LOGNOTICE)
+    level = kwargs.get('level', xbmc.LOGNOTICE)
+    if level == xbmc.LOGDEBUG and not is_debug_enabled():
+        return
+    if args:
+        message = message.format(*args)
+    xbmc.log('[DRMHELPER {0}] - {1}'.format(get_addon_version(), message),
+             level)
+
+
+def log_debug(message, *args):
+    log(message, *args, level=xbmc.LOGDEBUG)
+
+
+def log_limited(key, message, *args, **kwargs):
+    """
+    Log message at most once per LOG_REPEAT_INTERVAL seconds for each key,
+    noting how many were skipped in between
+    """
+    import time
+    now = time.time()
+    last, skipped = _last_logged.get(key, (0, 0))
+    if now - last < drmconfig.LOG_REPEAT_INTERVAL:
+        _last_logged[key] = (last, skipped + 1)
+        return
+    _last_logged[key] = (now, 0)
+    if skipped:
+        message = '{0} ({1} similar messages not logged)'.format(message,
+                                                               skipped)
+    log(message, *args, **kwargs)
+
+
+drmtiming.set_logger(log if drmconfig.LOG_TIMINGS else None)
+
+
+def add_timing_hook(callback):
+    """
+    Register callback(summary) to be given the phase timings of every
+    check_inputstream() and install call. summary is a dict with the call
+    name, its result, total duration in seconds and a list of phases, each
+    with a name, duration and details like bytes downloaded.
+    """
+    drmtiming.add_hook(callback)
+
+
+def remove_timing_hook(callback):
+    drmtiming.remove_hook(callback)
+
+
+def get_metrics():
+    """
+    Return the shared metrics log, or None if METRICS_FILE is turned off
+    """
+    global _metrics
+    import drmmetrics
+    if _metrics is None:
+        if not drmconfig.METRICS_FILE:
+            return None
+        _metrics = drmmetrics.MetricsLog(
+            xbmc.translatePath(drmconfig.METRICS_FILE),
+            drmconfig.METRICS_MAX_SIZE, plat=get_platform().plat,
+            kodi=xbmc.getInfoLabel('System.BuildVersion').split(' ')[0],
+            version=get_addon_version())
+    return _metrics
+
+
+def record_download(url, started, transferred=0, retries=0, error=None,
+                    background=False):
+    """
+    Add a download to the metrics log. url is the mirror it came from and
+    retries the segments and mirrors that had to be tried again.
+    """
+    import time
+    import drmmirror
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    duration = time.time() - started
+    metrics.record('download', url=url, source=drmmirror.host(url),
+                   bytes=transferred, duration=round(duration, 3),
+                   throughput=round(transferred / max(duration, 0.001)),
+                   retries=retries, background=background,
+                   error=None if error is None else str(error))
+
+
+def record_timings(summary):
+    """
+    Timing hook adding check_inputstream() calls and installs to the
+    metrics log
+    """
+    import drmmetrics
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    if summary['call'] == 'check_inputstream':
+        metrics.record('check', outcome=drmmetrics.check_outcome(summary),
+                       latency=summary['total'])
+    elif summary['call'] in drmmetrics.INSTALL_CALLS:
+        # installers return a false value when they fail rather than raise
+        metrics.record('install', call=summary['call'],
+                       duration=summary['total'],
+                       error=summary.get('error') or (
+                           None if summary.get('result') else 'failed'))
+    for phase in summary['phases']:  # installs made during a check
+        if phase['name'] in drmmetrics.INSTALL_CALLS:
+            metrics.record('install', call=phase['name'],
+                           duration=phase['duration'],
+                           error=phase.get('error') or (
+                               None if phase.get('result') else 'failed'))
+
+
+def metrics_summary():
+    """
+    Return percentiles of the download, check and install times recorded
+    in the metrics log, by platform. See drmmetrics.summarise().
+    """
+    import drmmetrics
+    metrics = get_metrics()
+    if metrics is None:
+        return {}
+    return drmmetrics.summarise(metrics.read())
+
+
+if drmconfig.METRICS_FILE:
+    drmtiming.add_hook(record_timings)
 
 
 def get_os_version_info():
-    return xbmc.getInfoLabel('System.OSVersionInfo')
+    """
+    Return OS version info infolabel. Kodi may answer 'Busy' while it
+    fetches the value, so retry with a short backoff until it's ready.
+    """
+    global _os_version_info
+    if _os_version_info is None:
+        delay = 10
+        info = xbmc.getInfoLabel('System.OSVersionInfo')
+        while info == 'Busy' and delay <= 160:
+            xbmc.sleep(delay)
+            delay *= 2
+            info = xbmc.getInfoLabel('System.OSVersionInfo')
+        if info == 'Busy':
+            return ''
+        _os_version_info = info
+    return _os_version_info
+
+
+class PlatformInfo(object):
+    """
+    Description of the OS/arch we're running on. Whether it's supported
+    and the module filenames that apply to it come from its Capability.
+    """
+    def __init__(self):
+        self.system = platform.system()
+        # bitness of this process, which may be 32 bit on a 64 bit OS
+        self.bits = struct.calcsize('P') * 8
+        if xbmc.getCondVisibility('system.platform.android'):
+            self.system = 'Android'
+
+        if 'Xbox One' in get_os_version_info():
+            self.system = 'XboxOne'
+
+        try:
+            machine = platform.machine()
+            if machine[:3] == 'arm':
+                machine = machine[:5]
+            self.arch = drmconfig.ARCH_DICT.get(machine, 'NS')
+        except:
+            self.arch = 'NS'
+
+        if self.system == 'Windows':
+            try:
+                self.arch = drmconfig.WINDOWS_BITNESS[
+                    '{0}bit'.format(self.bits)]
+            except:
+                self.arch = 'NS'
+
+        self.plat = '{0}-{1}'.format(self.system, self.arch)
+
+    @property
+    def supported(self):
+        return get_capability().supported
+
+    @property
+    def ssd_filename(self):
+        return get_capability().ssd_filename
+
+    @property
+    def widevinecdm_filename(self):
+        return get_capability().widevinecdm_filename
+
+
+def get_platform():
+    """
+    Return platform info, probing the system on first use only
+    """
+    global _platform
+    if _platform is None:
+        _platform = PlatformInfo()
+    return _platform
 
 
 def is_libreelec():
@@ -99,13 +295,162 @@ def get_kodi_build():
         return m
 
 
+def get_manifest():
+    """
+    Return the version and URL tables in effect, loaded once per run. This
+    never waits on the network, as it's on the way to playback: a stale
+    copy of the remote manifest is used as it is and refreshed in the
+    background for later runs. The service keeps it up to date with
+    update_manifest().
+    """
+    global _manifest
+    if _manifest is None:
+        _manifest = load_manifest(fetch=False)
+    return _manifest
+
+
+def load_manifest(force=False, fetch=True):
+    """
+    Build the version and URL tables from drmconfig and the remote manifest
+    at MANIFEST_URL, if there is one. The manifest is only fetched again
+    once the cached copy is older than MANIFEST_TTL, and then only if the
+    server says it has changed. Without a usable manifest the built in
+    tables are used.
+    force -- ask the server even if the cached copy is still fresh
+    fetch -- False to use the cached copy however old it is, refreshing it
+        in a background thread if it's stale
+    """
+    import drmcapability
+    import drmmanifest
+    url = drmconfig.MANIFEST_URL
+    if not url:
+        return drmmanifest.Manifest(drmconfig)
+    cache = drmmanifest.ManifestCache(
+        xbmc.translatePath(drmconfig.MANIFEST_CACHE_FILE))
+    entry = cache.lookup(url)
+    if force or not cache.is_fresh(entry, drmconfig.MANIFEST_TTL):
+        if fetch:
+            entry = refresh_manifest(cache, url, entry)
+        else:
+            refresh_manifest_later(cache, url, entry)
+    data = entry and entry.get('data')
+    try:
+        manifest = drmmanifest.Manifest(drmconfig, data)
+        problems = drmcapability.validate(manifest, drmconfig)
+        if problems:
+            raise drmmanifest.ManifestError('; '.join(problems))
+        return manifest
+    except (drmmanifest.ManifestError, KeyError, TypeError,
+            ValueError) as e:
+        log('Ignoring version manifest from {0}: {1}', url, e,
+            level=xbmc.LOGERROR)
+        return drmmanifest.Manifest(drmconfig)
+
+
+def refresh_manifest(cache, url, entry):
+    """
+    Ask the server for changes to the manifest at url, returning the
+    updated cache entry, or entry if that fails
+    """
+    import drmdownload
+    import drmmanifest
+    try:
+        with drmtiming.span('manifest', url=url):
+            return cache.refresh(url, drmconfig.MANIFEST_TIMEOUT)
+    except (drmdownload.DownloadError, drmmanifest.ManifestError) as e:
+        log('Could not update version manifest from {0}, using {1}: {2}',
+            url, 'cached copy' if entry and 'data' in entry else
+            'built in tables', e, level=xbmc.LOGWARNING)
+        cache.mark_checked(url)
+        return entry
+
+
+def refresh_manifest_later(cache, url, entry):
+    """
+    Refresh the cached manifest in a background thread, unless one is
+    already running. The result is used from the next run on.
+    """
+    global _manifest_refresh
+    import threading
+    if _manifest_refresh is not None and _manifest_refresh.is_alive():
+        return
+    _manifest_refresh = threading.Thread(target=refresh_manifest,
+                                         args=(cache, url, entry))
+    _manifest_refresh.daemon = True
+    _manifest_refresh.start()
+
+
+def update_manifest():
+    """
+    Check the remote manifest for changes now and use the result for the
+    rest of this run
+    """
+    global _manifest
+    _manifest = load_manifest(force=True)
+    return _manifest
+
+
+def get_capability(kodi=None):
+    """
+    Return the Capability for this platform and Kodi version, with the
+    filenames, URLs and versions of everything it needs. Worked out once
+    per run from the tables in effect.
+    kodi -- codename of another Kodi version to look up instead
+    """
+    global _capabilities, _capability
+    import drmcapability
+    manifest = get_manifest()
+    if _capabilities is None or _capabilities.manifest is not manifest:
+        _capabilities = drmcapability.CapabilityIndex(manifest, drmconfig)
+        _capability = None
+    p = get_platform()
+    if kodi:
+        return _capabilities.lookup_name(p.system, p.arch, kodi)
+    if _capability is None:
+        # custom builds (SPMC etc.) might have something else here, they're
+        # treated as Krypton
+        _capability = _capabilities.lookup(p.system, p.arch,
+                                           get_kodi_version()[:2])
+    return _capability
+
+
 def get_latest_ia_ver():
     """
     Return dict containing info for latest compiled inputstream.adaptive
     addon in the binary repo
     """
-    kodi = get_kodi_name()
-    return drmconfig.CURRENT_IA_VERSION[kodi]
+    cap = get_capability()
+    return {'ver': cap.ia_version, 'commit': cap.ia_commit}
+
+
+def get_target_kodi():
+    """
+    Return Kodi codename to fetch components for
+    """
+    return get_capability().kodi_name
+
+
+def get_ssd_wv_url(kodi=None):
+    """
+    Return URL of the compiled ssd_wv module for this platform
+    """
+    return get_capability(kodi).ssd_url
+
+
+def get_ia_url(kodi=None):
+    """
+    Return URL of the compiled inputstream.adaptive zip for this platform
+    """
+    return get_capability(kodi).ia_url
+
+
+def get_cdm_source():
+    """
+    Return (url, archive member, cache key) of the widevinecdm library for
+    this platform. The url and key are None if there's nowhere to get it.
+    """
+    cap = get_capability()
+    return cap.cdm_url, cap.cdm_member, cap.cdm_key
 
 
 def is_ia_current(addon, latest=False):
@@ -113,23 +458,48 @@ def is_ia_current(addon, latest=False):
     Check if inputstream.adaptive addon meets the minimum version requirements.
     latest -- checks if addon is equal to the latest available compiled version
     """
+    import drmrpc
     if not addon:
         return False
-    ia_ver = addon.getAddonInfo('version')
-    if latest:
-        ver = get_latest_ia_ver()['ver']
+    try:
+        details = drmrpc.get_addon_details('inputstream.adaptive')
+    except drmrpc.JSONRPCError:
+        details = None
+    if details and details.get('version'):
+        ia_ver = details['version']
     else:
-        ver = drmconfig.MIN_IA_VERSION[get_kodi_name()]
-    return LooseVersion(ia_ver) >= LooseVersion(ver)
+        ia_ver = addon.getAddonInfo('version')
+    return is_ia_version_current(ia_ver, latest)
 
 
+def is_ia_version_current(ia_ver, latest=False):
+    """
+    Check if an inputstream.adaptive version string meets the minimum
+    version requirements.
+    latest -- checks if version is equal to the latest available compiled
+        version
+    """
+    cap = get_capability()
+    return (get_manifest().parse_version(ia_ver) >=
+            (cap.latest_ia if latest else cap.min_ia))
+
+
+@drmtiming.traced('get_addon')
 def get_addon(drm=True):
     """
     Check if inputstream.adaptive is installed, attempt to install if not.
     Enable inpustream.adaptive addon.
     """
+    import drmrpc
+
     def manual_install(update=False):
-        if get_ia_direct(update, drm):
+        if get_components(drm=False):
+            # we install it ourselves, so fetch it and the widevine modules
+            # all at once behind one dialog
+            installed = install_components(drm, addon=True)
+        else:
+            installed = get_ia_direct(update, drm)
+        if installed:
             try:
                 addon = xbmcaddon.Addon('inputstream.adaptive')
                 return addon
@@ -138,19 +508,16 @@ def get_addon(drm=True):
 
     addon = None
     try:
-        enabled_json = ('{"jsonrpc":"2.0","id":1,"method":'
-                        '"Addons.GetAddonDetails","params":'
-                        '{"addonid":"inputstream.adaptive", '
-                        '"properties": ["enabled"]}}')
         # is inputstream.adaptive enabled?
-        result = json.loads(xbmc.executeJSONRPC(enabled_json))
-    except RuntimeError:
+        details = drmrpc.get_addon_details('inputstream.adaptive')
+    except drmrpc.JSONRPCError:
         return False
 
-    if 'error' in result:  # not installed
+    if details is None:  # not installed
         log('inputstream.adaptive not currently installed')
         try:  # see if there's an installed repo that has it
             xbmc.executebuiltin('InstallAddon(inputstream.adaptive)', True)
+            drmrpc.clear()
             addon = xbmcaddon.Addon('inputstream.adaptive')
             log('inputstream.adaptive installed from repo')
         except RuntimeError:
@@ -166,15 +533,11 @@ def get_addon(drm=True):
                 return False
 
     else:  # installed but not enabled. let's enable it.
-        if result['result']['addon'].get('enabled') is False:
+        if details.get('enabled') is False:
             log('inputstream.adaptive not enabled, enabling...')
-            json_string = ('{"jsonrpc":"2.0","id":1,"method":'
-                           '"Addons.SetAddonEnabled","params":'
-                           '{"addonid":"inputstream.adaptive",'
-                           '"enabled":true}}')
             try:
-                xbmc.executeJSONRPC(json_string)
-            except RuntimeError:
+                drmrpc.set_addon_enabled('inputstream.adaptive')
+            except drmrpc.JSONRPCError:
                 log('Failure in enabling inputstream.adaptive')
                 return False
         addon = xbmcaddon.Addon('inputstream.adaptive')
@@ -195,19 +558,88 @@ def get_addon(drm=True):
 
 def is_supported():
     """
-    Reads the value of 'supported' global variable and displays a helpful
-    message to the user if on an unsupported platform.
+    Checks if the platform is supported and displays a helpful message to the
+    user if on an unsupported platform.
     """
-    if not supported:
+    p = get_platform()
+    if not p.supported:
         xbmcgui.Dialog().ok('OS/Arch not supported',
                             '{0} {1} not supported for DRM playblack'.format(
-                                system_, arch))
-        log('{0} {1} not supported for DRM playback'.format(
-            system_, arch))
+                                p.system, p.arch))
+        log('{0} {1} not supported for DRM playback', p.system, p.arch)
         return False
     return True
 
 
+def get_verdict_cache():
+    """
+    Return the shared check_inputstream() verdict cache
+    """
+    global _verdict_cache
+    import drmcache
+    if _verdict_cache is None:
+        _verdict_cache = drmcache.VerdictCache(
+            xbmc.translatePath(drmconfig.VERDICT_CACHE_FILE))
+    return _verdict_cache
+
+
+def get_verdict_key(drm, cdm_path=None):
+    """
+    Build the key for a cached verdict from everything the full check depends
+    on. Returns None if inputstream.adaptive isn't installed and enabled.
+    """
+    import drmcache
+    ia_ver = xbmc.getInfoLabel('System.AddonVersion(inputstream.adaptive)')
+    if not ia_ver:
+        return None
+    # the version is still there while the add-on is disabled, HasAddon is
+    # only true for enabled ones
+    if not xbmc.getCondVisibility('System.HasAddon(inputstream.adaptive)'):
+        return None
+    p = get_platform()
+    manifest = get_manifest()
+    parts = [xbmc.getInfoLabel('System.BuildVersion'), ia_ver, p.plat, drm,
+             cdm_path, manifest.MIN_IA_VERSION, manifest.MIN_LEIA_BUILD,
+             drmcache.stat_key(xbmc.translatePath(
+                 drmconfig.IA_SETTINGS_FILE))]
+    if cdm_path:
+        parts.append(drmcache.stat_key(
+            os.path.join(cdm_path, p.widevinecdm_filename)))
+        parts.append(drmcache.stat_key(
+            os.path.join(cdm_path, p.ssd_filename)))
+    return drmcache.make_key(parts)
+
+
+def store_verdict(drm, cdm_path=None):
+    """
+    Remember a positive check_inputstream() result
+    """
+    key = get_verdict_key(drm, cdm_path)
+    if key:
+        get_verdict_cache().store('drm' if drm else 'nodrm', key,
+                                  cdm_path=cdm_path)
+    return True
+
+
+def is_verdict_cached(drm=True):
+    """
+    Check if a previous positive check_inputstream() result is still valid
+    """
+    entry = get_verdict_cache().lookup('drm' if drm else 'nodrm')
+    if not entry:
+        return False
+    key = get_verdict_key(drm, entry.get('cdm_path'))
+    return key is not None and key == entry.get('key')
+
+
+def clear_verdict_cache():
+    """
+    Forget all cached check_inputstream() results
+    """
+    get_verdict_cache().invalidate()
+
+
+@drmtiming.traced('check_inputstream')
 def check_inputstream(drm=True):
     """
     Main function call to check all components required are available for
@@ -215,30 +647,41 @@ def check_inputstream(drm=True):
     drm -- set to false if you just want to check for inputstream.adaptive
         and not widevine components eg. HLS playback
     """
-    try:
-        ver = get_kodi_version()
-        log('Kodi version: {0}'.format(ver))
-        if float(ver) < 17.0:
-            xbmcgui.Dialog().ok('Kodi 17+ Required',
-                                ('The minimum version of Kodi required for '
-                                 'DASH/DRM protected content is 17.0 - please '
-                                 'upgrade in order to use this feature.'))
-            return False
-    except ValueError:  # custom builds of Kodi may not follow same convention
-        pass
-
-    date = get_kodi_build()
-    if not date:  # can't find build date, assume meets minimum
-        log('Could not determine date of build, assuming date meets minimum. '
-            'Build string is {0}'
-            ''.format(xbmc.getInfoLabel("System.BuildVersion")))
-        date = drmconfig.MIN_LEIA_BUILD[0]
-
-    log('Build date: {0}'.format(date))
-    log('System: {0}'.format(system_))
-    log('Arch: {0}'.format(arch))
+    import drmbinary
+    with drmtiming.span('verdict'):
+        cached = is_verdict_cached(drm)
+    if cached:
+        log_limited('verdict', 'Components unchanged since last check '
+                    '(drm={0})', drm)
+        return True
 
-    min_date, min_commit = drmconfig.MIN_LEIA_BUILD
+    with drmtiming.span('version'):
+        try:
+            ver = get_kodi_version()
+            log_debug('Kodi version: {0}', ver)
+            if float(ver) < 17.0:
+                xbmcgui.Dialog().ok('Kodi 17+ Required',
+                                    ('The minimum version of Kodi required '
+                                     'for DASH/DRM protected content is 17.0 '
+                                     '- please upgrade in order to use this '
+                                     'feature.'))
+                return False
+        except ValueError:  # custom builds of Kodi may not follow convention
+            pass
+
+        date = get_kodi_build()
+        if not date:  # can't find build date, assume meets minimum
+            log('Could not determine date of build, assuming date meets '
+                'minimum. Build string is {0}',
+                xbmc.getInfoLabel("System.BuildVersion"))
+            date = get_manifest().MIN_LEIA_BUILD[0]
+
+    log_debug('Build date: {0}', date)
+    p = get_platform()
+    log_debug('System: {0}', p.system)
+    log_debug('Arch: {0}', p.arch)
+
+    min_date, min_commit = get_manifest().MIN_LEIA_BUILD
     if int(date) < int(min_date) and float(get_kodi_version()) >= 18.0:
         xbmcgui.Dialog().ok('Kodi 18 build is outdated',
                             ('The minimum Kodi 18 build required for DASH/DRM '
@@ -249,10 +692,12 @@ def check_inputstream(drm=True):
                                 min_date, min_commit, date)))
         return False
 
-    if not is_supported() and drm:
+    with drmtiming.span('is_supported'):
+        supported = is_supported()
+    if not supported and drm:
         return False
 
-    addon = get_addon()
+    addon = get_addon(drm)
     if not addon:
         xbmcgui.Dialog().ok('Missing inputstream.adaptive add-on',
                             ('inputstream.adaptive VideoPlayer InputStream '
@@ -262,7 +707,7 @@ def check_inputstream(drm=True):
 
     # widevine built into android - not supported on 17 atm though
     if xbmc.getCondVisibility('system.platform.android'):
-        log('Running on Android')
+        log_debug('Running on Android')
         if get_kodi_version()[:2] == '17' and drm:
             xbmcgui.Dialog().ok('Kodi 17 on Android not supported',
                                 ('Kodi 17 is not currently supported for '
@@ -272,21 +717,23 @@ def check_inputstream(drm=True):
                                  'd/arm/master/'))
             log('Kodi 17 Android DRM - not supported')
             return False
-        return True
+        return store_verdict(drm)
 
     # ??? not sure if ios has widevine support, assuming so for now ???
     if xbmc.getCondVisibility('system.platform.ios'):
-        log('Running on iOS')
-        return True
+        log_debug('Running on iOS')
+        return store_verdict(drm)
 
     # only checking for installation of inputstream.adaptive (eg HLS playback)
     if not drm:
-        log('DRM checking not requested')
-        return True
+        log_debug('DRM checking not requested')
+        return store_verdict(drm)
 
     # only 32bit userspace supported for linux aarch64 - no 64bit widevinecdm
-    if plat == 'Linux-aarch64':
-        if platform.architecture()[0] == '64bit':
+    userspace_64 = False
+    if p.plat == 'Linux-aarch64':
+        if p.bits == 64:
+            userspace_64 = True
             log('Running on Linux aarch64 64bit userspace - not supported')
             xbmcgui.Dialog().ok('64 bit build for aarch64 not supported',
                                 ('A build of your OS that supports 32 bit '
@@ -298,24 +745,65 @@ def check_inputstream(drm=True):
 
     cdm_path = xbmc.translatePath(addon.getSetting('DECRYPTERPATH'))
 
-    if not os.path.isfile(os.path.join(cdm_path, widevinecdm_filename)):
+    cdm_fn = os.path.join(cdm_path, p.widevinecdm_filename)
+    with drmtiming.span('cdm_check'):
+        cdm_error = check_binary(cdm_fn)
+        if cdm_error and install_from_cache(get_cdm_source()[2], cdm_fn):
+            cdm_error = check_binary(cdm_fn)
+    if cdm_error and os.path.isfile(cdm_fn):
+        log('Widevine CDM unusable: {0}', cdm_error)
+        if userspace_64 and isinstance(cdm_error,
+                                       drmbinary.IncompatibleBinary):
+            return False  # no download would help, see the dialog above
+        msg1 = 'Unusable widevinecdm module required for DRM content'
+        msg2 = '{0} in {1}: {2}'.format(
+            p.widevinecdm_filename,
+            xbmc.translatePath(addon.getSetting('DECRYPTERPATH')),
+            cdm_error)
+        msg3 = ('Do you want to attempt downloading the widevinecdm module '
+                'for your system again?')
+        if xbmcgui.Dialog().yesno(msg1, msg2, msg3):
+            install_components(drm, addon=False)
+        else:
+            return False
+    elif cdm_error:
         log('Widevine CDM missing')
         msg1 = 'Missing widevinecdm module required for DRM content'
         msg2 = '{0} not found in {1}'.format(
-            drmconfig.WIDEVINECDM_DICT[system_],
+            p.widevinecdm_filename,
             xbmc.translatePath(addon.getSetting('DECRYPTERPATH')))
         msg3 = ('Do you want to attempt downloading the missing widevinecdm '
                 'module for your system?')
         if xbmcgui.Dialog().yesno(msg1, msg2, msg3):
-            get_widevinecdm(cdm_path)
+            # also fetches a missing ssd_wv at the same time
+            install_components(drm, addon=False)
         else:
             return False
 
-    if not os.path.isfile(os.path.join(cdm_path, ssd_filename)):
+    ssd_fn = os.path.join(cdm_path, p.ssd_filename)
+    with drmtiming.span('ssd_check'):
+        ssd_error = check_binary(ssd_fn)
+        if ssd_error and install_from_cache(get_ssd_wv_url(),
+                                            os.path.realpath(ssd_fn)):
+            ssd_error = check_binary(ssd_fn)
+    if ssd_error and os.path.isfile(ssd_fn):
+        log('SSD module unusable: {0}', ssd_error)
+        msg1 = 'Unusable ssd_wv module required for DRM content'
+        msg2 = '{0} in {1}: {2}'.format(
+            p.ssd_filename,
+            xbmc.translatePath(addon.getSetting('DECRYPTERPATH')),
+            ssd_error)
+        msg3 = ('Do you want to attempt downloading the ssd_wv module for '
+                'your system again?')
+        if xbmcgui.Dialog().yesno(msg1, msg2, msg3):
+            get_ssd_wv(cdm_path)
+        else:
+            return False
+    elif ssd_error:
         log('SSD module not found')
         msg1 = 'Missing ssd_wv module required for DRM content'
         msg2 = '{0} not found in {1}'.format(
-            drmconfig.SSD_WV_DICT[system_],
+            p.ssd_filename,
             xbmc.translatePath(addon.getSetting('DECRYPTERPATH')))
         msg2 = ('Do you want to attempt downloading the missing ssd_wv '
                 'module for your system?')
@@ -323,27 +811,125 @@ def check_inputstream(drm=True):
             get_ssd_wv(cdm_path)
         else:
             return False
+
+    if not (check_binary(cdm_fn) or check_binary(ssd_fn)):
+        store_verdict(drm, cdm_path)
     return True
 
 
-def unzip_cdm(zpath, cdm_path):
+def unzip_cdm(zpath, cdm_path, progress=None):
     """
-    extract windows widevinecdm.dll from downloaded zip
+    extract widevinecdm library from downloaded zip
     """
-    cdm_fn = posixpath.join(cdm_path, widevinecdm_filename)
-    log('unzipping widevinecdm.dll from {0} to {1}'.format(zpath, cdm_fn))
-    with zipfile.ZipFile(zpath) as zf:
-        with open(cdm_fn, 'wb') as f:
-            data = zf.read('widevinecdm.dll')
-            f.write(data)
+    import drmarchive
+    p = get_platform()
+    cdm_fn = posixpath.join(cdm_path, p.widevinecdm_filename)
+    member = get_capability().cdm_member
+    log('unzipping {0} from {1} to {2}', member, zpath, cdm_fn)
+    with drmtiming.span('extract_cdm') as span:
+        span.set(bytes=drmarchive.extract_zip_member(zpath, member, cdm_fn,
+                                                     progress))
     os.remove(zpath)
 
 
+def fetch_widevinecdm(url, member, cdm_fn, progress=None, connections=1,
+                      session=None):
+    """
+    Download and extract the widevinecdm library to cdm_fn without any UI.
+    Only the library itself is fetched from zip files if the server allows
+    it, and .tar.xz files are decompressed on the fly. Otherwise the whole
+    archive is downloaded next to cdm_fn and extracted.
+    Raises DownloadError or ExtractError on failure.
+    """
+    import time
+    import drmarchive
+    import drmdownload
+    import drmmirror
+    with drmtiming.span('fetch_widevinecdm', url=url) as span:
+        started = time.time()
+        mirrors = drmmirror.order(get_mirror_urls(url), get_mirror_stats(),
+                                  session)
+        for i, mirror in enumerate(mirrors):
+            try:
+                transferred = _fetch_widevinecdm(mirror, member, cdm_fn,
+                                                 progress, connections,
+                                                 session)
+                record_download(mirror, started, transferred, i,
+                                background=session is not None)
+                break
+            except drmdownload.DownloadCancelled:
+                raise
+            except (drmdownload.DownloadError, drmarchive.ExtractError) as e:
+                if i == len(mirrors) - 1:
+                    record_download(mirror, started, retries=i, error=e,
+                                    background=session is not None)
+                    raise
+                log('Fetching {0} from {1} failed, trying next mirror: {2}',
+                    member, mirror, e, level=xbmc.LOGWARNING)
+                get_mirror_stats().record(mirror, failed=True)
+        span.set(bytes=os.path.getsize(cdm_fn), mirror=mirror)
+
+
+def _fetch_widevinecdm(url, member, cdm_fn, progress, connections,
+                       session=None):
+    """
+    Fetch member from one mirror, returns the bytes transferred, or the
+    size of the library when streamed from a .tar.xz
+    """
+    import drmarchive
+    import drmcapability
+    import drmdownload
+    filename = url.split('/')[-1]
+    method = drmcapability.extraction(filename)
+    if method == 'zip':
+        try:
+            remote = drmarchive.RemoteZip(url, session)
+            remote.extract(member, cdm_fn, progress)
+            log('Fetched {0} with {1} bytes transferred', member,
+                remote.transferred)
+            return remote.transferred
+        except (drmdownload.RangeNotSupported, drmarchive.ExtractError) as e:
+            log('Remote zip read failed, downloading whole archive: '
+                '{0}', e)
+    elif method == 'tar.xz' and drmarchive.has_lzma():
+        return drmarchive.stream_tar_xz_member(url, member, cdm_fn,
+                                               progress, session)
+
+    cdm_path = os.path.dirname(cdm_fn)
+    download_path = os.path.join(cdm_path, filename)
+    result = drmdownload.download(url, download_path, progress,
+                                  session=session, connections=connections)
+    log('Download complete, {0}, saved in {1}', result, download_path)
+    if method == 'zip':
+        drmarchive.extract_zip_member(download_path, member, cdm_fn,
+                                      progress)
+        os.remove(download_path)
+    else:  # no lzma module, fall back to system tools
+        from pipes import quote
+        command = get_capability().unarchive_command
+        if not command:
+            raise drmarchive.ExtractError(
+                'No way to extract {0} from {1}'.format(member, filename))
+        command = command.format(
+            quote(filename),
+            quote(cdm_path),
+            os.path.basename(cdm_fn))
+        log('executing command: {0}', command)
+        os.system(command)
+        if not os.path.isfile(cdm_fn):
+            raise drmarchive.ExtractError(
+                '{0} could not be extracted from {1}'.format(member,
+                                                             filename))
+    return result.transferred
+
+
+@drmtiming.traced('get_widevinecdm')
 def get_widevinecdm(cdm_path=None):
     """
     Win/Mac: download Chrome extension blob ~2MB and extract widevinecdm.dll
     Linux: download Chrome package ~50MB and extract libwidevinecdm.so
     Linux arm: download widevine package ~2MB from 3rd party host
+    Returns True if it's installed afterwards.
     """
     if not cdm_path:
         addon = get_addon()
@@ -351,68 +937,108 @@ def get_widevinecdm(cdm_path=None):
             xbmcgui.Dialog().ok('inputstream.adaptive not found',
                                 'inputstream.adaptive add-on must be installed'
                                 ' before installing widevide_cdm module')
-            return
+            return False
         cdm_path = xbmc.translatePath(addon.getSetting('DECRYPTERPATH'))
 
     if xbmc.getCondVisibility('system.platform.android'):
         log('Widevinecdm update - not possible on Android')
         xbmcgui.Dialog().ok('Not required for Android',
                             'This module cannot be updated on Android')
-        return
+        return False
 
-    url = drmconfig.WIDEVINECDM_URL[plat]
-    filename = url.split('/')[-1]
+    p = get_platform()
+    url, member, cache_key = get_cdm_source()
+    if not url:
+        log('Widevinecdm download - not available for {0}', p.plat)
+        xbmcgui.Dialog().ok('Not available for this OS',
+                            'There is no widevinecdm module to download '
+                            'for {0}'.format(p.plat))
+        return False
 
     if not os.path.isdir(cdm_path):
-        log('Creating directory: {0}'.format(cdm_path))
+        log('Creating directory: {0}', cdm_path)
         os.makedirs(cdm_path)
-    cdm_fn = os.path.join(cdm_path, widevinecdm_filename)
-    if os.path.isfile(cdm_fn):
-        log('Removing existing widevine_cdm: {0}'.format(cdm_fn))
-        os.remove(cdm_fn)
-    download_path = os.path.join(cdm_path, filename)
-    if not progress_download(url, download_path, widevinecdm_filename):
-        return
-
-    dp = xbmcgui.DialogProgress()
-    dp.create('Extracting {0}'.format(widevinecdm_filename),
-              'Extracting {0} from {1}'.format(widevinecdm_filename, filename))
-    dp.update(0)
-
-    if system_ == 'Windows':
-        unzip_cdm(download_path, cdm_path)
-    else:
-        command = drmconfig.UNARCHIVE_COMMAND[plat].format(
-            quote(filename),
-            quote(cdm_path),
-            drmconfig.WIDEVINECDM_DICT[system_])
-        log('executing command: {0}'.format(command))
-        os.system(command)
-    dp.close()
+    cdm_fn = os.path.join(cdm_path, p.widevinecdm_filename)
+    with single_flight(cache_key):
+        # checked while holding the lock, as another process may have just
+        # installed it
+        current = is_installed_current(cdm_fn, cache_key)
+        if not current:
+            if os.path.isfile(cdm_fn):
+                log('Removing existing widevine_cdm: {0}', cdm_fn)
+                os.remove(cdm_fn)
+            sha256 = _install_widevinecdm(url, member, cache_key, cdm_fn)
+            if not sha256:
+                return False
+    if current:
+        log('{0} is already current, skipping download', cdm_fn)
+        xbmcgui.Dialog().ok('Already installed',
+                            '{0} at {1} is already up to date'.format(
+                                p.widevinecdm_filename, cdm_path))
+        return True
     xbmcgui.Dialog().ok('Success', '{0} successfully installed at {1}'.format(
-        widevinecdm_filename, os.path.join(cdm_path, widevinecdm_filename)))
+        p.widevinecdm_filename, cdm_fn))
+    return True
 
 
+def _install_widevinecdm(url, member, cache_key, cdm_fn):
+    """
+    Install the widevinecdm library at cdm_fn from the local cache or by
+    downloading it, for callers holding the lock on cache_key.
+    Returns its sha256 digest, or None on failure.
+    """
+    import drmarchive
+    import drmdownload
+    p = get_platform()
+    sha256 = cache_restore(cache_key, cdm_fn)
+    if not sha256:
+        log('Downloading {0} and extracting {1}', url, member)
+        dp = xbmcgui.DialogProgress()
+        dp.create('Downloading {0}'.format(p.widevinecdm_filename),
+                  'Downloading and extracting {0}'.format(member), url)
+        try:
+            fetch_widevinecdm(url, member, cdm_fn, dialog_progress(dp, url),
+                              drmconfig.DOWNLOAD_CONNECTIONS)
+        except drmdownload.DownloadCancelled:
+            log('Download of {0} cancelled', url)
+            return None
+        except (drmdownload.DownloadError, drmarchive.ExtractError) as e:
+            xbmcgui.Dialog().ok('Download failed', str(e))
+            log('Error installing {0} from {1}: {2}', member, url, e,
+                level=xbmc.LOGERROR)
+            return None
+        finally:
+            dp.close()
+        sha256 = cache_store(cache_key, cdm_fn)
+    record_install(cache_key, cdm_fn, sha256)
+    os.chmod(cdm_fn, 0755)
+    return sha256
+
+
+@drmtiming.traced('get_ssd_wv')
 def get_ssd_wv(cdm_path=None):
     """
-    Download compiled ssd_wv from github repository
+    Download compiled ssd_wv from github repository.
+    Returns True if it's installed afterwards.
     """
+    import drmdownload
     if not cdm_path:
         addon = get_addon()
         if not addon:
             xbmcgui.Dialog().ok('inputstream.adaptive not found',
                                 'inputstream.adaptive add-on must be installed'
                                 ' before installing ssd_wv module')
-            return
+            return False
         cdm_path = xbmc.translatePath(addon.getSetting('DECRYPTERPATH'))
 
     if xbmc.getCondVisibility('system.platform.android'):
         log('ssd_wv update - not possible on Android')
         xbmcgui.Dialog().ok('Not required for Android',
                             'This module cannot be updated on Android')
-        return
+        return False
 
-    if system_ == 'Linux' and not is_libreelec():
+    p = get_platform()
+    if p.system == 'Linux' and not is_libreelec():
         log('ssd_wv update - not possible on linux other than LibreELEC')
         xbmcgui.Dialog().ok('Not Available for this OS',
                             'This method is not available for installation '
@@ -420,92 +1046,758 @@ def get_ssd_wv(cdm_path=None):
                             'Try installing kodi-inputstream-adaptive '
                             'package from your terminal (eg Ubuntu. sudo apt '
                             'install kodi-inputstream-adaptive).')
-        return
+        return False
 
     if not os.path.isdir(cdm_path):
-        log('Creating directory: {0}'.format(cdm_path))
+        log('Creating directory: {0}', cdm_path)
         os.makedirs(cdm_path)
-    ssd = os.path.join(cdm_path, ssd_filename)
+    ssd = os.path.join(cdm_path, p.ssd_filename)
     # preserve link for addons/inputstream.adaptive/lib
     if os.path.islink(ssd):
         download_path = os.path.realpath(ssd)
         download_dir = os.path.dirname(download_path)
         if not os.path.isdir(download_dir):
-            log('Creating directory: {0}'.format(download_dir))
+            log('Creating directory: {0}', download_dir)
             os.makedirs(download_dir)
     else:
-        download_path = os.path.join(cdm_path, ssd_filename)
-    if os.path.isfile(download_path):
-        log('Removing existing ssd_wv: {0}'.format(download_path))
-        os.remove(download_path)
-
-    try:
-        kodi = drmconfig.KODI_NAME[get_kodi_version()[:2]]
-    # custom builds (SPMC etc.) might have something else here, let's assume
-    # Krypton for now
-    except KeyError:
-        kodi = 'Krypton'
-    commit = drmconfig.CURRENT_IA_VERSION[kodi]['commit']
-    ssdfn, ssdext = ssd_filename.split('.')[0], ssd_filename.split('.')[1]
-    url = '{base}{kodi}/{plat}-{ssdfn}-{commit}.{ssdext}'.format(
-        base=drmconfig.REPO_BASE,
-        kodi=kodi,
-        plat=plat.lower(),
-        ssdfn=ssdfn,
-        commit=commit,
-        ssdext=ssdext)
-
-    if not progress_download(url, download_path, ssd_filename):
-        return
-    os.chmod(download_path, 0755)
+        download_path = os.path.join(cdm_path, p.ssd_filename)
+
+    cap = get_capability()
+    kodi = cap.kodi_name
+    commit = cap.ia_commit
+    url = cap.ssd_url
+
+    tmp_path = os.path.join(os.path.dirname(download_path),
+                            versioned_filename(p.ssd_filename, commit))
+    with single_flight(url):
+        # checked while holding the lock, as another process may have just
+        # installed it. The old module stays until the new one replaces it.
+        current = is_installed_current(download_path, url)
+        if not current:
+            sha256 = restore_or_download(url, tmp_path, p.ssd_filename)
+            if not sha256:
+                return False
+            drmdownload.replace_file(tmp_path, download_path)
+            record_install(url, download_path, sha256)
+            os.chmod(download_path, 0755)
+    if current:
+        log('{0} is already current, skipping download', download_path)
+        xbmcgui.Dialog().ok('Already installed',
+                            '{0} version {1} for Kodi {2} is already '
+                            'installed at {3}'.format(p.ssd_filename, commit,
+                                                      kodi, download_path))
+        return True
     xbmcgui.Dialog().ok(
         'Success', ('{fn} version {commit} for Kodi {kodi} '
                     'successfully installed at {path}'.format(
-                        fn=ssd_filename,
+                        fn=p.ssd_filename,
                         commit=commit,
                         kodi=kodi,
                         path=download_path)))
+    return True
 
 
-def progress_download(url, download_path, display_filename=None):
+def get_artifact_cache():
     """
-    Download file in Kodi with progress bar
+    Return the shared local cache of downloaded files
     """
-    log('Downloading {0}'.format(url))
+    global _artifact_cache
+    import drmcache
+    if _artifact_cache is None:
+        _artifact_cache = drmcache.ArtifactCache(
+            xbmc.translatePath(drmconfig.ARTIFACT_CACHE_DIR),
+            drmconfig.ARTIFACT_CACHE_MAX_SIZE)
+    return _artifact_cache
+
+
+def get_mirror_stats():
+    """
+    Return the shared record of how fast each mirror has been
+    """
+    global _mirror_stats
+    import drmmirror
+    if _mirror_stats is None:
+        _mirror_stats = drmmirror.MirrorStats(
+            xbmc.translatePath(drmconfig.MIRROR_STATS_FILE))
+    return _mirror_stats
+
+
+def get_mirror_urls(url):
+    """
+    Return url followed by the URL of the same file on each mirror
+    """
+    manifest = get_manifest()
+    if url.startswith(manifest.REPO_BASE):
+        path = url[len(manifest.REPO_BASE):]
+        return [url] + [base + path for base in manifest.REPO_MIRRORS]
+    cap = get_capability()
+    if url == cap.cdm_url:
+        return [url] + cap.cdm_mirrors
+    return [url]
+
+
+def mirror_download(url, download_path, progress=None, connections=1,
+                    session=None):
+    """
+    Download url or the same file from one of its mirrors, whichever is
+    fastest, moving to another mirror part way through if one fails or
+    slows down. Returns a DownloadResult.
+    session -- a session from get_download_session() for background
+        downloads, None for full speed
+    """
+    import time
+    import drmdownload
+    import drmmirror
+    started = time.time()
     try:
-        res = requests.get(url, stream=True, verify=False)
-        res.raise_for_status()
-    except requests.exceptions.HTTPError:
-        xbmcgui.Dialog().ok('Download failed',
-                            'HTTP ' + str(res.status_code) + ' error')
-        log('Error retrieving {0}'.format(url))
+        result = drmmirror.download(get_mirror_urls(url), download_path,
+                                    progress, connections,
+                                    get_mirror_stats(), session,
+                                    detect_slow=session is None)
+    except drmdownload.DownloadCancelled:
+        raise
+    except drmdownload.DownloadError as e:
+        record_download(url, started, error=e,
+                        background=session is not None)
+        raise
+    record_download(result.url, started, result.transferred, result.retries,
+                    background=session is not None)
+    return result
+
+
+def is_playing():
+    return xbmc.Player().isPlaying()
+
+
+def get_download_session(background=False):
+    """
+    Return the session to download with at the given priority, or None for
+    the shared full speed one. Background downloads are held to
+    BACKGROUND_RATE bytes per second and, if BACKGROUND_PAUSE is set, stop
+    while Kodi is playing something.
+    """
+    global _background_session
+    import drmdownload
+    if not background:
+        return None
+    if _background_session is None:
+        _background_session = drmdownload.LimitedSession(
+            drmdownload.RateLimiter(
+                drmconfig.BACKGROUND_RATE,
+                pause=is_playing if drmconfig.BACKGROUND_PAUSE else None))
+    return _background_session
+
+
+def get_install_record():
+    """
+    Return the shared record of installed file digests
+    """
+    global _install_record
+    import drmcache
+    if _install_record is None:
+        _install_record = drmcache.InstallRecord(
+            xbmc.translatePath(drmconfig.INSTALL_RECORD_FILE))
+    return _install_record
+
+
+@contextlib.contextmanager
+def single_flight(key):
+    """
+    Hold a lock shared by every process and thread using drmhelper while
+    installing from or to key, so only one of them does the work and the
+    others wait and then reuse the result. If the holder seems stuck for
+    longer than LOCK_TIMEOUT we carry on without the lock.
+    """
+    import drmcache
+    lock = drmcache.FileLock(
+        os.path.join(xbmc.translatePath(drmconfig.LOCK_DIR),
+                     drmcache.make_key([key]) + '.lock'),
+        drmconfig.LOCK_TIMEOUT)
+    try:
+        lock.acquire()
+    except drmcache.LockTimeout:
+        log('Timed out waiting for another install of {0}', key)
+    except (IOError, OSError) as e:
+        log('Unable to lock {0}: {1}', key, e)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def is_installed_current(path, key):
+    """
+    Check if the file at path is the one that would be installed from key,
+    by comparing it with the expected size and digest from drmconfig or the
+    ones recorded when it was installed
+    """
+    import drmcache
+    expected = (get_manifest().ARTIFACT_DIGESTS.get(key) or
+                get_install_record().get(key))
+    if not expected or not os.path.isfile(path):
+        return False
+    return drmcache.file_matches(path, expected)
+
+
+def record_install(key, path, sha256):
+    """
+    Remember the digest of a file installed from key
+    """
+    expected = get_manifest().ARTIFACT_DIGESTS.get(key)
+    if expected and expected['sha256'] != sha256:
+        log('Digest of {0} from {1} does not match expected {2}', path, key,
+            expected['sha256'], level=xbmc.LOGWARNING)
+    get_install_record().set(key, os.path.getsize(path), sha256)
+
+
+def get_bundle_path():
+    """
+    Return the path of the offline bundle to use, or None. BUNDLE_PATH may
+    be a bundle or a folder of them named after BUNDLE_NAME.
+    """
+    if not drmconfig.BUNDLE_PATH:
+        return None
+    path = xbmc.translatePath(drmconfig.BUNDLE_PATH)
+    if os.path.isdir(path):
+        path = os.path.join(path, drmconfig.BUNDLE_NAME.format(
+            plat=get_platform().plat.lower(), kodi=get_target_kodi()))
+    return path
+
+
+def get_bundle():
+    """
+    Return the offline Bundle for this platform and Kodi version, or None
+    if there isn't one. It's looked for once per run.
+    """
+    global _bundle
+    import drmbundle
+    if _bundle is None:
+        _bundle = False
+        path = get_bundle_path()
+        if path:
+            try:
+                bundle = drmbundle.Bundle(path)
+            except drmbundle.BundleError as e:
+                log('Not using offline bundle: {0}', e,
+                    level=xbmc.LOGWARNING)
+                return None
+            if (bundle.plat, bundle.kodi) != (get_platform().plat,
+                                              get_target_kodi()):
+                log('Not using offline bundle {0}, it is for {1} {2}', path,
+                    bundle.plat, bundle.kodi, level=xbmc.LOGWARNING)
+                return None
+            _bundle = bundle
+    return _bundle or None
+
 
+def import_from_bundle(key, progress=None):
+    """
+    Copy the file for key from the offline bundle into the local cache,
+    verifying it on the way. Returns True if it's cached afterwards.
+    """
+    import drmbundle
+    bundle = get_bundle()
+    entry = bundle and bundle.lookup(key)
+    if not entry:
+        return False
+    expected = get_manifest().ARTIFACT_DIGESTS.get(key)
+    if expected and expected['sha256'] != entry['sha256']:
+        log('{0} in offline bundle {1} is not the expected version', key,
+            bundle.path, level=xbmc.LOGWARNING)
+        return False
+    cache = get_artifact_cache()
+    if entry['size'] > cache.max_size:
+        log('Not copying {0} from offline bundle, it is bigger than the '
+            'local cache', key, level=xbmc.LOGWARNING)
         return False
+    blob_path = cache.blob_path(entry['sha256'])
+    with drmtiming.span('bundle', key=key) as span:
+        try:
+            if not os.path.isdir(cache.directory):
+                os.makedirs(cache.directory)
+            bundle.extract(key, blob_path, progress)
+            cache.store(key, blob_path, entry['sha256'])
+        except (drmbundle.BundleError, IOError, OSError) as e:
+            log('Unable to copy {0} from offline bundle: {1}', key, e,
+                level=xbmc.LOGERROR)
+            return False
+        span.set(bytes=entry['size'])
+    log('Copied {0} from offline bundle {1}', key, bundle.path)
+    return True
+
+
+def lookup_artifact(key):
+    """
+    Return the path of the cached file for key, copying it from the offline
+    bundle first if it's only there. Returns None if neither has it.
+    """
+    path = get_artifact_cache().lookup(key)
+    if not path and import_from_bundle(key):
+        path = get_artifact_cache().lookup(key)
+    return path
+
 
-    total_length = float(res.headers.get('content-length'))
+def build_bundle(path):
+    """
+    Fetch every component this platform needs into the local cache and
+    write them all to an offline bundle at path, so identical devices can
+    be set up from it with BUNDLE_PATH and no network access.
+    Returns the bundle manifest.
+    """
+    import drmbundle
+    components = get_components(current=True)
+    for component in components:
+        component.stage(connections=drmconfig.DOWNLOAD_CONNECTIONS)
+    artifacts = [(c.key, lookup_artifact(c.key)) for c in components]
+    manifest = drmbundle.build(path, get_platform().plat, get_target_kodi(),
+                               artifacts)
+    log('Built offline bundle {0} with {1}', path,
+        ', '.join(c.name for c in components))
+    return manifest
+
+
+def cache_restore(key, path):
+    """
+    Copy a previously downloaded file from the local cache, or the offline
+    bundle, to path. Returns its sha256 digest, or None if it isn't cached.
+    """
+    cache = get_artifact_cache()
+    sha256 = get_manifest().ARTIFACT_DIGESTS.get(key, {}).get('sha256')
+    if (cache.restore(key, path, sha256) or
+            import_from_bundle(key) and cache.restore(key, path, sha256)):
+        log('Restored {0} from local cache', key)
+        return cache.digest(key)
+    return None
+
+
+def cache_store(key, path, sha256=None):
+    """
+    Keep a copy of a downloaded file in the local cache.
+    Returns its sha256 digest.
+    """
+    import drmcache
+    try:
+        return get_artifact_cache().store(key, path, sha256)
+    except drmcache.ArtifactTooLarge as e:
+        log('Not caching {0}: {1}', key, e, level=xbmc.LOGWARNING)
+    except (IOError, OSError) as e:
+        log('Unable to cache {0}: {1}', key, e)
+    return sha256 or drmcache.hash_file(path)
+
+
+def cached_download(url, download_path, display_filename=None,
+                    connections=1):
+    """
+    Download file in Kodi with progress bar unless it's in the local cache.
+    If another process is already downloading it, wait and use its copy.
+    Returns its sha256 digest, or None on failure.
+    """
+    with single_flight(url):
+        return restore_or_download(url, download_path, display_filename,
+                                   connections)
+
+
+def restore_or_download(url, download_path, display_filename=None,
+                        connections=1):
+    """
+    Same as cached_download(), for callers already holding the
+    single_flight() lock on url
+    """
+    sha256 = cache_restore(url, download_path)
+    if sha256:
+        return sha256
+    result = progress_download(url, download_path, display_filename,
+                               connections)
+    if not result:
+        return None
+    return cache_store(url, download_path, result.sha256)
+
+
+def install_from_cache(key, path):
+    """
+    Install a file staged in the local cache by the background service,
+    without downloading or showing any dialogs. Returns True on success.
+    """
+    if not lookup_artifact(key):
+        return False
+    with single_flight(key), drmtiming.span('install_cached', key=key):
+        if is_installed_current(path, key):  # another process beat us to it
+            return True
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        sha256 = cache_restore(key, path)
+        if not sha256:
+            return False
+        record_install(key, path, sha256)
+        os.chmod(path, 0755)
+    log('Installed staged {0} at {1}', key, path)
+    return True
+
+
+def get_binary_target():
+    """
+    Return (machine, bits) the widevine modules must be built for to be
+    loaded by this Kodi, which may run a 32 bit userspace on a 64 bit CPU
+    """
+    import drmbinary
+    p = get_platform()
+    return drmbinary.target(p.arch, p.bits), p.bits
+
+
+def check_binary(path):
+    """
+    Check the module at path is complete and can be loaded by this Kodi,
+    reading only its headers. Returns None if so, otherwise the BinaryError
+    saying why not.
+    """
+    import drmbinary
+    machine, bits = get_binary_target()
+    try:
+        drmbinary.check(path, machine, bits)
+    except drmbinary.BinaryError as e:
+        return e
+    return None
+
+
+def needs_install(path, key):
+    """
+    Check if the file at path is missing, damaged or known to be outdated
+    """
+    import drmbinary
+    import drmcache
+    if not os.path.isfile(path):
+        return True
+    error = check_binary(path)
+    if error and not isinstance(error, drmbinary.IncompatibleBinary):
+        return True
+    expected = (get_manifest().ARTIFACT_DIGESTS.get(key) or
+                get_install_record().get(key))
+    return bool(expected) and not drmcache.file_matches(path, expected)
+
+
+def get_staging_path(filename):
+    """
+    Return path for a file being fetched into the cache in the background
+    """
+    staging_dir = xbmc.translatePath(drmconfig.STAGING_DIR)
+    try:
+        os.makedirs(staging_dir)
+    except OSError:  # already there, maybe made by another thread
+        if not os.path.isdir(staging_dir):
+            raise
+    return os.path.join(staging_dir, filename)
+
+
+def versioned_filename(filename, version):
+    """
+    Return filename with version added before the extension, eg.
+    libssd_wv-<commit>.so, so a partial download of one version is never
+    continued with another
+    """
+    if not filename or not version:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return '{0}-{1}{2}'.format(root, version, ext)
+
+
+class Component(object):
+    """
+    A file that may need to be installed for DRM playback and where to
+    fetch it from. filename is the name it's installed as in DECRYPTERPATH,
+    or None for the inputstream.adaptive zip. needed is False if the
+    installed copy is already up to date.
+    """
+    def __init__(self, name, key, url, member=None, filename=None,
+                 version=None, needed=True):
+        self.name = name
+        self.key = key
+        self.url = url
+        self.member = member
+        self.filename = filename
+        self.version = version
+        self.needed = needed
+
+    def fetch(self, dest, progress=None, connections=1, session=None):
+        """
+        Download the component to dest without any UI. Returns its sha256
+        digest if it was worked out during the download, otherwise None.
+        session -- a session from get_download_session() for background
+            downloads
+        """
+        if session is not None:
+            session.wait()  # mirrors can't be timed while we're paused
+        if self.member:
+            fetch_widevinecdm(self.url, self.member, dest, progress,
+                              connections, session)
+            return None
+        with drmtiming.span('download', url=self.url) as span:
+            result = mirror_download(self.url, dest, progress, connections,
+                                     session)
+            span.set(bytes=result.transferred,
+                     throughput=int(result.throughput), mirror=result.url)
+        return result.sha256
+
+    def stage(self, progress=None, connections=1, session=None):
+        """
+        Fetch the component into the local cache without any UI, unless
+        it's already there or another process has just put it there.
+        Returns True if it was fetched.
+        """
+        with single_flight(self.key):
+            if lookup_artifact(self.key):
+                return False
+            tmp_path = get_staging_path(versioned_filename(
+                self.filename, self.version) or self.url.split('/')[-1])
+            sha256 = self.fetch(tmp_path, progress, connections, session)
+            cache_store(self.key, tmp_path, sha256)
+            os.remove(tmp_path)
+            log('Staged {0}', self.key)
+            return True
+
+
+def get_cdm_path():
+    """
+    Return the DECRYPTERPATH of inputstream.adaptive, or its default if the
+    add-on isn't installed yet
+    """
+    try:
+        path = xbmcaddon.Addon('inputstream.adaptive').getSetting(
+            'DECRYPTERPATH')
+    except RuntimeError:
+        path = None
+    return xbmc.translatePath(path or drmconfig.DEFAULT_DECRYPTER_PATH)
+
+
+def get_components(drm=True, addon=True, current=False):
+    """
+    Return list of the Components that are missing or out of date for this
+    platform, in the order they need to be installed.
+    drm -- include the widevine components
+    addon -- include inputstream.adaptive if it's older than the latest
+        compiled version
+    current -- also include the components that are up to date
+    """
+    import drmrpc
+    p = get_platform()
+    cap = get_capability()
+    if (not cap.needs_modules or
+            xbmc.getCondVisibility('system.platform.ios')):
+        return []
+    # other linux distros get these from their package manager
+    direct = not (p.system == 'Linux' and not is_libreelec())
+    components = []
+    ia_needed = False
+    if addon and direct:
+        details = drmrpc.get_addon_details('inputstream.adaptive')
+        url = cap.ia_url
+        ia_needed = not (details and is_ia_version_current(
+            details.get('version', '0'), latest=True))
+        components.append(Component(
+            'inputstream.adaptive', url, url, version=cap.ia_version,
+            needed=ia_needed))
+    if drm:
+        cdm_path = get_cdm_path()
+        if cap.can_fetch_cdm:
+            components.append(Component(
+                p.widevinecdm_filename, cap.cdm_key, cap.cdm_url,
+                cap.cdm_member, p.widevinecdm_filename,
+                needed=needs_install(os.path.join(
+                    cdm_path, p.widevinecdm_filename), cap.cdm_key)))
+        if direct:
+            url = cap.ssd_url
+            ssd_fn = os.path.join(cdm_path, p.ssd_filename)
+            # ssd_wv is built from the same commit as inputstream.adaptive,
+            # so it's updated along with it
+            components.append(Component(
+                p.ssd_filename, url, url, filename=p.ssd_filename,
+                version=cap.ia_commit,
+                needed=needs_install(ssd_fn, url) or (
+                    ia_needed and not is_installed_current(ssd_fn, url))))
+    return [c for c in components if current or c.needed]
+
+
+def stage_components(drm=True, background=False):
+    """
+    Fetch any components check_inputstream() would need to install into the
+    local cache, without installing them or showing any dialogs, so the
+    install at playback time doesn't need the network.
+    background -- download at background priority, see
+        get_download_session()
+    Returns list of the cache keys fetched. A component that fails is
+    logged and skipped, so the others are still fetched.
+    """
+    import drmarchive
+    import drmdownload
+    session = get_download_session(background)
+    staged = []
+    for component in get_components(drm):
+        try:
+            if component.stage(session=session):
+                staged.append(component.key)
+        except (drmdownload.DownloadError, drmarchive.ExtractError,
+                IOError, OSError) as e:
+            log('Unable to stage {0} from {1}: {2}', component.name,
+                component.url, e, level=xbmc.LOGERROR)
+    return staged
+
+
+def fetch_components(components):
+    """
+    Download components that aren't in the local cache yet at the same
+    time, showing one progress dialog for all of them.
+    Returns True if they're all in the cache afterwards.
+    """
+    import drmdownload
+    missing = [c for c in components if not lookup_artifact(c.key)]
+    if not missing:
+        return True
+    names = ', '.join(c.name for c in missing)
+    log('Downloading {0}', names)
+    dp = xbmcgui.DialogProgress()
+    dp.create('Downloading DRM components', 'Downloading {0}'.format(names))
+    tasks = [lambda progress, c=c: c.stage(progress,
+                                           drmconfig.DOWNLOAD_CONNECTIONS)
+             for c in missing]
+    try:
+        with drmtiming.span('download_all', components=len(tasks)):
+            results = drmdownload.run_parallel(
+                tasks, drmconfig.INSTALL_WORKERS, dialog_progress(dp))
+    except drmdownload.DownloadCancelled:
+        log('Download of {0} cancelled', names)
+        return False
+    finally:
+        dp.close()
+
+    errors = [(c, e) for c, e in zip(missing, results)
+              if isinstance(e, Exception)]
+    for c, e in errors:
+        log('Error retrieving {0} from {1}: {2}', c.name, c.url, e,
+            level=xbmc.LOGERROR)
+    if errors:
+        xbmcgui.Dialog().ok('Download failed', '\n'.join(
+            '{0}: {1}'.format(c.name, e) for c, e in errors))
+        return False
+    return True
+
+
+@drmtiming.traced('install_components')
+def install_components(drm=True, addon=True):
+    """
+    Install everything missing or out of date for DRM playback. All the
+    downloads run at once, so this takes about as long as the slowest of
+    them, then the components are installed in dependency order:
+    inputstream.adaptive first as it determines DECRYPTERPATH.
+    Returns True if everything is installed.
+    """
+    if not is_supported():
+        return False
+    components = get_components(drm, addon)
+    if not components:
+        log('All components are up to date')
+        return True
+    if not fetch_components(components):
+        return False
+
+    for component in components:
+        if component.filename:
+            path = os.path.realpath(os.path.join(get_cdm_path(),
+                                                 component.filename))
+            if not install_from_cache(component.key, path):
+                xbmcgui.Dialog().ok('Installation failed',
+                                    'Unable to install {0} at {1}'.format(
+                                        component.name, path))
+                return False
+            continue
+        try:
+            install_ia_zip(lookup_artifact(component.key))
+        except Exception as e:
+            xbmcgui.Dialog().ok('Unzipping failed',
+                                'Unzipping failed error {0}'.format(e))
+            return False
+    xbmcgui.Dialog().ok('Installation complete', '{0} installed.'.format(
+        ', '.join(c.name for c in components)))
+    return True
+
+
+def install_ia_zip(zpath):
+    """
+    Extract inputstream.adaptive zip to the addons folder and enable it.
+    Unchanged files aren't rewritten, and the add-on folder is swapped in
+    whole so a failed update leaves the previous version in place.
+    """
+    import drmarchive
+    import drmrpc
+    ia_path = os.path.join(xbmc.translatePath('special://home'), 'addons',
+                           'inputstream.adaptive')
+    with single_flight(ia_path), drmtiming.span('extract_ia') as span:
+        extracted, reused = drmarchive.extract_zip_tree(
+            zpath, 'inputstream.adaptive', ia_path)
+        span.set(extracted=extracted, reused=reused)
+    log('Extracted {0} files to {1}, {2} unchanged', extracted, ia_path,
+        reused)
+    xbmc.executebuiltin('UpdateLocalAddons', True)
+    drmrpc.clear()
+    #  enable addon, seems to default to disabled
+    drmrpc.set_addon_enabled('inputstream.adaptive')
+
+
+def dialog_progress(dp, url=None):
+    """
+    Return a download progress callback that drives a DialogProgress.
+    The dialog is only redrawn when the percentage changes.
+    """
+    state = {'percent': None}
+
+    def update(downloaded, total):
+        if dp.iscanceled():
+            return True
+        if total:
+            percent = int(downloaded * 100 / total)
+            if percent != state['percent']:
+                state['percent'] = percent
+                dp.update(percent)
+        else:
+            dp.update(0, 'Downloaded {0:.1f} MB'.format(
+                downloaded / 1048576.0), url or '')
+        return False
+    return update
+
+
+def progress_download(url, download_path, display_filename=None,
+                      connections=1):
+    """
+    Download file in Kodi with progress bar. Returns a DownloadResult, or
+    False on failure.
+    connections -- number of parallel connections to use for large files
+    """
+    import drmdownload
+    log('Downloading {0}', url)
     dp = xbmcgui.DialogProgress()
     if not display_filename:
-        display_filename = download_path.split()[-1]
+        display_filename = os.path.basename(download_path)
     dp.create("Downloading {0}".format(display_filename),
               "Downloading File", url)
-
-    with open(download_path, 'wb') as f:
-        chunk_size = 1024
-        downloaded = 0
-        for chunk in res.iter_content(chunk_size=chunk_size):
-            f.write(chunk)
-            downloaded += len(chunk)
-            percent = int(downloaded*100/total_length)
-            if dp.iscanceled():
-                dp.close()
-                res.close()
-            dp.update(percent)
-    log('Download {0} bytes complete, saved in {1}'.format(
-        int(total_length), download_path))
-    dp.close()
-    return True
+    try:
+        with drmtiming.span('download', url=url) as span:
+            result = mirror_download(url, download_path,
+                                     dialog_progress(dp, url), connections)
+            span.set(bytes=result.transferred,
+                     throughput=int(result.throughput), mirror=result.url)
+    except drmdownload.DownloadCancelled:
+        log('Download of {0} cancelled', url)
+        return False
+    except drmdownload.DownloadError as e:
+        xbmcgui.Dialog().ok('Download failed', str(e))
+        log('Error retrieving {0}: {1}', url, e, level=xbmc.LOGERROR)
+        return False
+    finally:
+        dp.close()
+    log('Download complete, {0} from {1}, saved in {2}', result, result.url,
+        download_path)
+    return result
 
 
+@drmtiming.traced('get_ia_direct')
 def get_ia_direct(update=False, drm=True):
     """
     Download inputstream.adaptive zip file from remote repository and save in
@@ -514,7 +1806,8 @@ def get_ia_direct(update=False, drm=True):
     if not is_supported():
         return False
 
-    if system_ == 'Linux' and not is_libreelec():
+    p = get_platform()
+    if p.system == 'Linux' and not is_libreelec():
         log('inputstream.adaptive update not possible on this Linux distro')
         xbmcgui.Dialog().ok('Not Available for this OS',
                             'This method is not available for installation '
@@ -524,50 +1817,25 @@ def get_ia_direct(update=False, drm=True):
                             'install kodi-inputstream-adaptive).')
         return False
 
-    try:
-        kodi = drmconfig.KODI_NAME[get_kodi_version()[:2]]
-    # custom builds (SPMC etc.) might have something else here, let's assume
-    # Krypton for now
-    except KeyError:
-        kodi = 'Krypton'
-    ver = drmconfig.CURRENT_IA_VERSION[kodi]['ver']
-    commit = drmconfig.CURRENT_IA_VERSION[kodi]['commit']
+    cap = get_capability()
+    kodi = cap.kodi_name
+    ver = cap.ia_version
+    commit = cap.ia_commit
 
     log('Attempting manual install of inputstream.adaptive (update={0}, '
-        'drm={1}, kodi={2})'.format(str(update), str(drm), kodi))
+        'drm={1}, kodi={2})', update, drm, kodi)
 
-    url = '{base}{kodi}/{plat}-inputstream.adaptive-{ver}-{commit}.zip'.format(
-        base=drmconfig.REPO_BASE,
-        kodi=kodi,
-        plat=plat.lower(),
-        ver=ver,
-        commit=commit)
+    url = cap.ia_url
 
     filename = url.split('/')[-1]
     location = os.path.join(xbmc.translatePath('special://home'), filename)
-    if not progress_download(url, location, filename):
+    if not cached_download(url, location, filename):
         xbmcgui.Dialog().ok('Download Failed', 'Failed to download {0} from '
                             '{1}'.format(filename, url))
         return False
     else:
         try:
-            with zipfile.ZipFile(location, "r") as z:
-                addons_path = os.path.join(
-                    xbmc.translatePath('special://home'), 'addons')
-                if update:
-                    ia_path = os.path.join(addons_path, 'inputstream.adaptive')
-                    if os.path.isdir(ia_path):
-                        shutil.rmtree(ia_path)
-                    os.mkdir(ia_path)
-
-                z.extractall(addons_path)
-            xbmc.executebuiltin('UpdateLocalAddons', True)
-            #  enable addon, seems to default to disabled
-            json_string = ('{"jsonrpc":"2.0","id":1,"method":'
-                           '"Addons.SetAddonEnabled","params":'
-                           '{"addonid":"inputstream.adaptive",'
-                           '"enabled":true}}')
-            xbmc.executeJSONRPC(json_string)
+            install_ia_zip(location)
             xbmcgui.Dialog().ok(
                 'Installation complete',
                 ('inputstream.adaptive version {ver} commit '
@@ -0,0 +1,170 @@
+import json
+import time
+from distutils.version import LooseVersion
+
+import drmcache
+import drmdownload
+
+# drmconfig tables a manifest may override. Dict tables are merged with the
+# built in ones, so a manifest only needs the entries that changed.
+KEYS = {'CURRENT_IA_VERSION': dict,
+        'MIN_IA_VERSION': dict,
+        'MIN_LEIA_BUILD': list,
+        'REPO_BASE': str,
+        'REPO_MIRRORS': list,
+        'WIDEVINECDM_URL': dict,
+        'WIDEVINECDM_MEMBER': dict,
+        'WIDEVINECDM_MIRRORS': dict,
+        'ARTIFACT_DIGESTS': dict}
+# longest accepted manifest, anything bigger isn't ours
+MAX_SIZE = 256 * 1024
+
+
+class ManifestError(Exception):
+    """
+    Raised when a manifest can't be fetched or doesn't make sense
+    """
+    pass
+
+
+def validate(data):
+    """
+    Check a decoded manifest only holds known tables of the right types
+    """
+    if not isinstance(data, dict):
+        raise ManifestError('Manifest is not a JSON object')
+    for name, value in data.items():
+        expected = KEYS.get(name)
+        if expected is None:
+            continue  # newer manifests may carry tables we don't use yet
+        if expected is str:
+            ok = isinstance(value, type(u''))
+        else:
+            ok = isinstance(value, expected)
+        if not ok:
+            raise ManifestError('{0} should be a {1}'.format(
+                name, expected.__name__))
+    for kodi, info in data.get('CURRENT_IA_VERSION', {}).items():
+        if not isinstance(info, dict) or not {'ver', 'commit'} <= set(info):
+            raise ManifestError('CURRENT_IA_VERSION for {0} needs ver and '
+                                'commit'.format(kodi))
+    if len(data.get('MIN_LEIA_BUILD', ['', ''])) != 2:
+        raise ManifestError('MIN_LEIA_BUILD should be [date, commit]')
+    return data
+
+
+class Manifest(object):
+    """
+    The version and URL tables in effect: those in config, the drmconfig
+    module, with any from a remote manifest on top. Version strings are
+    parsed once each rather than on every comparison.
+    """
+    def __init__(self, config, overrides=None):
+        overrides = overrides or {}
+        for name in KEYS:
+            value = getattr(config, name)
+            if name in overrides:
+                if isinstance(value, dict):
+                    value = dict(value, **overrides[name])
+                else:
+                    value = overrides[name]
+            setattr(self, name, value)
+        self.MIN_LEIA_BUILD = tuple(str(v) for v in self.MIN_LEIA_BUILD)
+        self.REPO_BASE = str(self.REPO_BASE)
+        self._versions = {}
+
+    def parse_version(self, ver):
+        """
+        Return a LooseVersion for ver, parsing each string only once
+        """
+        parsed = self._versions.get(ver)
+        if parsed is None:
+            parsed = self._versions[ver] = LooseVersion(ver)
+        return parsed
+
+
+class ManifestCache(drmcache.JSONStore):
+    """
+    Local copy of the remote manifest along with the validators needed to
+    ask the server whether it has changed
+    """
+    def lookup(self, url):
+        """
+        Return the cached entry for url, or None. The entry has the time
+        the server was last asked and, if one was ever fetched, the
+        manifest under 'data'.
+        """
+        entry = self._load()
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    @staticmethod
+    def is_fresh(entry, ttl):
+        return (entry is not None and
+                0 <= time.time() - entry.get('checked', 0) < ttl)
+
+    def mark_checked(self, url):
+        """
+        Note that the server was asked just now, so a failed fetch isn't
+        retried before the TTL is up
+        """
+        def change(entry):
+            if entry.get('url') != url:
+                entry.clear()
+                entry['url'] = url
+            entry['checked'] = time.time()
+        self.update(change)
+
+    def refresh(self, url, timeout, session=None):
+        """
+        Fetch url unless it hasn't changed since the cached copy, using the
+        ETag and Last-Modified validators from the last fetch. Returns the
+        updated entry. Raises DownloadError or ManifestError, leaving any
+        cached copy in place.
+        """
+        entry = self.lookup(url) or {}
+        headers = {}
+        if entry.get('data') is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('modified'):
+                headers['If-Modified-Since'] = entry['modified']
+        getter = session or drmdownload.get_session()
+        try:
+            # unlike the modules it lists, nothing else vouches for the
+            # manifest, so the certificate must be checked
+            res = getter.get(url, headers=headers, timeout=timeout,
+                             stream=True)
+        except drmdownload.network_errors() as e:
+            raise drmdownload.DownloadError(str(e))
+        try:
+            if res.status_code == 304:
+                data = entry['data']
+            elif res.status_code >= 400:
+                raise drmdownload.DownloadError(
+                    'HTTP {0} error'.format(res.status_code), res.status_code)
+            else:
+                body = res.raw.read(MAX_SIZE + 1, decode_content=True)
+                if len(body) > MAX_SIZE:
+                    raise ManifestError('Manifest is too big')
+                try:
+                    data = validate(json.loads(body.decode('utf-8')))
+                except ValueError as e:
+                    raise ManifestError('Manifest is not valid JSON: '
+                                        '{0}'.format(e))
+        except drmdownload.network_errors() as e:
+            raise drmdownload.DownloadError(str(e))
+        finally:
+            res.close()
+
+        new = {'url': url, 'checked': time.time(), 'data': data,
+               'etag': res.headers.get('ETag', entry.get('etag')),
+               'modified': res.headers.get('Last-Modified',
+                                           entry.get('modified'))}
+
+        def change(current):
+            current.clear()
+            current.update(new)
+        self.update(change)
+        return new
@@ -0,0 +1,197 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import drmcache
+import drmdownload
+
+PERCENTILES = (50, 90, 99)
+# traced calls recorded as installs, the rest only show up as phases
+INSTALL_CALLS = ('get_widevinecdm', 'get_ssd_wv', 'get_ia_direct',
+                 'install_components', 'provision')
+# phases of check_inputstream() meaning it had to install something
+INSTALL_PHASES = INSTALL_CALLS + ('install_cached',)
+
+
+class MetricsLog(object):
+    """
+    Append only log of timings, one JSON object per line. Once the file is
+    bigger than max_size it's moved to path + '.1', replacing the previous
+    one, so at most about twice max_size is kept.
+    """
+    def __init__(self, path, max_size, **common):
+        self.path = path
+        self.max_size = max_size
+        self.common = common
+        self._lock = threading.Lock()
+
+    @property
+    def paths(self):
+        return [self.path + '.1', self.path]
+
+    def record(self, kind, **fields):
+        """
+        Add an entry of kind, eg. 'download', with fields and the common
+        fields given when the log was made. Errors are ignored, losing a
+        sample mustn't break playback.
+        """
+        entry = dict(self.common, kind=kind, time=round(time.time(), 3))
+        entry.update(fields)
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                # a single write to a file opened for appending doesn't
+                # interleave with other processes' lines
+                with open(self.path, 'a') as f:
+                    f.write(line)
+                    size = f.tell()
+                if size > self.max_size:
+                    self._rotate()
+            except (IOError, OSError):
+                pass
+
+    def _rotate(self):
+        with drmcache.FileLock(self.path + '.lock'):
+            # another process may have rotated it while we waited
+            if os.path.getsize(self.path) > self.max_size:
+                drmdownload.replace_file(self.path, self.path + '.1')
+
+    def read(self):
+        return read(self.paths)
+
+
+def read(paths):
+    """
+    Yield the entries of the metrics files at paths, oldest file first,
+    skipping missing files and lines that aren't complete
+    """
+    for path in paths:
+        try:
+            f = open(path)
+        except (IOError, OSError):
+            continue
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # cut short by a crash or a full disk
+                if isinstance(entry, dict):
+                    yield entry
+
+
+def percentile(values, pct):
+    """
+    Return the pct percentile of sorted values, interpolating between the
+    closest two
+    """
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def distribution(values):
+    """
+    Return count, min, max and PERCENTILES of values
+    """
+    values = sorted(v for v in values if v is not None)
+    result = {'count': len(values)}
+    if values:
+        result['min'] = round(values[0], 3)
+        result['max'] = round(values[-1], 3)
+        for pct in PERCENTILES:
+            result['p{0}'.format(pct)] = round(percentile(values, pct), 3)
+    return result
+
+
+def _downloads(entries):
+    ok = [e for e in entries if not e.get('error')]
+    return {'count': len(entries),
+            'failed': len(entries) - len(ok),
+            'bytes': sum(e.get('bytes', 0) for e in ok),
+            'retries': sum(e.get('retries', 0) for e in entries),
+            'duration': distribution(e.get('duration') for e in ok),
+            'throughput': distribution(e.get('throughput') for e in ok)}
+
+
+def summarise(entries):
+    """
+    Aggregate metrics entries into percentiles by platform: downloads
+    overall and by source, check_inputstream() outcomes and latency, and
+    the duration of each kind of install that succeeded
+    """
+    platforms = {}
+    for entry in entries:
+        platforms.setdefault(entry.get('plat', 'unknown'), []).append(entry)
+    summary = {}
+    for plat, group in platforms.items():
+        downloads = [e for e in group if e.get('kind') == 'download']
+        by_source = {}
+        for e in downloads:
+            by_source.setdefault(e.get('source'), []).append(e)
+        checks = [e for e in group if e.get('kind') == 'check']
+        outcomes = {}
+        for e in checks:
+            outcome = e.get('outcome')
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        installs = {}
+        for e in group:
+            if e.get('kind') == 'install':
+                installs.setdefault(e.get('call'), []).append(e)
+        summary[plat] = {
+            'downloads': dict(_downloads(downloads), by_source=dict(
+                (source, _downloads(d)) for source, d in by_source.items())),
+            'checks': {'count': len(checks),
+                       'outcomes': outcomes,
+                       'latency': distribution(e.get('latency')
+                                               for e in checks)},
+            'installs': dict(
+                (call, {'count': len(i),
+                        'failed': len([e for e in i if e.get('error')]),
+                        'duration': distribution(e.get('duration') for e in i
+                                                 if not e.get('error'))})
+                for call, i in installs.items()),
+        }
+    return summary
+
+
+def check_outcome(summary):
+    """
+    Return what a check_inputstream() trace summary says happened: cached,
+    ok, installed, failed or error
+    """
+    if summary.get('error'):
+        return 'error'
+    if not summary.get('result'):
+        return 'failed'
+    names = [phase.get('name') for phase in summary.get('phases', [])]
+    if names == ['verdict']:
+        return 'cached'
+    if any(name in INSTALL_PHASES for name in names):
+        return 'installed'
+    return 'ok'
+
+
+def main(argv):
+    """
+    Print a summary of metrics files as JSON, eg. ones copied from a number
+    of devices:
+    python lib/drmmetrics.py metrics.jsonl.1 metrics.jsonl
+    """
+    if not argv:
+        sys.stderr.write('usage: drmmetrics.py metrics.jsonl...\n')
+        return 2
+    print(json.dumps(summarise(read(argv)), indent=1, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,201 @@
+import threading
+import time
+
+import drmcache
+import drmdownload
+
+# bytes requested from each mirror when racing them
+PROBE_BYTES = 16 * 1024
+RACE_TIMEOUT = 10
+# a transfer slower than this for SLOW_WINDOW seconds moves to another mirror
+MIN_THROUGHPUT = 32 * 1024
+SLOW_WINDOW = 10
+# stats older than this are refreshed by racing the mirrors again
+STATS_TTL = 24 * 60 * 60
+# weight of the newest sample in the running averages
+SMOOTHING = 0.3
+
+
+def host(url):
+    """
+    Return the scheme and host part of a URL, which stats are kept by
+    """
+    return '/'.join(url.split('/', 3)[:3])
+
+
+class MirrorStats(drmcache.JSONStore):
+    """
+    Running averages of the latency and throughput seen from each mirror
+    host, kept between runs so later downloads can skip the race
+    """
+    def get(self, url):
+        return self._load().get(host(url))
+
+    def record(self, url, latency=None, throughput=None, failed=False):
+        def change(data):
+            entry = data.setdefault(host(url), {'failures': 0})
+            for name, value in (('latency', latency),
+                                ('throughput', throughput)):
+                if value is not None:
+                    old = entry.get(name)
+                    entry[name] = (value if old is None else
+                                   old + SMOOTHING * (value - old))
+            entry['failures'] = entry['failures'] + 1 if failed else 0
+            entry['updated'] = time.time()
+        self.update(change)
+
+    def is_fresh(self, urls):
+        """
+        Check if there are recent stats for all of urls
+        """
+        now = time.time()
+        for url in urls:
+            entry = self.get(url)
+            if not entry or now - entry.get('updated', 0) > STATS_TTL:
+                return False
+        return True
+
+    def rank(self, urls):
+        """
+        Return urls ordered by expected speed, mirrors that failed last
+        time going to the back
+        """
+        def key(item):
+            index, url = item
+            entry = self.get(url) or {}
+            return (entry.get('failures', 0),
+                    entry.get('latency', RACE_TIMEOUT), index)
+        return [url for _, url in sorted(enumerate(urls), key=key)]
+
+
+class ThroughputMonitor(object):
+    """
+    Progress callback wrapper that cancels a transfer whose throughput
+    stays under MIN_THROUGHPUT for SLOW_WINDOW seconds
+    """
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.slow = False
+        self.samples = []
+
+    def __call__(self, done, total):
+        now = time.time()
+        self.samples.append((now, done))
+        # keep the newest sample at least SLOW_WINDOW old as the baseline
+        while (len(self.samples) > 1 and
+               now - self.samples[1][0] >= SLOW_WINDOW):
+            self.samples.pop(0)
+        first_time, first_done = self.samples[0]
+        if (now - first_time >= SLOW_WINDOW and
+                (done - first_done) / (now - first_time) < MIN_THROUGHPUT):
+            self.slow = True
+            return True
+        return bool(self.progress and self.progress(done, total))
+
+
+def probe(url, session=None):
+    """
+    Return seconds until the first bytes of url arrive
+    """
+    getter = session or drmdownload.get_session()
+    started = time.time()
+    try:
+        res = getter.get(url, stream=True, verify=False,
+                         headers={'Range': 'bytes=0-{0}'.format(
+                             PROBE_BYTES - 1)},
+                         timeout=(RACE_TIMEOUT, RACE_TIMEOUT))
+    except drmdownload.network_errors() as e:
+        raise drmdownload.DownloadError(str(e))
+    try:
+        if res.status_code >= 400:
+            raise drmdownload.DownloadError(
+                'HTTP {0} error'.format(res.status_code), res.status_code)
+        res.raw.read(1)
+    except drmdownload.network_errors() as e:
+        raise drmdownload.DownloadError(str(e))
+    finally:
+        res.close()
+    return time.time() - started
+
+
+def race(urls, session=None):
+    """
+    Probe all urls at once. Returns a list of (url, latency) for those that
+    answered, fastest first, and a list of those that didn't.
+    """
+    latencies = {}
+
+    def worker(url):
+        try:
+            latencies[url] = probe(url, session)
+        except drmdownload.DownloadError:
+            pass
+
+    threads = [threading.Thread(target=worker, args=(url,)) for url in urls]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    deadline = time.time() + RACE_TIMEOUT
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+    answered = sorted(latencies.items(), key=lambda item: item[1])
+    failed = [url for url in urls if url not in latencies]
+    return answered, failed
+
+
+def order(urls, stats=None, session=None):
+    """
+    Return urls in the order they should be tried. With several mirrors
+    and no recent stats for them, they're raced to find the fastest.
+    """
+    if len(urls) < 2:
+        return list(urls)
+    if stats is not None and stats.is_fresh(urls):
+        return stats.rank(urls)
+    answered, failed = race(urls, session)
+    if stats is not None:
+        for url, latency in answered:
+            stats.record(url, latency=latency)
+        for url in failed:
+            stats.record(url, failed=True)
+    return [url for url, _ in answered] + failed
+
+
+def download(urls, path, progress=None, connections=1, stats=None,
+             session=None, detect_slow=True):
+    """
+    Download a file available from several mirrors to path, starting with
+    the fastest. If a mirror fails or slows to a crawl part way through,
+    the download carries on from the next one with a Range request.
+    detect_slow -- move on from slow mirrors, which should be off for
+        downloads that are slowed down on purpose
+    Returns the DownloadResult of the mirror that finished the download,
+    with the mirrors given up on counted in its retries.
+    """
+    candidates = order(urls, stats, session)
+    error = None
+    for i, url in enumerate(candidates):
+        last = i == len(candidates) - 1
+        if last or not detect_slow:
+            monitor = progress
+        else:
+            monitor = ThroughputMonitor(progress)
+        try:
+            result = drmdownload.download(url, path, monitor,
+                                          session=session,
+                                          connections=connections,
+                                          key=urls[0])
+        except drmdownload.DownloadCancelled:
+            if not getattr(monitor, 'slow', False):
+                raise
+            error = drmdownload.DownloadError('{0} too slow'.format(url))
+        except drmdownload.DownloadError as e:
+            error = e
+        else:
+            if stats is not None and detect_slow:
+                stats.record(url, throughput=result.throughput)
+            result.retries += i
+            return result
+        if stats is not None:
+            stats.record(url, failed=True)
+    raise error
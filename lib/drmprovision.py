@@ -0,0 +1,355 @@
+import json
+import os
+import sys
+import time
+
+import xbmc
+
+import drmconfig
+import drmhelper
+import drmtiming
+
+CURRENT = 'current'
+INSTALLED = 'installed'
+MISSING = 'missing'
+OUTDATED = 'outdated'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+UNSUPPORTED = 'unsupported'
+
+# where missing components may be installed from: downloads from the
+# binary repo and widevine hosts, or an installed Kodi repository
+# (inputstream.adaptive only). Components already staged in the local
+# cache or in the offline bundle are always used.
+SOURCES = ('direct', 'repository')
+
+
+class Policy(object):
+    """
+    What provision() may do on its own.
+    auto_install -- install missing and outdated components, otherwise only
+        report their state
+    drm -- include the widevine components
+    sources -- where components may be fetched from, any of SOURCES.
+        Installing from a Kodi repository asks for confirmation on some
+        Kodi versions, so it isn't allowed by default.
+    time_budget -- seconds the whole run may take, or None for no limit.
+        Downloads still running when it's used up are cancelled.
+    background -- download at background priority, limited to
+        BACKGROUND_RATE and pausing during playback
+    """
+    def __init__(self, auto_install=True, drm=True, sources=('direct',),
+                 time_budget=None, background=False):
+        unknown = set(sources) - set(SOURCES)
+        if unknown:
+            raise ValueError('Unknown sources: {0}'.format(
+                ', '.join(sorted(unknown))))
+        self.auto_install = auto_install
+        self.drm = drm
+        self.sources = tuple(sources)
+        self.time_budget = time_budget
+        self.background = background
+
+    def allows(self, source):
+        return source in self.sources
+
+
+class Budget(object):
+    """
+    Time left of a Policy's time_budget. Also works as a download progress
+    callback, cancelling the download once time is up.
+    """
+    def __init__(self, seconds):
+        self.deadline = None if seconds is None else time.time() + seconds
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def __call__(self, done, total):
+        return self.expired()
+
+
+class Status(object):
+    """
+    State of one component after provisioning
+    """
+    def __init__(self, component, state, version=None, path=None,
+                 elapsed=0.0, source=None, error=None):
+        self.component = component
+        self.state = state
+        self.version = version
+        self.path = path
+        self.elapsed = elapsed
+        self.source = source
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.state in (CURRENT, INSTALLED)
+
+    def to_dict(self):
+        return {'component': self.component,
+                'state': self.state,
+                'version': self.version,
+                'path': self.path,
+                'elapsed': round(self.elapsed, 3),
+                'source': self.source,
+                'error': self.error}
+
+
+class Report(object):
+    """
+    Outcome of a provision() run, one Status per component
+    """
+    def __init__(self, platform=None):
+        self.platform = platform
+        self.components = []
+        self.started = time.time()
+        self.elapsed = None
+
+    def add(self, status):
+        self.components.append(status)
+        return status
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+        return self
+
+    @property
+    def ok(self):
+        return all(status.ok for status in self.components)
+
+    def __nonzero__(self):
+        return self.ok
+    __bool__ = __nonzero__
+
+    def to_dict(self):
+        return {'ok': self.ok,
+                'platform': self.platform,
+                'elapsed': round(self.elapsed or 0, 3),
+                'components': [s.to_dict() for s in self.components]}
+
+    def __str__(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+
+def install_from_repository(report):
+    """
+    Install inputstream.adaptive from an installed Kodi repository.
+    Returns True if it's installed afterwards.
+    """
+    import drmrpc
+    started = time.time()
+    xbmc.executebuiltin('InstallAddon(inputstream.adaptive)', True)
+    drmrpc.clear()
+    details = drmrpc.get_addon_details('inputstream.adaptive')
+    if not details:
+        return False
+    report.add(Status('inputstream.adaptive', INSTALLED,
+                      details.get('version'), details.get('path'),
+                      time.time() - started, 'repository'))
+    return True
+
+
+def check_addon(report, policy):
+    """
+    Report on an inputstream.adaptive that isn't going to be updated
+    directly, enabling it if allowed. Returns True if it's usable.
+    """
+    import drmrpc
+    details = drmrpc.get_addon_details('inputstream.adaptive')
+    if not details:
+        if (policy.auto_install and policy.allows('repository') and
+                install_from_repository(report)):
+            return True
+        report.add(Status('inputstream.adaptive', MISSING,
+                          error='Not installed'))
+        return False
+    version = details.get('version', '0')
+    if not drmhelper.is_ia_version_current(version):
+        report.add(Status('inputstream.adaptive', OUTDATED, version,
+                          details.get('path'),
+                          error='Older than the minimum version'))
+        return False
+    status = report.add(Status('inputstream.adaptive', CURRENT, version,
+                               details.get('path')))
+    if details.get('enabled') is False:
+        if not policy.auto_install:
+            status.state = FAILED
+            status.error = 'Not enabled'
+            return False
+        drmrpc.set_addon_enabled('inputstream.adaptive')
+    return True
+
+
+def fetch(components, budget, background=False):
+    """
+    Download components that aren't in the local cache at the same time.
+    Returns a dict of component name to (seconds taken, error or None).
+    """
+    import drmdownload
+    timings = {}
+    session = drmhelper.get_download_session(background)
+    connections = 1 if background else drmconfig.DOWNLOAD_CONNECTIONS
+
+    def task(component):
+        def run(progress):
+            started = time.time()
+            try:
+                component.stage(progress, connections, session)
+            finally:
+                timings[component.name] = time.time() - started
+        return run
+
+    try:
+        results = drmdownload.run_parallel(
+            [task(c) for c in components], drmconfig.INSTALL_WORKERS,
+            budget)
+    except drmdownload.DownloadCancelled:
+        results = [None] * len(components)
+    outcome = {}
+    for c, result in zip(components, results):
+        error = result if isinstance(result, Exception) else None
+        outcome[c.name] = (timings.get(c.name, 0.0), error)
+    return outcome
+
+
+def install(component, report, elapsed, source):
+    """
+    Install a component from the local cache
+    """
+    started = time.time()
+    cache = drmhelper.get_artifact_cache()
+    if component.filename:
+        path = os.path.realpath(os.path.join(drmhelper.get_cdm_path(),
+                                             component.filename))
+        if drmhelper.install_from_cache(component.key, path):
+            state, error = INSTALLED, None
+        else:
+            state, error = FAILED, 'Unable to install from local cache'
+    else:
+        path = os.path.join(xbmc.translatePath('special://home'), 'addons',
+                            'inputstream.adaptive')
+        try:
+            drmhelper.install_ia_zip(cache.lookup(component.key))
+            state, error = INSTALLED, None
+        except Exception as e:
+            state, error = FAILED, str(e)
+    report.add(Status(component.name, state, component.version, path,
+                      elapsed + time.time() - started, source, error))
+
+
+@drmtiming.traced('provision')
+def provision(policy=None):
+    """
+    Check and install everything needed for DRM playback without showing
+    any dialogs, for unattended setups. policy says what may be installed
+    from where and how long it may take. Returns a Report with the
+    component, state, version, path and time taken for each component.
+    """
+    import drmrpc
+    policy = policy or Policy()
+    budget = Budget(policy.time_budget)
+    p = drmhelper.get_platform()
+    report = Report(p.plat)
+    if not p.supported:
+        report.add(Status('platform', UNSUPPORTED, error='{0} {1} not '
+                          'supported for DRM playback'.format(p.system,
+                                                              p.arch)))
+        return report.finish()
+    drmrpc.clear()  # may have changed since the last run of the service
+
+    components = drmhelper.get_components(policy.drm, current=True)
+    ia = [c for c in components if c.filename is None]
+    if not (ia and ia[0].needed):  # installed and current, or not ours
+        if not check_addon(report, policy):
+            return report.finish()
+    cdm_path = drmhelper.get_cdm_path()
+    pending = []
+    paths = {}
+    for c in components:
+        if c.filename is None:
+            if not c.needed:
+                continue  # reported by check_addon()
+            path = (drmrpc.get_addon_details('inputstream.adaptive') or
+                    {}).get('path')
+        else:
+            path = os.path.realpath(os.path.join(cdm_path, c.filename))
+        paths[c.name] = path
+        if not c.needed:
+            report.add(Status(c.name, CURRENT, c.version, path))
+        elif not policy.auto_install:
+            exists = path and os.path.exists(path)
+            report.add(Status(c.name, OUTDATED if exists else MISSING,
+                              c.version, path))
+        else:
+            pending.append(c)
+
+    cache = drmhelper.get_artifact_cache()
+    to_fetch = [c for c in pending if not drmhelper.lookup_artifact(c.key)]
+    if to_fetch and not policy.allows('direct'):
+        for c in to_fetch:
+            report.add(Status(c.name, MISSING, c.version, paths[c.name],
+                              error='Not in the local cache and downloads '
+                                    'are not allowed'))
+        pending = [c for c in pending if c not in to_fetch]
+        to_fetch = []
+    outcome = {}
+    if to_fetch and not budget.expired():
+        outcome = fetch(to_fetch, budget, policy.background)
+
+    for c in pending:
+        elapsed, error = outcome.get(c.name, (0.0, None))
+        source = 'direct' if c in to_fetch else 'cache'
+        if cache.lookup(c.key):
+            install(c, report, elapsed, source)
+        elif error is not None:
+            report.add(Status(c.name, FAILED, c.version, paths[c.name],
+                              elapsed, source, str(error)))
+        else:
+            report.add(Status(c.name, TIMED_OUT, c.version, paths[c.name],
+                              elapsed, source, 'Time budget used up'))
+    report.finish()
+    drmhelper.log('Provisioning finished: {0}', report)
+    return report
+
+
+def parse_args(argv):
+    """
+    Build a Policy from key=value arguments. Booleans are true or false,
+    sources are joined with '+' as RunScript splits arguments on commas.
+    """
+    kwargs = {}
+    for arg in argv:
+        key, _, value = arg.partition('=')
+        if key in ('auto_install', 'drm', 'background'):
+            kwargs[key] = value.lower() in ('true', '1', 'yes')
+        elif key == 'sources':
+            kwargs[key] = tuple(s for s in value.split('+') if s)
+        elif key == 'time_budget':
+            kwargs[key] = float(value)
+        else:
+            raise ValueError('Unknown argument: {0}'.format(arg))
+    return Policy(**kwargs)
+
+
+def main(argv):
+    """
+    Script entry point, eg. from Kodi:
+    RunScript(special://home/addons/script.module.drmhelper/lib/
+    drmprovision.py, time_budget=600, sources=direct+repository)
+    The report is logged and saved as json to PROVISION_REPORT_FILE.
+    """
+    import drmcache
+    report = provision(parse_args(argv))
+    path = xbmc.translatePath(drmconfig.PROVISION_REPORT_FILE)
+    try:
+        drmcache.write_json(path, report.to_dict())
+    except (IOError, OSError) as e:
+        drmhelper.log('Unable to save provisioning report to {0}: {1}', path,
+                      e, level=xbmc.LOGERROR)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+import json
+
+import xbmc
+
+ADDON_PROPERTIES = ['enabled', 'version', 'path']
+# add-ons whose details are fetched together in one batch
+PREFETCH_ADDONS = ['inputstream.adaptive']
+
+_addon_details = {}
+
+
+class JSONRPCError(Exception):
+    """
+    Raised when a JSON-RPC call fails or returns an error
+    """
+    def __init__(self, message, code=None):
+        super(JSONRPCError, self).__init__(message)
+        self.code = code
+
+
+def _request(method, params, req_id):
+    return {'jsonrpc': '2.0', 'id': req_id, 'method': method,
+            'params': params}
+
+
+def _result(response):
+    if 'error' in response:
+        error = response['error']
+        return JSONRPCError(error.get('message', 'JSON-RPC error'),
+                            error.get('code'))
+    return response.get('result')
+
+
+def _execute(payload):
+    try:
+        return json.loads(xbmc.executeJSONRPC(json.dumps(payload)))
+    except (RuntimeError, ValueError) as e:
+        raise JSONRPCError(str(e))
+
+
+def call(method, **params):
+    """
+    Make a single JSON-RPC call and return its result
+    """
+    result = _result(_execute(_request(method, params, 1)))
+    if isinstance(result, JSONRPCError):
+        raise result
+    return result
+
+
+def batch(calls):
+    """
+    Make several JSON-RPC calls in one round trip using the array form of a
+    request. calls is a list of (method, params) tuples. Returns a list of
+    results in the same order, with a JSONRPCError in place of any call
+    that failed.
+    """
+    payload = [_request(method, params, i)
+               for i, (method, params) in enumerate(calls)]
+    responses = _execute(payload)
+    if not isinstance(responses, list):  # batches not supported
+        results = []
+        for method, params in calls:
+            try:
+                results.append(call(method, **params))
+            except JSONRPCError as e:
+                results.append(e)
+        return results
+    by_id = dict((r.get('id'), _result(r)) for r in responses)
+    return [by_id.get(i, JSONRPCError('No response'))
+            for i in range(len(calls))]
+
+
+def get_addon_details(addonid):
+    """
+    Return dict with enabled, version and path of an installed add-on, or
+    None if it isn't installed. Results are remembered until clear() is
+    called, and the details of all PREFETCH_ADDONS are fetched in the same
+    batch as the first lookup.
+    """
+    if addonid not in _addon_details:
+        ids = [addonid] + [a for a in PREFETCH_ADDONS
+                           if a != addonid and a not in _addon_details]
+        results = batch([('Addons.GetAddonDetails',
+                          {'addonid': i, 'properties': ADDON_PROPERTIES})
+                         for i in ids])
+        for i, result in zip(ids, results):
+            if isinstance(result, JSONRPCError):
+                _addon_details[i] = None
+            else:
+                _addon_details[i] = result.get('addon')
+    return _addon_details[addonid]
+
+
+def set_addon_enabled(addonid, enabled=True):
+    """
+    Enable or disable an add-on
+    """
+    result = call('Addons.SetAddonEnabled', addonid=addonid, enabled=enabled)
+    if _addon_details.get(addonid):
+        _addon_details[addonid]['enabled'] = enabled
+    return result
+
+
+def clear():
+    """
+    Forget remembered add-on details, eg. after installing an add-on
+    """
+    _addon_details.clear()
@@ -0,0 +1,99 @@
+import platform
+import struct
+import threading
+
+import xbmc
+
+import drmconfig
+import drmhelper
+import drmrpc
+
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# CPU family of each machine name the kernel may report
+MACHINES = {
+    'x86_64': 'x86',
+    'i686': 'x86',
+    'i386': 'x86',
+    'aarch64': 'arm',
+    'armv8l': 'arm',
+    'armv7l': 'arm',
+    'armv6l': 'arm',
+}
+# (gettid, ioprio_set) syscall numbers for linux by CPU family and process
+# bitness, which can differ from the kernel's, eg. 32 bit LibreELEC builds
+# on aarch64
+SYSCALLS = {
+    ('x86', 64): (186, 251),
+    ('x86', 32): (224, 289),
+    ('arm', 64): (178, 30),
+    ('arm', 32): (224, 314),
+}
+
+
+def lower_priority():
+    """
+    Put the calling thread in the idle I/O class and give it the lowest CPU
+    priority where the OS allows it, so staging downloads don't compete with
+    playback. Only supported on Linux, elsewhere this does nothing.
+    """
+    if platform.system() != 'Linux':
+        return False
+    bits = struct.calcsize('P') * 8
+    syscalls = SYSCALLS.get((MACHINES.get(platform.machine()), bits))
+    if not syscalls:
+        return False
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        tid = libc.syscall(syscalls[0])
+        libc.syscall(syscalls[1], IOPRIO_WHO_PROCESS, tid,
+                     IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        # PRIO_PROCESS with a thread id only affects that thread on linux
+        libc.setpriority(0, tid, 19)
+        return True
+    except Exception:
+        return False
+
+
+def provision():
+    """
+    Stage any components that are missing or out of date
+    """
+    lower_priority()
+    # add-ons may have been installed or updated since the last run
+    drmrpc.clear()
+    try:
+        drmhelper.update_manifest()
+        staged = drmhelper.stage_components(background=True)
+    except Exception as e:
+        drmhelper.log('Background provisioning failed: {0}', e,
+                      level=xbmc.LOGERROR)
+        return
+    if staged:
+        drmhelper.log('Staged for install: {0}', ', '.join(staged))
+
+
+def run():
+    """
+    Service entry point. Checks components shortly after login and then
+    periodically, each time in a background thread so Kodi can still stop
+    the service promptly.
+    """
+    monitor = xbmc.Monitor()
+    if monitor.waitForAbort(drmconfig.SERVICE_STARTUP_DELAY):
+        return
+    while True:
+        worker = threading.Thread(target=provision)
+        worker.daemon = True
+        worker.start()
+        while worker.is_alive():
+            if monitor.waitForAbort(1):
+                return
+        if monitor.waitForAbort(drmconfig.SERVICE_INTERVAL):
+            return
+
+
+if __name__ == '__main__':
+    run()
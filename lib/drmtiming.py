@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+
+_hooks = []
+_logger = None
+_local = threading.local()
+
+
+def set_logger(logger):
+    """
+    Log the summary line of each traced call with logger(format, arg), or
+    stop logging them if logger is None
+    """
+    global _logger
+    _logger = logger
+
+
+def add_hook(callback):
+    """
+    Call callback(summary) at the end of each traced call, with a dict of
+    the call name, total duration and list of phases
+    """
+    if callback not in _hooks:
+        _hooks.append(callback)
+
+
+def remove_hook(callback):
+    if callback in _hooks:
+        _hooks.remove(callback)
+
+
+def is_enabled():
+    return _logger is not None or bool(_hooks)
+
+
+class NullSpan(object):
+    """
+    Stands in for a span when nothing is being timed
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **extra):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """
+    One timed phase of a traced call. Extra details such as byte counts
+    can be added with set() and end up in the summary.
+    """
+    def __init__(self, trace, name, extra):
+        self.trace = trace
+        self.name = name
+        self.extra = extra
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        phase = dict(self.extra, name=self.name,
+                     duration=round(time.time() - self.started, 4))
+        if exc_type is not None:
+            phase['error'] = exc_type.__name__
+        with self.trace.lock:
+            self.trace.phases.append(phase)
+        return False
+
+    def set(self, **extra):
+        self.extra.update(extra)
+
+
+class Trace(object):
+    """
+    Timings of one top level call, emitted as a single summary when the
+    call ends. Worker threads doing part of the call may add phases to it
+    too, see attach().
+    """
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def summary(self, result=None, error=None):
+        summary = {'call': self.name,
+                   'total': round(time.time() - self.started, 4),
+                   'phases': self.phases}
+        if error is not None:
+            summary['error'] = error
+        else:
+            summary['result'] = result
+        return summary
+
+    def emit(self, summary):
+        if _logger is not None:
+            _logger('Timings: {0}', json.dumps(summary, sort_keys=True,
+                                               default=str))
+        for hook in list(_hooks):
+            try:
+                hook(summary)
+            except Exception:
+                pass  # a broken hook mustn't break playback
+
+
+def current():
+    """
+    Return the trace of the call in progress on this thread, or None
+    """
+    return getattr(_local, 'trace', None)
+
+
+def attach(trace):
+    """
+    Make trace, from current() on another thread, the call in progress on
+    this thread, so spans of work handed to a worker thread end up in the
+    caller's summary
+    """
+    _local.trace = trace
+
+
+def span(name, **extra):
+    """
+    Return a context manager timing a phase of the current call
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return NULL_SPAN
+    return Span(trace, name, extra)
+
+
+def traced(name):
+    """
+    Decorator timing each call of a function along with the spans inside
+    it. Calls made while another traced call is running on the same thread
+    are recorded as a phase of that call instead, with whether their result
+    was true.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            outer = getattr(_local, 'trace', None)
+            if outer is not None:
+                with Span(outer, name, {}) as span:
+                    result = func(*args, **kwargs)
+                    span.set(result=bool(result))
+                    return result
+            trace = _local.trace = Trace(name)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                _local.trace = None
+                trace.emit(trace.summary(error=type(e).__name__))
+                raise
+            _local.trace = None
+            trace.emit(trace.summary(result))
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator